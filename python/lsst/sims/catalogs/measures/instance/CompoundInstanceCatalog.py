@@ -1,7 +1,92 @@
 from __future__ import with_statement
+import os
+import copy
+import shutil
+import tempfile
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy
 from collections import OrderedDict
 from lsst.sims.catalogs.generation.db import CompoundCatalogDBObject
+from .ConnectionPool import ConnectionPool
+
+
+# the CompoundInstanceCatalog whose groups are written by a worker
+# process (see CompoundInstanceCatalog._write_concurrently)
+_worker_compound_catalog = None
+
+def _init_group_worker(compound_catalog):
+    global _worker_compound_catalog
+    _worker_compound_catalog = compound_catalog
+
+def _write_group_segment(row, segment_name, chunk_size, write_header):
+    """Write one group of InstanceCatalogs in a worker process"""
+    _worker_compound_catalog._write_segment(row, segment_name, chunk_size, write_header)
+
+
+class _ChunkColumnView(object):
+    """
+    The chunk seen by one of the InstanceCatalogs written by
+    CompoundInstanceCatalog._write_compound.
+
+    This mimics a numpy record array containing the columns of the
+    InstanceCatalog.  Columns are looked up by name (chunk['ra'], chunk.ra
+    or chunk.field('ra')) in the chunk returned by the CompoundCatalogDBObject
+    and returned as read-only views of its fields, so that no data is copied.
+    The view also has the len(), size, shape and dtype of a record array,
+    and can be indexed by row (with an integer, a slice, a boolean mask or
+    an array of indices), which returns a copy of the selected rows as a
+    numpy record (array) with the InstanceCatalog's column names.
+    """
+    def __init__(self, chunk, column_map, dtype=None):
+        """
+        @param [in] chunk is the record array returned by the CompoundCatalogDBObject
+
+        @param [in] column_map is an OrderedDict mapping the names of the
+        InstanceCatalog's columns to the names of the fields of chunk
+
+        @param [in] dtype is the dtype of a record array containing the
+        InstanceCatalog's columns.  It is built from chunk and column_map if
+        None; pass the dtype of the view of a previous chunk to reuse it.
+        """
+        self._chunk = chunk
+        self._column_map = column_map
+        if dtype is None:
+            dtype = numpy.dtype([(column, chunk.dtype[name])
+                                 for column, name in column_map.items()])
+        self.dtype = dtype
+
+    def __getitem__(self, item):
+        if isinstance(item, basestring):
+            field = self._chunk[self._column_map[item]].view()
+            field.flags['WRITEABLE'] = False
+            return field
+
+        rows = self._chunk[item]
+        fields = [rows[name] for name in self._column_map.values()]
+        if numpy.ndim(rows) == 0:
+            return numpy.rec.array([tuple(fields)], dtype=self.dtype)[0]
+        return numpy.rec.fromarrays(fields, dtype=self.dtype)
+
+    def __getattr__(self, name):
+        # only called for the names which are not attributes of the view
+        if name.startswith('_') or name not in self.__dict__.get('_column_map', ()):
+            raise AttributeError(name)
+        return self[name]
+
+    def field(self, column):
+        return self[column]
+
+    def __len__(self):
+        return len(self._chunk)
+
+    @property
+    def size(self):
+        return len(self._chunk)
+
+    @property
+    def shape(self):
+        return (len(self._chunk),)
 
 
 class CompoundInstanceCatalog(object):
@@ -18,7 +103,8 @@ class CompoundInstanceCatalog(object):
     """
 
     def __init__(self, instanceCatalogClassList, catalogDBObjectClassList,
-                 obs_metadata=None, constraint=None, compoundDBclass = None):
+                 obs_metadata=None, constraint=None, compoundDBclass = None,
+                 connection_pool=None):
         """
         @param [in] instanceCatalogClassList is a list of the InstanceCatalog
         classes to be combined into one output catalog.
@@ -45,6 +131,10 @@ class CompoundInstanceCatalog(object):
 
         Note: compoundDBclass should be a CompoundCatalogDBObject class.
         Not an instantiation of a CompoundCatalogDBObject class.
+
+        @param [in] connection_pool is an optional ConnectionPool from which
+        to get the database connections.  If None, the pool shared by the whole
+        process (ConnectionPool.default()) is used.
         """
 
         self._compoundDBclass = compoundDBclass
@@ -52,7 +142,10 @@ class CompoundInstanceCatalog(object):
         self._dbo_list = catalogDBObjectClassList
         self._ic_list = instanceCatalogClassList
         self._constraint = constraint
-        self._active_connections = []
+        if connection_pool is None:
+            self._connection_pool = ConnectionPool.default()
+        else:
+            self._connection_pool = connection_pool
 
         assigned = [False]*len(self._dbo_list)
         self._dbObjectGroupList = []
@@ -134,53 +227,15 @@ class CompoundInstanceCatalog(object):
 
         @param [in] dbo is a DBObject class that needs to be connected
 
-        @param [out] returns a connection of self._active_connections
+        @param [out] returns a connection of self._connection_pool
         that suits the DBObject.  Returns None otherwise.
         """
 
-        if hasattr(dboClass, 'database'):
-            desired_database = dboClass.database
-        else:
-            desired_database = None
-
-        if hasattr(dboClass, 'driver'):
-            desired_driver = dboClass.driver
-        else:
-            desired_driver = None
-
-        if hasattr(dboClass, 'host'):
-            desired_host = dboClass.host
-        else:
-            desired_host = None
-
-        if hasattr(dboClass, 'port'):
-            desired_port = dboClass.port
-        else:
-            desired_port = None
-
-
-        if hasattr(dboClass, 'verbose'):
-            desired_verbose = dboClass.verbose
-        else:
-            desired_verbose = False
-
+        return self._connection_pool.get_connection(dboClass)
 
-        best_connection = None
 
-        for cc in self._active_connections:
-            if cc.database is desired_database and \
-               cc.driver is desired_driver and \
-               cc.host is desired_host and \
-               cc.port is desired_port and \
-               cc.verbose is desired_verbose:
-
-                best_connection = cc
-                break
-
-        return best_connection
-
-
-    def write_catalog(self, filename, chunk_size=None, write_header=True, write_mode='w'):
+    def write_catalog(self, filename, chunk_size=None, write_header=True, write_mode='w',
+                      concurrency=None, n_workers=None):
         """
         Write the stored list of InstanceCatalogs to a single ASCII output catalog.
 
@@ -196,35 +251,130 @@ class CompoundInstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] concurrency is None (the default) to write the groups of
+        InstanceCatalogs which query the same table one after the other,
+        'threads' to write them concurrently in threads (best if the time is spent
+        querying the database) or 'processes' to write them concurrently in worker
+        processes (best if the time is spent in the getters).  Each group is
+        written to a temporary file next to filename; the temporary files are then
+        concatenated into filename in the same order as when concurrency is None.
+        Each group opens its own database connections.
+
+        @param [in] n_workers is the number of threads or processes to use if
+        concurrency is not None (default: one per group)
         """
 
-        instantiated_ic_list = [None]*len(self._ic_list)
+        if concurrency is not None:
+            self._write_concurrently(filename, concurrency, n_workers, chunk_size=chunk_size,
+                                     write_header=write_header, write_mode=write_mode)
+            return
 
         # first, loop over all of the InstanceCatalog and CatalogDBObject classes, pre-processing
         # them (i.e. verifying that they have access to all of the columns they need)
-        for ix, (icClass, dboClass) in enumerate(zip(self._ic_list, self._dbo_list)):
-            best_connection = self.find_a_connection(dboClass)
-            if best_connection is None:
-                dbo = dboClass()
-                self._active_connections.append(dbo.connection)
-            else:
-                dbo = dboClass(connection=best_connection)
+        instantiated_ic_list = self._instantiate_catalogs(range(len(self._ic_list)))
+
+        for row in self._ordered_groups():
+            self._write_group(row, instantiated_ic_list, filename, chunk_size=chunk_size,
+                              write_header=write_header, write_mode=write_mode)
+            write_mode = 'a'
+            write_header = False
+
+
+    def _ordered_groups(self):
+        """
+        Return the rows of self._dbObjectGroupList in the order in which they
+        are written: first the InstanceCatalogs which are alone in querying their
+        table, then the groups of InstanceCatalogs which query the same table.
+        """
+        return [row for row in self._dbObjectGroupList if len(row)==1] + \
+               [row for row in self._dbObjectGroupList if len(row)>1]
 
+
+    def _instantiate_catalogs(self, indices):
+        """
+        Instantiate and pre-process some of the InstanceCatalogs.
+
+        @param [in] indices is a list of indices in the list of InstanceCatalog classes
+
+        @param [out] a list with one element per InstanceCatalog class; the elements
+        corresponding to indices are the instantiated InstanceCatalogs, the others are None
+        """
+        instantiated_ic_list = [None]*len(self._ic_list)
+
+        for ix in indices:
+            icClass = self._ic_list[ix]
+            dbo = self._connection_pool.get_db_object(self._dbo_list[ix])
             ic = icClass(dbo, obs_metadata=self._obs_metadata)
             ic._write_pre_process()
             instantiated_ic_list[ix] = ic
 
+        return instantiated_ic_list
+
+
+    def _write_group(self, row, instantiated_ic_list, filename,
+                     chunk_size=None, write_header=False, write_mode='a'):
+        """
+        Write out one row of self._dbObjectGroupList
+
+        @param [in] row is the list of indices of the InstanceCatalogs in the group
 
-        for row in self._dbObjectGroupList:
-            if len(row)==1:
-                ic = instantiated_ic_list[row[0]]
-                ic._query_and_write(filename, chunk_size=chunk_size,
-                                    write_header=write_header, write_mode=write_mode,
-                                    obs_metadata=self._obs_metadata,
-                                    constraint=self._constraint)
-                write_mode = 'a'
-                write_header = False
+        @param [in] instantiated_ic_list is a list of InstanceCatalogs as returned
+        by self._instantiate_catalogs
 
+        The other parameters are as in self._write_compound
+        """
+
+        if len(row)==1:
+            ic = instantiated_ic_list[row[0]]
+            ic._query_and_write(filename, chunk_size=chunk_size,
+                                write_header=write_header, write_mode=write_mode,
+                                obs_metadata=self._obs_metadata,
+                                constraint=self._constraint)
+            return
+
+        dbObjClassList = [self._dbo_list[ix] for ix in row]
+        catList = [instantiated_ic_list[ix] for ix in row]
+
+        # if a connection is already open to the database, use
+        # it rather than opening a new connection
+        best_connection = self.find_a_connection(dbObjClassList[0])
+
+        if self._compoundDBclass is None:
+            compound_dbo = CompoundCatalogDBObject(dbObjClassList, connection=best_connection)
+        elif not hasattr(self._compoundDBclass, '__getitem__'):
+            # if self._compoundDBclass is not a list
+            try:
+                compound_dbo = self._compoundDBclass(dbObjClassList)
+            except:
+                compound_dbo = self._default_compound_dbo()(dbObjClassList)
+        else:
+            compound_dbo = None
+            for candidate in self._compoundDBclass:
+                use_it = True
+                if False in [candidate._table_restriction is not None \
+                             and dbo.tableid in candidate._table_restriction \
+                             for dbo in dbObjClassList]:
+
+                    use_it = False
+
+                if use_it:
+                    compound_dbo = candidate(dbObjClassList)
+                    break
+
+            if compound_dbo is None:
+                compound_dbo = self._default_compound_dbo()(dbObjClassList)
+
+        self._write_compound(catList, compound_dbo, filename,
+                             chunk_size=chunk_size, write_header=write_header,
+                             write_mode=write_mode)
+
+
+    def _default_compound_dbo(self):
+        """
+        Return the CompoundCatalogDBObject class to use for groups of InstanceCatalogs
+        which are not claimed by any of the classes in self._compoundDBclass
+        """
         default_compound_dbo = None
         if self._compoundDBclass is not None:
             if not hasattr(self._compoundDBclass, '__getitem__'):
@@ -236,48 +386,86 @@ class CompoundInstanceCatalog(object):
                         break
 
                 if default_compound_dbo is None:
-                    default_compound_dbo is CompoundCatalogDBObject
-
-        for row in self._dbObjectGroupList:
-            if len(row)>1:
-                dbObjClassList = [self._dbo_list[ix] for ix in row]
-                catList = [instantiated_ic_list[ix] for ix in row]
-
-                # if a connection is already open to the database, use
-                # it rather than opening a new connection
-                best_connection = self.find_a_connection(dbObjClassList[0])
-
-                if self._compoundDBclass is None:
-                    compound_dbo = CompoundCatalogDBObject(dbObjClassList, connection=best_connection)
-                elif not hasattr(self._compoundDBclass, '__getitem__'):
-                    # if self._compoundDBclass is not a list
-                    try:
-                        compound_dbo = self._compoundDBclass(dbObjClassList)
-                    except:
-                        compound_dbo = default_compound_dbo(dbObjClassList)
-                else:
-                    compound_dbo = None
-                    for candidate in self._compoundDBclass:
-                        use_it = True
-                        if False in [candidate._table_restriction is not None \
-                                     and dbo.tableid in candidate._table_restriction \
-                                     for dbo in dbObjClassList]:
-
-                            use_it = False
-
-                        if use_it:
-                            compound_dbo = candidate(dbObjClassList)
-                            break
-
-                    if compound_dbo is None:
-                        compound_dbo = default_compound_dbo(dbObjClassList)
-
-
-                self._write_compound(catList, compound_dbo, filename,
-                                     chunk_size=chunk_size, write_header=write_header,
-                                     write_mode=write_mode)
-                write_mode = 'a'
-                write_header = False
+                    default_compound_dbo = CompoundCatalogDBObject
+
+        return default_compound_dbo
+
+
+    def _write_concurrently(self, filename, concurrency, n_workers,
+                            chunk_size=None, write_header=True, write_mode='w'):
+        """
+        Write the rows of self._dbObjectGroupList concurrently to temporary
+        segment files and concatenate them into filename.
+
+        The parameters are as in self.write_catalog
+        """
+
+        if concurrency not in ('threads', 'processes'):
+            raise ValueError("Unrecognized concurrency: %s" % str(concurrency))
+
+        groups = self._ordered_groups()
+        if n_workers is None:
+            n_workers = len(groups)
+
+        segment_dir = os.path.dirname(os.path.abspath(filename))
+        segment_names = []
+        for ix in range(len(groups)):
+            file_descriptor, segment_name = tempfile.mkstemp(suffix='.segment', dir=segment_dir)
+            os.close(file_descriptor)
+            segment_names.append(segment_name)
+
+        if concurrency == 'threads':
+            pool = ThreadPool(n_workers)
+            write_segment = self._write_segment
+        else:
+            # The worker processes receive this CompoundInstanceCatalog
+            # through the pool initializer.
+            pool = multiprocessing.Pool(n_workers, initializer=_init_group_worker,
+                                        initargs=(self,))
+            write_segment = _write_group_segment
+
+        try:
+            results = [pool.apply_async(write_segment,
+                                        (row, segment_name, chunk_size,
+                                         write_header and ix==0))
+                       for ix, (row, segment_name) in enumerate(zip(groups, segment_names))]
+
+            pool.close()
+            for result in results:
+                result.get()
+
+            with open(filename, write_mode) as file_handle:
+                for segment_name in segment_names:
+                    with open(segment_name, 'r') as segment:
+                        shutil.copyfileobj(segment, file_handle)
+        finally:
+            pool.terminate()
+            for segment_name in segment_names:
+                if os.path.exists(segment_name):
+                    os.unlink(segment_name)
+
+
+    def _write_segment(self, row, segment_name, chunk_size, write_header):
+        """
+        Write one row of self._dbObjectGroupList to its own file, using
+        database connections (in a ConnectionPool of its own) which are not
+        shared with any other row.
+
+        @param [in] row is the list of indices of the InstanceCatalogs in the group
+
+        @param [in] segment_name is the name of the file to be written
+
+        @param [in] chunk_size is as in self.write_catalog
+
+        @param [in] write_header is a boolean specifying whether or not to begin
+        the file with the catalog header
+        """
+        writer = copy.copy(self)
+        with ConnectionPool(max_connections=self._connection_pool.max_connections) as pool:
+            writer._connection_pool = pool
+            instantiated_ic_list = writer._instantiate_catalogs(row)
+            writer._write_group(row, instantiated_ic_list, segment_name, chunk_size=chunk_size,
+                                write_header=write_header, write_mode='w')
 
 
     def _write_compound(self, catList, compound_dbo, filename,
@@ -305,19 +493,17 @@ class CompoundInstanceCatalog(object):
         'a' if you want to append to an existing output file (default: 'w')
         """
 
+        # column_maps[ix] maps the names of the columns that catList[ix]
+        # queries to their names in the CompoundCatalogDBObject
         colnames = []
-        master_colnames = []
-        name_map = []
+        column_maps = []
         dbObjNameList = [db.objid for db in compound_dbo._dbObjectClassList]
         for name, cat in zip(dbObjNameList, catList):
-            localNames = []
-            local_map = {}
+            column_map = OrderedDict()
             for colName in cat._active_columns:
                 colnames.append('%s_%s' % (name, colName))
-                localNames.append('%s_%s' % (name, colName))
-                local_map['%s_%s' % (name, colName)] = colName
-            master_colnames.append(localNames)
-            name_map.append(local_map)
+                column_map[colName] = '%s_%s' % (name, colName)
+            column_maps.append(column_map)
 
 
         master_results = compound_dbo.query_columns(colnames=colnames,
@@ -329,31 +515,78 @@ class CompoundInstanceCatalog(object):
             if write_header:
                 catList[0].write_header(file_handle)
 
-
-            new_dtype_list = [None]*len(catList)
+            chunk_cols_list = [None]*len(catList)
+            views = [None]*len(catList)
 
             first_chunk = True
             for chunk in master_results:
-                for ix, (catName, cat) in enumerate(zip(dbObjNameList, catList)):
+                for ix, cat in enumerate(catList):
 
                     if first_chunk:
-                        for iy, name in enumerate(master_colnames[ix]):
+                        # some columns are returned without the prefix
+                        for colName, name in column_maps[ix].items():
                             if name not in chunk.dtype.fields:
-                                master_colnames[ix][iy] = name_map[ix][name]
-
-                    local_recarray = chunk[master_colnames[ix]].view(numpy.recarray)
+                                column_maps[ix][colName] = colName
 
-                    local_recarray.flags['WRITEABLE'] = False # so numpy does not raise a warning
-                                                              # because it thinks we may accidentally
-                                                              # write to this array
-                    if new_dtype_list[ix] is None:
-                        new_dtype = numpy.dtype([
-                                                tuple([dd.replace(catName+'_','')] + [local_recarray.dtype[dd]]) \
-                                                for dd in master_colnames[ix]
-                                                ])
-                        new_dtype_list[ix] = new_dtype
+                    # the views of all the chunks of a catalog share one dtype
+                    views[ix] = _ChunkColumnView(chunk, column_maps[ix],
+                                                 None if first_chunk else views[ix].dtype)
+                    chunk_cols_list[ix] = cat._prepare_chunk_cols(cat._get_chunk_cols(views[ix],
+                                                                                      read_only=True))
 
-                    local_recarray.dtype = new_dtype_list[ix]
-                    cat._write_recarray(local_recarray, file_handle)
+                # write the blocks of all of the InstanceCatalogs with a single call
+                file_handle.write(self._format_compound_chunk(catList, chunk_cols_list))
 
                 first_chunk = False
+
+    def _format_compound_chunk(self, catList, chunk_cols_list):
+        """
+        Format one chunk of the output of several InstanceCatalogs as a
+        single string, with the lines of each InstanceCatalog in the order of
+        catList.
+
+        Consecutive InstanceCatalogs whose lines are laid out in the same way
+        (same column templates, dtypes, delimiter and endline) are formatted
+        together: their columns are concatenated and formatted with a single
+        pass of the line template.
+
+        @param [in] catList is the list of InstanceCatalog instantiations
+
+        @param [in] chunk_cols_list is a list containing, for each InstanceCatalog
+        in catList, the list of its output columns (as returned by
+        InstanceCatalog._prepare_chunk_cols)
+
+        @param [out] a string containing the formatted lines
+        """
+
+        blocks = []
+        group_cat = None
+        group_layout = None
+        group_cols = []
+
+        for cat, chunk_cols in zip(catList, chunk_cols_list):
+            layout = (tuple(cat._column_templates), cat.delimiter, cat.endline,
+                      tuple(col.dtype for col in chunk_cols))
+
+            if layout != group_layout:
+                if group_cat is not None:
+                    blocks.append(group_cat._format_chunk(self._concatenate_columns(group_cols)))
+                group_cat = cat
+                group_layout = layout
+                group_cols = []
+
+            group_cols.append(chunk_cols)
+
+        if group_cat is not None:
+            blocks.append(group_cat._format_chunk(self._concatenate_columns(group_cols)))
+
+        return ''.join(blocks)
+
+    def _concatenate_columns(self, chunk_cols_list):
+        """
+        Concatenate, column by column, a list of lists of columns
+        """
+        if len(chunk_cols_list) == 1:
+            return chunk_cols_list[0]
+
+        return [numpy.concatenate(cols) for cols in zip(*chunk_cols_list)]
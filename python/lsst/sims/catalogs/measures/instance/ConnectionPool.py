@@ -0,0 +1,185 @@
+"""Connection pool shared by the catalogs written in a process"""
+import os
+import threading
+from collections import OrderedDict
+
+__all__ = ["ConnectionPool"]
+
+
+class ConnectionPool(object):
+    """
+    A pool of open database connections, keyed on the parameters of the
+    connection (database, driver, host, port and verbose).
+
+    CatalogDBObject classes are instantiated through the pool with
+    get_db_object(); if the pool already holds a connection with the same
+    parameters, the new CatalogDBObject uses it instead of opening a new one.
+    The parameters are normalized before they are compared, so that, e.g.,
+    two equal strings or the port 3306 and '3306' select the same connection.
+
+    If max_connections is not None, the pool holds at most that many
+    connections; the least recently used connection is closed to make room
+    for a new one.  Closing a connection releases its resources, but the
+    catalogs that still refer to it can go on using it (it will reconnect).
+
+    All of the connections are closed by close() or at the end of a with
+    block:
+
+        with ConnectionPool(max_connections=4) as pool:
+            compoundCat = CompoundInstanceCatalog(..., connection_pool=pool)
+            compoundCat.write_catalog('catalog.txt')
+
+    The pool returned by ConnectionPool.default() is shared by all of the
+    CompoundInstanceCatalogs in a process which are not given a pool.
+    """
+
+    _default_pool = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, max_connections=None):
+        """
+        @param [in] max_connections is the maximum number of connections that
+        the pool holds (default None, i.e. no limit)
+        """
+        if max_connections is not None and max_connections < 1:
+            raise ValueError("max_connections must be at least 1; you gave %s" % str(max_connections))
+
+        self.max_connections = max_connections
+        self._connections = OrderedDict()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def default(cls):
+        """
+        Return the ConnectionPool shared by all of the catalogs in this process
+        """
+        with cls._default_lock:
+            if cls._default_pool is None:
+                cls._default_pool = cls()
+            return cls._default_pool
+
+    @staticmethod
+    def connection_key(database=None, driver=None, host=None, port=None, verbose=False):
+        """
+        Return the normalized tuple of connection parameters used as the key
+        of the pool
+
+        @param [in] database is the name of the database (or the path to the
+        database file for sqlite)
+
+        @param [in] driver is the database driver (e.g. 'sqlite' or 'mssql+pymssql')
+
+        @param [in] host is the database host
+
+        @param [in] port is the port on the host
+
+        @param [in] verbose is the verbosity of the connection
+        """
+        if driver is not None:
+            driver = str(driver).strip().lower()
+
+        if host is not None:
+            host = str(host).strip().lower()
+
+        if port is not None:
+            try:
+                port = int(port)
+            except ValueError:
+                port = str(port).strip()
+
+        if database is not None:
+            database = str(database).strip()
+            if driver == 'sqlite' and database != ':memory:':
+                database = os.path.abspath(database)
+
+        return (database, driver, host, port, bool(verbose))
+
+    def _key(self, dbo):
+        """
+        Return the key of the connection wanted (or held) by dbo, which may be
+        a CatalogDBObject class, a CatalogDBObject or a connection
+        """
+        return self.connection_key(database=getattr(dbo, 'database', None),
+                                   driver=getattr(dbo, 'driver', None),
+                                   host=getattr(dbo, 'host', None),
+                                   port=getattr(dbo, 'port', None),
+                                   verbose=getattr(dbo, 'verbose', False))
+
+    def __len__(self):
+        return len(self._connections)
+
+    def get_connection(self, dboClass):
+        """
+        @param [in] dboClass is a CatalogDBObject class (or instantiation)
+
+        @param [out] the connection of the pool that suits dboClass, or None
+        if the pool does not hold one
+        """
+        key = self._key(dboClass)
+        with self._lock:
+            connection = self._connections.pop(key, None)
+            if connection is not None:
+                # move the connection to the most recently used end
+                self._connections[key] = connection
+            return connection
+
+    def add_connection(self, connection):
+        """
+        Add an open connection to the pool, closing the least recently used
+        connections if the pool is full.  If the pool already holds a
+        connection with the same parameters, it is replaced.
+
+        @param [in] connection is the connection (e.g. CatalogDBObject.connection)
+        """
+        key = self._key(connection)
+        with self._lock:
+            self._connections.pop(key, None)
+            self._connections[key] = connection
+            while self.max_connections is not None and \
+                  len(self._connections) > self.max_connections:
+
+                old_key, old_connection = self._connections.popitem(last=False)
+                self._close_connection(old_connection)
+
+    def get_db_object(self, dboClass):
+        """
+        Instantiate a CatalogDBObject class, reusing a connection of the pool
+        if possible (and adding the new connection to the pool otherwise).
+
+        @param [in] dboClass is a CatalogDBObject class
+
+        @param [out] an instantiation of dboClass
+        """
+        connection = self.get_connection(dboClass)
+        if connection is not None:
+            return dboClass(connection=connection)
+
+        dbo = dboClass()
+        self.add_connection(dbo.connection)
+        return dbo
+
+    def close(self):
+        """
+        Close all of the connections of the pool and empty it
+        """
+        with self._lock:
+            while len(self._connections) > 0:
+                key, connection = self._connections.popitem(last=False)
+                self._close_connection(connection)
+
+    def _close_connection(self, connection):
+        """
+        Release the resources of a connection (its session and the pooled
+        connections of its engine)
+        """
+        if hasattr(connection, 'session'):
+            connection.session.close()
+        if hasattr(connection, 'engine'):
+            connection.engine.dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return False
@@ -4,6 +4,15 @@ import numpy
 import inspect
 import re
 import copy
+import sys
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque, namedtuple, OrderedDict
+from .decorators import ColumnCache
+from .writers import _RecordBuilder, _NpyCatalogWriter, _FitsCatalogWriter
+from .footprint import _footprint_mask, _union_footprint
+from .pipeline import _init_chunk_worker, _compute_chunk_cols, _prefetch, _BackgroundWriter
 from lsst.sims.utils import defaultSpecMap
 from lsst.sims.utils import ObservationMetaData
 
@@ -33,12 +42,111 @@ def is_null(argument):
 
     return False
 
+
+_vectorized_is_null = numpy.frompyfunc(is_null, 1, 1)
+
+def _null_mask(column):
+    """
+    Return a boolean numpy array that is True wherever is_null() would
+    return True for the corresponding element of the numpy array 'column'.
+
+    Float columns are tested with numpy.isnan; string columns are compared
+    (stripped and lower-cased) against 'null', 'nan' and 'none'.  Integer
+    and boolean columns can never be null.  Object columns can hold any
+    mixture of the above, so is_null is applied to each of their elements.
+    """
+    kind = column.dtype.kind
+    if kind in ('f', 'c'):
+        return numpy.isnan(column)
+    elif kind in ('S', 'U'):
+        words = numpy.char.lower(numpy.char.strip(column))
+        return (words == 'null') | (words == 'nan') | (words == 'none')
+    elif kind in ('i', 'u', 'b'):
+        return numpy.zeros(len(column), dtype=bool)
+
+    return _vectorized_is_null(column).astype(bool)
+
+
+def _make_default_getter(value, dtype):
+    """
+    Return the default_* method installed by InstanceCatalogMeta for a
+    column in default_columns.  The method fills a new array of the length
+    of the current chunk with value.  (value, dtype) is also stored as the
+    _default_value attribute of the method so that the catalog writer can
+    use a read-only constant column instead (see _constant_column).
+
+    The value is converted to dtype first, so that an unsized string dtype
+    (e.g. str) takes the length of value, as in _constant_column.
+    """
+    element = numpy.array(value, dtype=dtype)
+    def getter(self):
+        return numpy.full(len(self._current_chunk), element, dtype=element.dtype)
+    getter._default_value = (value, dtype)
+    return getter
+
+
+def _constant_column(value, dtype, length):
+    """
+    Return a read-only array of the given length all of whose elements
+    are value.  No memory is allocated for the elements: the array is a
+    zero-stride view of a single element.
+    """
+    element = numpy.array(value, dtype=dtype)
+    column = numpy.lib.stride_tricks.as_strided(element, shape=(length,), strides=(0,))
+    column.flags['WRITEABLE'] = False
+    return column
+
+
+def _is_constant(column):
+    """
+    Return True if every element of the numpy array column is equal
+    to the first one.  Only numeric and string columns are compared;
+    other columns are reported as constant only if they are zero-stride
+    views (see _constant_column).
+    """
+    if len(column) < 2:
+        return False
+    if column.strides[0] == 0:
+        return True
+    if column.dtype.kind not in 'biufSU':
+        return False
+    if not (column[1:] == column[0]).all():
+        return False
+    if column.dtype.kind == 'f':
+        # 0.0 == -0.0, but they are not formatted the same way
+        return bool((numpy.signbit(column) == numpy.signbit(column[0])).all())
+    return True
+
+
+# The column index built by InstanceCatalogMeta for every catalog class:
+#
+#  defining_classes maps the name of every get_* and default_* method
+#   to the first class of the MRO which defines it
+#  getters is the frozenset of the columns which have a get_* method
+#  defaults is the frozenset of the columns which have a default_* method
+#  compound_columns maps every compound column to the tuple of the
+#   individual columns it represents
+#  compound_members maps every individual column of a compound column
+#   to the name of its compound getter
+#  column_names is the tuple of the columns with a get_* or default_*
+#   method, in the order of dir(cls)
+_ColumnIndex = namedtuple('_ColumnIndex', ['defining_classes', 'getters', 'defaults',
+                                           'compound_columns', 'compound_members',
+                                           'column_names'])
+
+
 class InstanceCatalogMeta(type):
     """Meta class for registering instance catalogs.
 
     When any new type of instance catalog class is created, this registers it
     in a `registry` class attribute, available to all derived instance
     catalogs.
+
+    It also indexes the columns of the new class (see _ColumnIndex) so that
+    the getters, compound columns and defaults do not have to be looked up
+    with dir(), hasattr() and getattr() every time a catalog is instantiated.
+    The index is rebuilt if a get_* or default_* method is later set on (or
+    deleted from) the class or one of its ancestors.
     """
     @staticmethod
     def convert_to_underscores(name):
@@ -46,6 +154,11 @@ class InstanceCatalogMeta(type):
         s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
         return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
+    @staticmethod
+    def _is_column_method(name):
+        """Return True if name is the name of a get_* or default_* method"""
+        return name.startswith('get_') or name.startswith('default_')
+
     def __new__(cls, name, bases, dct):
         # check if attribute catalog_type is specified.
         # If not, create a default
@@ -57,8 +170,11 @@ class InstanceCatalogMeta(type):
             dct['catalog_type'] = cls.convert_to_underscores(name)
 
         dct['_cached_columns'] = {}
-        dct['_compound_columns'] = {}
-        dct['_compound_column_names'] = {}
+
+        # every class keeps its own results of the column analysis of
+        # InstanceCatalog.__init__, keyed by _column_analysis_key(), from
+        # the least to the most recently used
+        dct['_column_analysis_cache'] = OrderedDict()
 
         return super(InstanceCatalogMeta, cls).__new__(cls, name, bases, dct)
 
@@ -77,19 +193,37 @@ class InstanceCatalogMeta(type):
         # add methods for default columns
         for default in cls.default_columns:
             setattr(cls, 'default_%s'%(default[0]),
-                lambda self, value=default[1], type=default[2]:\
-                        numpy.array([value for i in
-                                 xrange(len(self._current_chunk))],
-                                 dtype=type))
-
-        # store compound columns and check for collisions
-        #
-        #  We create a forward and backward mapping.
-        #  The dictionary cls._compound_columns maps the compound column
-        #   name to the multiple individual columns it represents.
-        #  The dictionary cls._compound_column_names maps the individual
-        #   column names to the compound column that contains them
-        for key in dir(cls):
+                    _make_default_getter(default[1], default[2]))
+
+        cls._index_columns()
+
+        return super(InstanceCatalogMeta, cls).__init__(name, bases, dct)
+
+    def _index_columns(cls):
+        """
+        Build cls._column_index, checking the compound columns for collisions.
+
+        We also keep the forward and backward mapping of the compound columns
+        in the form in which they have always been available.
+        The dictionary cls._compound_columns maps the compound getter
+         name to the multiple individual columns it represents.
+        The dictionary cls._compound_column_names maps the individual
+         column names to the compound getter that contains them
+        """
+        defining_classes = {}
+        for klass in reversed(cls.__mro__):
+            for key in klass.__dict__:
+                if cls._is_column_method(key):
+                    defining_classes[key] = klass
+
+        method_names = sorted(defining_classes)
+
+        getters = frozenset(key[4:] for key in method_names if key.startswith('get_'))
+        defaults = frozenset(key[8:] for key in method_names if key.startswith('default_'))
+
+        compound_columns = {}
+        compound_column_names = {}
+        for key in method_names:
             if not key.startswith('get_'):
                 continue
             compound_getter = getattr(cls, key)
@@ -103,38 +237,107 @@ class InstanceCatalogMeta(type):
                     raise ValueError("column names in compound "
                                      "decorator must be strings")
 
-                if hasattr(cls, getter):
+                if getter in defining_classes:
                     raise ValueError("column name '%s' in compound getter "
                                      "'%s' conflicts with getter '%s'"
                                      % (col, key, getter))
 
-                elif col in cls._compound_column_names:
+                elif col in compound_column_names:
                     raise ValueError("duplicate compound column name: '%s'"
                                      % col)
 
                 else:
-                    cls._compound_column_names[col] = key
-            cls._compound_columns[key] = compound_getter._colnames
+                    compound_column_names[col] = key
+            compound_columns[key] = compound_getter._colnames
 
-        return super(InstanceCatalogMeta, cls).__init__(name, bases, dct)
+        column_names = []
+        for key in method_names:
+            if key.startswith('get_'):
+                columnName = key[4:]
+            else:
+                columnName = key[8:]
+            if columnName not in column_names:
+                column_names.append(columnName)
+
+        cls._compound_columns = compound_columns
+        cls._compound_column_names = compound_column_names
+        cls._column_index = _ColumnIndex(defining_classes=defining_classes,
+                                         getters=getters,
+                                         defaults=defaults,
+                                         compound_columns=dict((key[4:], tuple(colnames))
+                                                               for key, colnames
+                                                               in compound_columns.items()),
+                                         compound_members=compound_column_names,
+                                         column_names=tuple(column_names))
+
+    def _with_subclasses(cls):
+        """Return a list of cls and of all of its subclasses"""
+        family = []
+        pending = [cls]
+        while len(pending) > 0:
+            klass = pending.pop()
+            if klass not in family:
+                family.append(klass)
+                pending.extend(klass.__subclasses__())
+        return family
+
+    def _reindex_columns(cls):
+        """
+        Rebuild the column index of cls and of all of its subclasses and
+        forget their cached column analyses (see InstanceCatalog._column_analysis_key)
+        """
+        if '_column_index' not in cls.__dict__:
+            # cls is still being created; __init__ will index it
+            return
+
+        for klass in cls._with_subclasses():
+            klass._index_columns()
+            with klass._column_analysis_lock:
+                klass._column_analysis_cache.clear()
+
+    def __setattr__(cls, name, value):
+        super(InstanceCatalogMeta, cls).__setattr__(name, value)
+        if cls._is_column_method(name):
+            cls._reindex_columns()
+
+    def __delattr__(cls, name):
+        super(InstanceCatalogMeta, cls).__delattr__(name)
+        if cls._is_column_method(name):
+            cls._reindex_columns()
 
 
 class _MimicRecordArray(object):
     """An object used for introspection of the database colums.
 
-    This mimics a numpy record array, but when a column is referenced,
-    it logs the reference and returns zeros.
+    This mimics a numpy record array, but when a column is referenced
+    (as chunk['ra'] or chunk.ra), it logs the reference and returns an
+    empty array.  Selecting rows (with anything but a column name) returns
+    the _MimicRecordArray itself, i.e. no rows.
     """
     def __init__(self):
         self.referenced_columns = set()
 
-    def __getitem__(self, column):
-        self.referenced_columns.add(column)
+    def __getitem__(self, item):
+        if not isinstance(item, basestring):
+            return self
+        self.referenced_columns.add(item)
         return numpy.empty(0)
 
+    def __getattr__(self, name):
+        # only called for the names which are not attributes of the object
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def field(self, column):
+        return self[column]
+
     def __len__(self):
         return 0
 
+    size = 0
+    shape = (0,)
+
 
 class InstanceCatalog(object):
     """ Base class for instance catalogs generated by simulations.
@@ -163,6 +366,23 @@ class InstanceCatalog(object):
     delimiter = ", "
     comment_char = "#"
     endline = "\n"
+    memoize_columns = True # compute each column once per chunk, in dependency order (see _make_column_plan and _get_chunk_cols)
+    column_cache_max_bytes = None # limit on the memory used by @cached columns (None means no limit)
+    cache_column_analysis = True # reuse the column analysis of __init__ between instances (see _column_analysis_key)
+    column_analysis_cache_size = 16 # the number of column analyses kept for each class
+    _column_analysis_lock = threading.Lock() # guards the _column_analysis_cache of every class
+    column_dtypes = {} # dtypes of the columns in the binary output formats, e.g. {'name': (str, 20)} (default: the dtype of the first chunk)
+    shared_columns = [] # columns which do not depend on the pointing (computed once for all pointings by write_pointing_catalogs with shared_query=True)
+
+    # the attributes set by the column analysis of __init__
+    _column_analysis_attributes = ('_all_available_columns', '_column_outputs',
+                                   '_actually_calculated_columns', '_column_origins',
+                                   '_column_dependencies', '_metadata_columns',
+                                   '_active_columns', '_column_dispatch', '_column_plan',
+                                   '_constant_defaults')
+
+    # binary formats accepted by write_catalog's output_format argument
+    _binary_writers = {'npy': _NpyCatalogWriter, 'fits': _FitsCatalogWriter}
 
     @classmethod
     def new_catalog(cls, catalog_type, *args, **kwargs):
@@ -175,22 +395,30 @@ class InstanceCatalog(object):
             raise ValueError("Unrecognized catalog_type: %s"
                              % str(catalog_type))
 
+    @classmethod
+    def clear_column_analysis_cache(cls):
+        """
+        Forget the column analyses which the catalogs of this class and of its
+        subclasses have cached (see cache_column_analysis), so that the next
+        catalog of each class analyzes its columns afresh
+        """
+        for klass in cls._with_subclasses():
+            with klass._column_analysis_lock:
+                klass._column_analysis_cache.clear()
+
     @classmethod
     def is_compound_column(cls, column_name):
         """Return true if the given column name is a compound column"""
-        getfunc = "get_%s" % column_name
-        if hasattr(cls, getfunc):
-            if hasattr(getattr(cls, getfunc), '_compound_column'):
-                return True
-        return False
+        return column_name in cls._column_index.compound_columns
 
 
     def iter_column_names(self):
         """Iterate the column names, expanding any compound columns"""
 
+        compound_columns = self._column_index.compound_columns
         for column in self._column_outputs:
-            if self.is_compound_column(column):
-                for col in getattr(getattr(self, "get_" + column), '_colnames'):
+            if column in compound_columns:
+                for col in compound_columns[column]:
                     yield col
             else:
                 yield column
@@ -242,6 +470,16 @@ class InstanceCatalog(object):
         else:
             self.obs_metadata = ObservationMetaData()
 
+        # catalogs constructed with the same ObservationMetaData share
+        # their @metadata_only columns; @chunk_invariant columns are
+        # stored in self._invariant_columns
+        if obs_metadata is not None:
+            self._metadata_key = obs_metadata
+        else:
+            self._metadata_key = self.obs_metadata
+        self._metadata_signature = None
+        self._invariant_columns = {}
+
         if self.column_outputs is not None:
             self._column_outputs = copy.deepcopy(self.column_outputs)
 
@@ -261,12 +499,43 @@ class InstanceCatalog(object):
 
         self.refIdCol = self.db_obj.getIdColKey()
 
-        self._column_cache = {}
+        self._column_cache = ColumnCache(max_bytes=self.column_cache_max_bytes)
+
+        # self._column_dispatch is filled by self._check_requirements() (see
+        # self._make_column_dispatch())
+        self._column_dispatch = {}
+
+        # self._column_dependencies maps each column to the columns it asks
+        # for; it is filled by self.db_required_columns() and used by
+        # self._make_column_plan() to fill self._column_plan
+        self._column_dependencies = {}
+        self._column_stack = []
+        self._metadata_columns = set()
+        self._column_plan = None
+        self._column_values = {}
+        self._constant_defaults = {}
 
         # self._column_origins_switch tells column_by_name to log where it is getting
         # the columns in self._column_origins (we only want to do that once)
         self._column_origins_switch = True
 
+        # the rest of the analysis only depends on the class, the columns of
+        # db_obj and the requested outputs, so it is done once and for all
+        # (catalogs may be created by several threads at once, e.g. by
+        # CompoundInstanceCatalog, so the cache is only used under
+        # _column_analysis_lock)
+        analysis_key = self._column_analysis_key()
+        analysis = None
+        if analysis_key is not None:
+            with self._column_analysis_lock:
+                analysis = self._column_analysis_cache.pop(analysis_key, None)
+                if analysis is not None:
+                    # move the analysis to the most recently used end
+                    self._column_analysis_cache[analysis_key] = analysis
+        if analysis is not None:
+            self._restore_column_analysis(analysis)
+            return
+
         # now we will create and populate a list containing the names of
         # all of the columns which this InstanceCatalog can return.
         # Note: this needs to happen before self._check_requirements()
@@ -288,15 +557,9 @@ class InstanceCatalog(object):
             if name not in self._all_available_columns:
                 self._all_available_columns.append(name)
 
-        for name in dir(self):
-            if name[:4] == 'get_':
-                columnName = name[4:]
-                if columnName not in self._all_available_columns:
-                    self._all_available_columns.append(columnName)
-            elif name[:8] == 'default_':
-                columnName = name[8:]
-                if columnName not in self._all_available_columns:
-                    self._all_available_columns.append(columnName)
+        for name in self._column_index.column_names:
+            if name not in self._all_available_columns:
+                self._all_available_columns.append(name)
 
         if not hasattr(self,'_column_outputs'):
             self._column_outputs = []
@@ -310,20 +573,93 @@ class InstanceCatalog(object):
 
         self._check_requirements()
 
+        if analysis_key is not None:
+            analysis = dict((name, copy.copy(getattr(self, name)))
+                            for name in self._column_analysis_attributes)
+            with self._column_analysis_lock:
+                self._column_analysis_cache.pop(analysis_key, None)
+                self._column_analysis_cache[analysis_key] = analysis
+                while len(self._column_analysis_cache) > max(self.column_analysis_cache_size, 0):
+                    self._column_analysis_cache.popitem(last=False)
+
+    def _column_analysis_key(self):
+        """
+        Return the key under which the column analysis of __init__ is stored in
+        the _column_analysis_cache of the class, or None if cache_column_analysis
+        is False.
+
+        The analysis is reused by all the instances of a class which have the same
+        requested column_outputs and whose db_obj have the same columns (and id
+        column).  A class whose getters ask for different columns depending on
+        obs_metadata (or on anything else that varies between instances) should
+        set cache_column_analysis = False.  Each class keeps the analyses of its
+        column_analysis_cache_size most recently created combinations of columns;
+        clear_column_analysis_cache() forgets them.
+        """
+        if not self.cache_column_analysis:
+            return None
+
+        if hasattr(self, '_column_outputs'):
+            column_outputs = tuple(self._column_outputs)
+        else:
+            column_outputs = None
+
+        return (tuple(self.db_obj.columnMap.keys()), self.refIdCol, column_outputs)
+
+    def _restore_column_analysis(self, analysis):
+        """
+        Set the attributes computed by the column analysis of __init__ from a
+        dict stored in _column_analysis_cache
+        """
+        for name in self._column_analysis_attributes:
+            setattr(self, name, copy.copy(analysis[name]))
+        self._column_origins_switch = False
+
+        if self.verbose:
+            self.print_column_origins()
+
 
     def _set_current_chunk(self, chunk, column_cache=None):
         """Set the current chunk and clear the column cache"""
         self._current_chunk = chunk
+        self._column_values = {}
+        self._metadata_signature = None
         if column_cache is None:
-            self._column_cache = {}
+            self._column_cache.clear()
         else:
             self._column_cache = column_cache
 
+    def column_cache_info(self):
+        """
+        Return a dict describing the use of the cache of @cached and
+        @compound columns since the catalog was created: the number of
+        'hits', 'misses' and 'evictions', the number of bytes currently
+        held ('nbytes') and the limit on that number ('max_bytes')
+        """
+        return {'hits': self._column_cache.hits,
+                'misses': self._column_cache.misses,
+                'evictions': self._column_cache.evictions,
+                'nbytes': self._column_cache.nbytes,
+                'max_bytes': self._column_cache.max_bytes}
+
     def db_required_columns(self):
         """Get the list of columns required to be in the database object."""
-        saved_cache = self._cached_columns
+        saved_cache = self._column_cache
         saved_chunk = self._current_chunk
-        self._set_current_chunk(_MimicRecordArray())
+        saved_dispatch = self._column_dispatch
+
+        # use a separate cache so that the introspection does not count
+        # towards column_cache_info()
+        self._set_current_chunk(_MimicRecordArray(), ColumnCache())
+
+        # every column has to go through the introspection path of column_by_name
+        self._column_dispatch = {}
+
+        # column_by_name records which columns each column asks for
+        # (and the obs_metadata property which columns read obs_metadata)
+        self._column_dependencies = {}
+        self._column_stack = []
+        self._metadata_columns = set()
 
         for col_name in self.iter_column_names():
             # just call the column: this will log queries to the database.
@@ -336,18 +672,79 @@ class InstanceCatalog(object):
         required_columns_with_defaults = default_columns_set&required_columns_set
 
         self._set_current_chunk(saved_chunk, saved_cache)
+        self._column_dispatch = saved_dispatch
 
         return db_required_columns, list(required_columns_with_defaults)
 
+    @property
+    def obs_metadata(self):
+        """
+        The ObservationMetaData characterizing the telescope pointing.
+        While db_required_columns introspects the getters, the columns
+        which read it are recorded in self._metadata_columns.
+        """
+        column_stack = getattr(self, '_column_stack', None)
+        if column_stack:
+            self._metadata_columns.update(column_stack)
+        return self._obs_metadata
+
+    @obs_metadata.setter
+    def obs_metadata(self, value):
+        self._obs_metadata = value
+
     def column_by_name(self, column_name, *args, **kwargs):
         """Given a column name, return the column data"""
 
-        if isinstance(self._current_chunk, _MimicRecordArray) and column_name not in self._actually_calculated_columns:
+        # columns already computed for this chunk (see _get_chunk_cols); the
+        # caller gets a copy, which it is free to modify in place
+        if column_name in self._column_values and len(args) == 0 and len(kwargs) == 0:
+            value = self._column_values[column_name]
+            if isinstance(value, numpy.ndarray):
+                return value.copy()
+            return value
+
+        # columns resolved by _make_column_dispatch skip the introspection below
+        dispatch = self._column_dispatch.get(column_name)
+        if dispatch is not None:
+            source, function = dispatch
+            if source == 'getter':
+                return function(self, *args, **kwargs)
+            elif source == 'compound':
+                return function(self, *args, **kwargs)[column_name]
+            elif source == 'database':
+                return self._current_chunk[column_name]
+            else:
+                return function(self, *args, **kwargs)
+
+        if isinstance(self._current_chunk, _MimicRecordArray):
+            return self._introspect_column(column_name, *args, **kwargs)
+
+        return self._find_column(column_name, *args, **kwargs)
+
+    def _introspect_column(self, column_name, *args, **kwargs):
+        """
+        Return a column of the _MimicRecordArray chunk, logging that it was
+        needed and which column (if any) asked for it.
+        """
+        if column_name not in self._actually_calculated_columns:
             self._actually_calculated_columns.append(column_name)
 
-        getfunc = "get_%s" % column_name
-        if hasattr(self, getfunc):
-            function = getattr(self,getfunc)
+        if len(self._column_stack) > 0:
+            dependencies = self._column_dependencies.setdefault(self._column_stack[-1], [])
+            if column_name not in dependencies:
+                dependencies.append(column_name)
+
+        self._column_stack.append(column_name)
+        try:
+            return self._find_column(column_name, *args, **kwargs)
+        finally:
+            self._column_stack.pop()
+
+    def _find_column(self, column_name, *args, **kwargs):
+        """Find where a column comes from and return the column data"""
+
+        if column_name in self._column_index.getters:
+            function = getattr(self, "get_%s" % column_name)
 
             if self._column_origins_switch:
                 self._column_origins[column_name] = self._get_class_that_defined_method(function)
@@ -406,10 +803,120 @@ class InstanceCatalog(object):
                 raise ValueError("Required columns missing from database: "
                                  "({0})".format(', '.join(nodefault)))
 
+        self._column_dispatch = self._make_column_dispatch(missing_cols)
+        self._column_plan = self._make_column_plan()
+        self._constant_defaults = self._find_constant_defaults()
+
         if self.verbose:
             self.print_column_origins()
 
-    def _make_line_template(self, chunk_cols):
+    def _make_column_dispatch(self, missing_cols):
+        """
+        Resolve, once and for all, where column_by_name should get each column.
+
+        @param [in] missing_cols is a list of the required columns that are not
+        in the database (and will therefore be provided by their default)
+
+        @param [out] a dict mapping column names to tuples (source, function);
+        source is 'getter', 'compound', 'database' or 'default' and function
+        is the (unbound) getter to call, if any.  The order of precedence is
+        the same as in column_by_name.  Columns which are not in the dict are
+        resolved by column_by_name every time they are requested.
+        """
+        dispatch = {}
+        cls = self.__class__
+
+        index = cls._column_index
+
+        for column_name in self._all_available_columns:
+            if column_name in index.getters:
+                dispatch[column_name] = ('getter', getattr(cls, "get_%s" % column_name).im_func)
+            elif column_name in self._compound_column_names:
+                getfunc = self._compound_column_names[column_name]
+                dispatch[column_name] = ('compound', getattr(cls, getfunc).im_func)
+
+        for column_name in self._active_columns:
+            if column_name not in dispatch:
+                dispatch[column_name] = ('database', None)
+
+        for column_name in missing_cols:
+            if column_name not in dispatch and column_name in index.defaults:
+                dispatch[column_name] = ('default', getattr(cls, "default_%s" % column_name).im_func)
+
+        return dispatch
+
+    def _make_column_plan(self):
+        """
+        Use the column dependencies recorded by db_required_columns to
+        plan the evaluation of a chunk.
+
+        @param [out] a list of tuples (column_name, released) in which
+        every column comes after all of the columns it asks for.  released
+        is the list of columns that are no longer needed once column_name
+        has been computed.  Returns None if self.memoize_columns is False.
+        """
+        if not self.memoize_columns:
+            return None
+
+        order = []
+        visited = set()
+
+        def visit(column_name):
+            if column_name in visited:
+                return
+            visited.add(column_name)
+            for dependency in self._column_dependencies.get(column_name, []):
+                visit(dependency)
+            order.append(column_name)
+
+        for column_name in self.iter_column_names():
+            visit(column_name)
+
+        # the position in order after which each column can be released
+        last_use = dict((column_name, ix) for ix, column_name in enumerate(order))
+        for ix, column_name in enumerate(order):
+            for dependency in self._column_dependencies.get(column_name, []):
+                last_use[dependency] = max(last_use[dependency], ix)
+
+        released = [[] for column_name in order]
+        for column_name in order:
+            released[last_use[column_name]].append(column_name)
+
+        return zip(order, released)
+
+    def _find_constant_defaults(self):
+        """
+        Find the output columns which _get_chunk_cols can replace by
+        read-only constant views.
+
+        @param [out] a dict mapping column names to the (value, dtype) of
+        their entry in default_columns.  Only the output columns which are
+        filled by their default, which are not transformed and which no
+        other column asks for are included.
+        """
+        requested = set()
+        for dependencies in self._column_dependencies.values():
+            requested.update(dependencies)
+
+        constant_defaults = {}
+        for column_name in self.iter_column_names():
+            source, func = self._column_dispatch.get(column_name, (None, None))
+            if source != 'default' or not hasattr(func, '_default_value'):
+                continue
+            if column_name in self.transformations or column_name in requested:
+                continue
+            constant_defaults[column_name] = func._default_value
+
+        return constant_defaults
+
+    def _make_column_templates(self, chunk_cols):
+        """
+        Return a list of the format strings that will be used to write
+        each of the columns in iter_column_names()
+
+        @param [in] chunk_cols is a list of numpy arrays (one per column)
+        whose dtypes are used to select from self.default_formats
+        """
         templ_list = []
         for i, col in enumerate(self.iter_column_names()):
             templ = self.override_formats.get(col, None)
@@ -425,7 +932,52 @@ class InstanceCatalog(object):
                 templ = "%s"
             templ_list.append(templ)
 
-        return self.delimiter.join(templ_list) + self.endline
+        return templ_list
+
+    def _make_line_template(self, chunk_cols):
+        return self.delimiter.join(self._make_column_templates(chunk_cols)) + self.endline
+
+    def _format_chunk(self, chunk_cols):
+        """
+        Format a chunk of the catalog as a single string.
+
+        Each column is formatted as a whole with numpy.char.mod using
+        the templates in self._column_templates; the formatted columns
+        are then joined with self.delimiter and self.endline.  The result
+        is identical to applying self._template to each row.
+
+        @param [in] chunk_cols is a list of numpy arrays (one per column)
+
+        @param [out] a string containing the formatted lines
+        """
+        if len(chunk_cols) == 0 or len(chunk_cols[0]) == 0:
+            return ''
+
+        # Constant columns are formatted once and merged with the
+        # delimiters around them, so that only the other columns are
+        # formatted row-by-row.
+        lines = None
+        constant_text = ''
+        for ix, (templ, col) in enumerate(zip(self._column_templates, chunk_cols)):
+            if ix > 0:
+                constant_text += self.delimiter
+            if _is_constant(col):
+                constant_text += numpy.char.mod(templ, col[:1])[0]
+                continue
+
+            formatted = numpy.char.mod(templ, col)
+            if lines is None:
+                lines = formatted if constant_text == '' else numpy.char.add(constant_text, formatted)
+            else:
+                lines = numpy.char.add(numpy.char.add(lines, constant_text), formatted)
+            constant_text = ''
+
+        constant_text += self.endline
+        if lines is None:
+            return constant_text*len(chunk_cols[0])
+
+        lines = numpy.char.add(lines, constant_text)
+        return ''.join(lines.tolist())
 
     def write_header(self, file_handle):
         column_names = list(self.iter_column_names())
@@ -437,12 +989,13 @@ class InstanceCatalog(object):
 
 
     def write_catalog(self, filename, chunk_size=None,
-                      write_header=True, write_mode='w'):
+                      write_header=True, write_mode='w', output_format='ascii',
+                      n_processes=None, prefetch_depth=None, write_depth=None):
         """
         Write query self.db_obj and write the resulting InstanceCatalog to
-        an ASCII output file
+        an output file
 
-        @param [in] filename is the name of the ASCII file to be written
+        @param [in] filename is the name of the file to be written
 
         @param [in] chunk_size is an optional parameter telling the CompoundInstanceCatalog
         to query the database in manageable chunks (in case returning the whole catalog
@@ -453,6 +1006,27 @@ class InstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] output_format is 'ascii' (the default) to write a text catalog,
+        'npy' to write a numpy .npy file containing a structured array or 'fits'
+        to write a FITS binary table.  In the binary formats the fields are named
+        after iter_column_names(); write_header is ignored and write_mode must be 'w'.
+        The dtype of every field is that of the first chunk, unless it is given in
+        column_dtypes; if a later chunk has longer strings than its field can hold,
+        a ValueError is raised and the file is deleted.
+
+        @param [in] n_processes is an optional number of worker processes.  If it
+        is greater than 1, the columns of several chunks are computed concurrently
+        by a pool of processes; the chunks are still written in the order in which
+        they were returned by the database (default None, i.e. no pool)
+
+        @param [in] prefetch_depth is an optional number of chunks.  If it is given,
+        a background thread runs the database query and reads up to this many
+        chunks ahead of the column computation (default None, i.e. no prefetching)
+
+        @param [in] write_depth is an optional number of chunks.  If it is given,
+        formatted chunks are written to the file by a background thread, with up to
+        this many chunks waiting to be written (default None, i.e. no writer thread)
         """
 
         self._write_pre_process()
@@ -461,11 +1035,284 @@ class InstanceCatalog(object):
                               write_header=write_header,
                               write_mode=write_mode,
                               obs_metadata=self.obs_metadata,
-                              constraint=self.constraint)
+                              constraint=self.constraint,
+                              output_format=output_format,
+                              n_processes=n_processes,
+                              prefetch_depth=prefetch_depth,
+                              write_depth=write_depth)
+
+
+    @classmethod
+    def write_pointing_catalogs(cls, db_obj, obs_metadata_list, filenames,
+                                column_outputs=None, constraint=None, specFileMap=None,
+                                chunk_size=None, write_header=True, write_mode='w',
+                                output_format='ascii', n_workers=None, shared_query=False,
+                                ra_column=None, dec_column=None):
+        """
+        Write one catalog of this class per telescope pointing.
+
+        The catalog is instantiated (and its column requirements are worked out)
+        only once, with the first pointing; every pointing then gets a copy of
+        that catalog which shares its column analysis but none of its per-chunk
+        state.  The getters must therefore require the same columns whatever the
+        pointing.
+
+        @param [in] db_obj is the CatalogDBObject queried for every pointing
+
+        @param [in] obs_metadata_list is a sequence of ObservationMetaData, one
+        per pointing
+
+        @param [in] filenames is either a list of file names (one per pointing)
+        or a string which is formatted with the index of the pointing in
+        obs_metadata_list (e.g. 'catalog_%d.txt')
+
+        @param [in] column_outputs, constraint and specFileMap are passed to the
+        constructor of the catalog
+
+        @param [in] chunk_size, write_header, write_mode and output_format are
+        as in write_catalog
+
+        @param [in] n_workers is an optional number of threads.  If it is greater
+        than 1, that many pointings are written at the same time (default None,
+        i.e. the pointings are written one after the other)
+
+        @param [in] shared_query is a boolean.  If True, the database is queried
+        only once, for a circle containing the fields of view of all of the
+        pointings, and the rows are shared out between the pointings according
+        to their fields of view.  This is meant for overlapping (e.g. dithered)
+        pointings.  The columns listed in the class attribute shared_columns are
+        computed once for all of the pointings, by a catalog whose obs_metadata
+        is None; they must therefore not depend on the pointing in any way, and
+        they must be computed row-by-row.  All the other columns are computed
+        for each pointing.  n_workers is ignored.  (default False)
+
+        @param [in] ra_column and dec_column are the names of the columns (in
+        degrees) against which the fields of view are tested if shared_query is
+        True (default: db_obj.raColName and db_obj.decColName, i.e. the columns
+        against which the database tests the field of view of a query)
+        """
+
+        obs_metadata_list = list(obs_metadata_list)
+        if isinstance(filenames, basestring):
+            filenames = [filenames % ix for ix in range(len(obs_metadata_list))]
+
+        if len(filenames) != len(obs_metadata_list):
+            raise ValueError("You passed %d file names for %d pointings"
+                             % (len(filenames), len(obs_metadata_list)))
+
+        if len(obs_metadata_list) == 0:
+            return
+
+        template = cls(db_obj, obs_metadata=obs_metadata_list[0],
+                       column_outputs=column_outputs, constraint=constraint,
+                       specFileMap=specFileMap)
+        template._write_pre_process()
+
+        if shared_query:
+            template._write_shared_query(obs_metadata_list, filenames, chunk_size=chunk_size,
+                                         write_header=write_header, write_mode=write_mode,
+                                         output_format=output_format,
+                                         ra_column=ra_column, dec_column=dec_column)
+            return
+
+        def write(ix):
+            cat = template._copy_for_pointing(obs_metadata_list[ix])
+            cat._query_and_write(filenames[ix], chunk_size=chunk_size,
+                                 write_header=write_header, write_mode=write_mode,
+                                 obs_metadata=cat.obs_metadata,
+                                 constraint=cat.constraint,
+                                 output_format=output_format)
+
+        if n_workers is None or n_workers <= 1:
+            for ix in range(len(obs_metadata_list)):
+                write(ix)
+            return
+
+        pool = ThreadPool(n_workers)
+        try:
+            results = [pool.apply_async(write, (ix,)) for ix in range(len(obs_metadata_list))]
+            pool.close()
+            for result in results:
+                result.get()
+        finally:
+            pool.terminate()
+
+    def _write_shared_query(self, obs_metadata_list, filenames, chunk_size=None,
+                            write_header=True, write_mode='w', output_format='ascii',
+                            ra_column=None, dec_column=None):
+        """
+        Write one catalog per pointing from a single query of the database
+        (see write_pointing_catalogs with shared_query=True)
+        """
+        self._check_output_format(output_format, write_mode)
+
+        if ra_column is None:
+            ra_column = getattr(self.db_obj, 'raColName', None)
+        if dec_column is None:
+            dec_column = getattr(self.db_obj, 'decColName', None)
+
+        for name in (ra_column, dec_column):
+            if name not in self.db_obj.columnMap:
+                raise ValueError("Cannot share the query between pointings: "
+                                 "column '%s' is not in the database" % str(name))
+
+        colnames = list(self._active_columns)
+        for name in (ra_column, dec_column):
+            if name not in colnames:
+                colnames.append(name)
+
+        union = _union_footprint(obs_metadata_list)
+
+        # the shared columns are computed by a catalog without any pointing,
+        # so that a getter which does read the pointing fails
+        columns = self._find_shared_columns()
+        shared = self._copy_for_pointing(ObservationMetaData())
+        shared.obs_metadata = None
+
+        catalogs = [self._copy_for_pointing(obs) for obs in obs_metadata_list]
+        outputs = []
+        try:
+            for cat, filename in zip(catalogs, filenames):
+                outputs.append(cat._open_output(filename, output_format, write_header, write_mode))
+
+            query_result = self.db_obj.query_columns(colnames=colnames, obs_metadata=union,
+                                                     constraint=self.constraint,
+                                                     chunk_size=chunk_size)
+
+            for chunk in query_result:
+                ra = chunk[ra_column]
+                dec = chunk[dec_column]
+                masks = [_footprint_mask(cat.obs_metadata, ra, dec) for cat in catalogs]
+
+                # drop the rows which are in none of the fields of view
+                covered = numpy.logical_or.reduce(masks)
+                if not covered.all():
+                    chunk = chunk[covered]
+                    masks = [mask[covered] for mask in masks]
+
+                shared_values = shared._compute_columns(chunk, columns)
+
+                for cat, (write, close, abort), mask in zip(catalogs, outputs, masks):
+                    if not mask.any():
+                        continue
+                    column_values = dict((name, value[mask]) for name, value in shared_values.items())
+                    write(cat._get_chunk_cols(chunk[mask], read_only=True,
+                                              column_values=column_values))
+        except:
+            error = sys.exc_info()
+            for write, close, abort in outputs:
+                abort()
+            raise error[0], error[1], error[2]
+
+        for write, close, abort in outputs:
+            close()
+
+    def _open_output(self, filename, output_format, write_header, write_mode):
+        """
+        Open a catalog file for _write_shared_query
+
+        @param [out] a tuple of three functions: the first writes the columns of
+        a chunk (as returned by _get_chunk_cols), the second closes the file and
+        the third closes it after a failure (deleting it if it is a binary file)
+        """
+        if output_format != 'ascii':
+            writer = self._binary_writers[output_format](filename, list(self.iter_column_names()),
+                                                         column_dtypes=self.column_dtypes)
+            return (lambda chunk_cols: writer.write(self._remove_null_rows(chunk_cols)),
+                    writer.close, writer.abort)
 
+        file_handle = open(filename, write_mode)
+        if write_header:
+            self.write_header(file_handle)
+        return (lambda chunk_cols: self._write_chunk_cols(chunk_cols, file_handle),
+                file_handle.close, file_handle.close)
+
+    def _find_shared_columns(self):
+        """
+        Return the columns of self._column_plan which _write_shared_query
+        computes once for all of the pointings: the columns in shared_columns
+        which are computed by getters.
+
+        Raises a ValueError if one of them reads obs_metadata (as recorded by
+        db_required_columns) or asks for a column which is computed by a getter
+        but is not in shared_columns.
+        """
+        if self._column_plan is None or len(self.shared_columns) == 0:
+            return []
+
+        columns = []
+        for column_name, released in self._column_plan:
+            if column_name not in self.shared_columns:
+                continue
+            source, function = self._column_dispatch.get(column_name, (None, None))
+            if source in ('database', 'default'):
+                continue
+
+            if column_name in self._metadata_columns:
+                raise ValueError("Column '%s' is in shared_columns, but it reads obs_metadata"
+                                 % column_name)
+
+            for dependency in self._column_dependencies.get(column_name, []):
+                if dependency not in self.shared_columns and \
+                   self._column_dispatch.get(dependency, (None, None))[0] not in ('database', 'default'):
+
+                    raise ValueError("Column '%s' is in shared_columns, but it asks for "
+                                     "column '%s', which is not" % (column_name, dependency))
+
+            columns.append(column_name)
+
+        return columns
+
+    def _compute_columns(self, chunk, column_names):
+        """
+        Set chunk as the current chunk and compute some of its columns
+
+        @param [in] chunk is the recarray of queried columns
+
+        @param [in] column_names is a list of column names
+
+        @param [out] a dict mapping the names in column_names to their (read-only)
+        values
+        """
+        self._set_current_chunk(chunk)
+        for column_name, released in self._column_plan:
+            if column_name in column_names:
+                value = self.column_by_name(column_name)
+                if isinstance(value, numpy.ndarray):
+                    value.flags.writeable = False
+                self._column_values[column_name] = value
+
+        return dict((column_name, self._column_values[column_name]) for column_name in column_names)
+
+    def _copy_for_pointing(self, obs_metadata):
+        """
+        Return a shallow copy of this catalog describing another pointing.
+        The copy shares the column analysis of this catalog (see
+        _check_requirements and _write_pre_process), but has its own
+        ObservationMetaData, column cache and per-chunk state.
+
+        @param [in] obs_metadata is the ObservationMetaData of the pointing
+        """
+        if not isinstance(obs_metadata, ObservationMetaData):
+            raise ValueError("You passed InstanceCatalog something that was not ObservationMetaData")
+
+        cat = copy.copy(self)
+        cat.obs_metadata = copy.deepcopy(obs_metadata)
+        cat._metadata_key = obs_metadata
+        cat._metadata_signature = None
+        cat._invariant_columns = {}
+        cat._column_cache = ColumnCache(max_bytes=self.column_cache_max_bytes)
+        cat._column_values = {}
+        cat._column_stack = []
+        cat._current_chunk = None
+        cat._template = None
+        cat._column_templates = None
+        return cat
 
     def _query_and_write(self, filename, chunk_size=None, write_header=True,
-                         write_mode='w', obs_metadata=None, constraint=None):
+                         write_mode='w', obs_metadata=None, constraint=None,
+                         output_format='ascii', n_processes=None,
+                         prefetch_depth=None, write_depth=None):
         """
         This method queries db_obj, and then writes the resulting recarray
         to the specified ASCII output file.
@@ -486,33 +1333,162 @@ class InstanceCatalog(object):
 
         @param [in] write_mode is 'w' if you want to overwrite the output file or
         'a' if you want to append to an existing output file (default: 'w')
+
+        @param [in] output_format is 'ascii', 'npy' or 'fits' (see write_catalog)
+
+        @param [in] n_processes is the number of worker processes used to compute
+        the columns (see write_catalog)
+
+        @param [in] prefetch_depth is the number of chunks read ahead of the column
+        computation by a background thread (see write_catalog)
+
+        @param [in] write_depth is the number of formatted chunks that can wait
+        for a background thread to write them (see write_catalog)
         """
 
+        self._check_output_format(output_format, write_mode)
 
-        file_handle = open(filename, write_mode)
-        if write_header:
-            self.write_header(file_handle)
+        def query():
+            return self.db_obj.query_columns(colnames=self._active_columns,
+                                             obs_metadata=obs_metadata,
+                                             constraint=constraint,
+                                             chunk_size=chunk_size)
 
-        query_result = self.db_obj.query_columns(colnames=self._active_columns,
-                                                 obs_metadata=obs_metadata,
-                                                 constraint=constraint,
-                                                 chunk_size=chunk_size)
+        # the query is run by the prefetching thread, so that the
+        # database connection is only ever used from one thread
+        if prefetch_depth:
+            query_result = _prefetch(query, prefetch_depth)
+        else:
+            query_result = query()
+
+        try:
+            if output_format != 'ascii':
+                self._write_binary(query_result, filename, output_format,
+                                   n_processes=n_processes, write_depth=write_depth)
+                return
+
+            file_handle = open(filename, write_mode)
+            if write_header:
+                self.write_header(file_handle)
+
+            output = _BackgroundWriter(file_handle.write, write_depth) if write_depth else file_handle
+            try:
+                for chunk_cols in self._iter_chunk_cols(query_result, n_processes=n_processes):
+                    self._write_chunk_cols(chunk_cols, output)
+            finally:
+                if output is not file_handle:
+                    output.close()
+                file_handle.close()
+        finally:
+            if prefetch_depth:
+                # stop the prefetching thread if we did not use all of the chunks
+                query_result.close()
+
+    def _check_output_format(self, output_format, write_mode):
+        """
+        Raise a ValueError if output_format is not known, or if it is a binary
+        format and write_mode is not 'w'
+        """
+        if output_format != 'ascii':
+            if output_format not in self._binary_writers:
+                raise ValueError("Unrecognized output_format: %s" % str(output_format))
+            if write_mode != 'w':
+                raise ValueError("Cannot append to a catalog with output_format '%s'"
+                                 % output_format)
+
+    def _write_binary(self, query_result, filename, output_format,
+                      n_processes=None, write_depth=None):
+        """
+        Write the chunks of a database query to a binary file
+        (see write_catalog)
 
-        for chunk in query_result:
-            self._write_recarray(chunk, file_handle)
+        @param [in] query_result is an iterator over recarrays, as returned
+        by db_obj.query_columns
+
+        @param [in] filename is the name of the file to be written
 
-        file_handle.close()
+        @param [in] output_format is 'npy' or 'fits'
+
+        @param [in] n_processes is the number of worker processes used to compute
+        the columns (see write_catalog)
+
+        @param [in] write_depth is the number of chunks that can wait for a
+        background thread to write them (see write_catalog)
+        """
+        writer = self._binary_writers[output_format](filename, list(self.iter_column_names()),
+                                                     column_dtypes=self.column_dtypes)
+        output = _BackgroundWriter(writer.write, write_depth) if write_depth else writer
+        try:
+            for chunk_cols in self._iter_chunk_cols(query_result, n_processes=n_processes):
+                output.write(self._remove_null_rows(chunk_cols))
+            if output is not writer:
+                output.close()
+        except:
+            # do not leave an incomplete file behind
+            error = sys.exc_info()
+            if output is not writer:
+                try:
+                    output.close()
+                except:
+                    pass
+            writer.abort()
+            raise error[0], error[1], error[2]
+
+        writer.close()
+
+    def _iter_chunk_cols(self, query_result, n_processes=None):
+        """
+        Iterate over the chunks returned by a database query, yielding the
+        list of (transformed) output columns for each chunk (see _get_chunk_cols).
+
+        @param [in] query_result is an iterator over recarrays, as returned
+        by db_obj.query_columns
+
+        @param [in] n_processes is the number of worker processes to use.
+        If it is None or 1, the columns are computed in this process.
+        Otherwise, up to 2*n_processes chunks are handed to a
+        multiprocessing.Pool at a time and the results are yielded in the
+        order of query_result.
+        """
+        if n_processes is None or n_processes <= 1:
+            for chunk in query_result:
+                yield self._get_chunk_cols(chunk, read_only=True)
+            return
+
+        # The worker processes receive this catalog, fully configured,
+        # through the pool initializer.
+        pool = multiprocessing.Pool(n_processes, initializer=_init_chunk_worker,
+                                    initargs=(self,))
+        try:
+            pending = deque()
+            for chunk in query_result:
+                pending.append(pool.apply_async(_compute_chunk_cols, (chunk,)))
+                if len(pending) >= 2*n_processes:
+                    yield pending.popleft().get()
+
+            while len(pending) > 0:
+                yield pending.popleft().get()
+
+            pool.close()
+        finally:
+            pool.terminate()
 
 
     def _write_pre_process(self):
         """
-        This function verifies the catalog's required columns, initializes
-        some member variables that are required for the catalog-writing process.
+        This function initializes some member variables that are required for
+        the catalog-writing process.  (The catalog's required columns have
+        already been verified by __init__.)
         """
-        db_required_columns, required_columns_with_defaults = self.db_required_columns()
         self._template = None
+        self._column_templates = None
+
+        self._find_cannot_be_null_dexes()
 
-        # find the indices of columns that cannot be null
+    def _find_cannot_be_null_dexes(self):
+        """
+        Find the indices (in iter_column_names()) of the columns that cannot be null
+        """
         self._cannotBeNullDexes = []
         for (i,col) in enumerate(self.iter_column_names()):
             if col in self.cannot_be_null:
@@ -533,59 +1509,237 @@ class InstanceCatalog(object):
         the catalog is being written.
         """
 
+        self._write_chunk_cols(self._get_chunk_cols(chunk, read_only=True), file_handle)
+
+    def _write_chunk_cols(self, chunk_cols, file_handle):
+        """
+        Format the columns of a chunk (as returned by _get_chunk_cols)
+        and write them to the catalog.
+
+        @param [in] chunk_cols is a list of numpy arrays (one per column)
+
+        @param [in] file_handle is a file handle pointing to the file where
+        the catalog is being written.
+        """
+
+        # format the chunk column-by-column and write it with a single call
+        file_handle.write(self._format_chunk(self._prepare_chunk_cols(chunk_cols)))
+
+    def _prepare_chunk_cols(self, chunk_cols):
+        """
+        Get the columns of a chunk (as returned by _get_chunk_cols) ready
+        for _format_chunk: set the line template if this is the first chunk
+        and remove the rows which have null values in the columns that
+        cannot be null.
+
+        @param [in] chunk_cols is a list of numpy arrays (one per column)
+
+        @param [out] the list of numpy arrays to be passed to _format_chunk
+        """
+
+        # Create the template with the first chunk
+        if self._template is None:
+            self._column_templates = self._make_column_templates(chunk_cols)
+            self._template = self.delimiter.join(self._column_templates) + self.endline
+
+        # drop rows that have a null value in one of the columns that cannot be
+        # null; this is skipped if no columns are specified by cannot_be_null
+        return self._remove_null_rows(chunk_cols)
+
+    def _get_chunk_cols(self, chunk, read_only=False, column_values=None):
+        """
+        Set chunk as the current chunk and return a list of the (transformed)
+        columns in iter_column_names()
+
+        @param [in] chunk is the recarray of queried columns
+
+        @param [in] read_only is a boolean stating whether the caller will
+        only read the returned columns.  If True, output columns which are
+        filled from default_columns (and which no other column asks for)
+        are returned as read-only constant views (see _constant_column)
+        rather than as newly allocated arrays.
+
+        @param [in] column_values is an optional dict of the columns of chunk
+        which have already been computed
+
+        If self.memoize_columns is True, every column is computed once; the
+        getters which ask for it through column_by_name get copies of it, so
+        that a getter which modifies its input in place (e.g. with +=) does
+        not change the other columns.
+        """
         self._set_current_chunk(chunk)
-        chunk_cols = [self.transformations[col](self.column_by_name(col))
+        if column_values is not None and self._column_plan is not None:
+            self._column_values.update(column_values)
+
+        if self._column_plan is None:
+            return [self.transformations[col](self.column_by_name(col))
+                    if col in self.transformations.keys() else
+                    self.column_by_name(col)
+                    for col in self.iter_column_names()]
+
+        # Compute each column once, after the columns it depends on, and
+        # keep it in self._column_values (where column_by_name will find it)
+        # until the last column that needs it has been computed.
+        output_values = {}
+        output_names = set(self.iter_column_names())
+        for column_name, released in self._column_plan:
+            if column_name in self._column_values:
+                # passed in column_values
+                value = self._column_values[column_name]
+            elif read_only and column_name in self._constant_defaults:
+                value, dtype = self._constant_defaults[column_name]
+                value = _constant_column(value, dtype, len(chunk))
+            else:
+                value = self.column_by_name(column_name)
+            self._column_values[column_name] = value
+            if column_name in output_names:
+                output_values[column_name] = value
+            for name in released:
+                del self._column_values[name]
+
+        chunk_cols = [self.transformations[col](output_values[col])
                       if col in self.transformations.keys() else
-                      self.column_by_name(col)
+                      output_values[col]
                       for col in self.iter_column_names()]
 
-        # Create the template with the first chunk
-        if self._template is None:
-            self._template = self._make_line_template(chunk_cols)
+        return chunk_cols
+
+    def _not_null_mask(self, chunk_cols):
+        """
+        Return a boolean numpy array that is True for the rows of chunk_cols
+        which have no null values (as defined by is_null) in the columns
+        listed in self._cannotBeNullDexes.
+        """
+        good_rows = numpy.ones(len(chunk_cols[0]), dtype=bool)
+        for i in self._cannotBeNullDexes:
+            good_rows &= numpy.logical_not(_null_mask(chunk_cols[i]))
+        return good_rows
+
+    def _remove_null_rows(self, chunk_cols):
+        """
+        Return chunk_cols with the rows that have null values in any of the
+        columns listed in self.cannot_be_null removed.
+        """
+        if len(self._cannotBeNullDexes) == 0:
+            return chunk_cols
 
-        # use a generator expression for lines rather than a list
-        # for memory efficiency
-        file_handle.writelines(self._template % line
-                               for line in zip(*chunk_cols)
-                               if numpy.array([not is_null(line[i]) for i in self._cannotBeNullDexes]).all())
-                               # the last boolean in this line causes a row not to be printed if it has
-                               # a null value in one of the columns that cannot be null; it is ignored
-                               # if no columns are specified by cannot_be_null
+        good_rows = self._not_null_mask(chunk_cols)
+        return [col[good_rows] for col in chunk_cols]
 
 
 
     def iter_catalog(self, chunk_size=None):
-        db_required_columns = self.db_required_columns()
+        self._find_cannot_be_null_dexes()
 
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
                                                  chunk_size=chunk_size)
         for chunk in query_result:
-            self._set_current_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
-                          if col in self.transformations.keys() else
-                          self.column_by_name(col)
-                          for col in self.iter_column_names()]
+            chunk_cols = self._remove_null_rows(self._get_chunk_cols(chunk, read_only=True))
             for line in zip(*chunk_cols):
                 yield line
 
+    def iter_catalog_rows(self, chunk_size=None, named=False, n_processes=None):
+        """
+        Iterate over the rows of the catalog, like iter_catalog, but yield rows
+        of native Python values (floats, ints, strings) rather than of numpy
+        scalars.  Every column of a chunk is converted with a single call to
+        tolist(), so that the rows cost nothing more to produce than iter_catalog's.
+
+        @param [in] chunk_size is the number of rows queried from the database
+        at a time (see write_catalog)
+
+        @param [in] named is a boolean.  If False (the default), the rows are
+        tuples.  If True, they are namedtuples whose fields are named after
+        iter_column_names() (names which are not valid field names, or which are
+        repeated, are replaced by positional names; see collections.namedtuple)
+
+        @param [in] n_processes is the number of worker processes used to compute
+        the columns (see write_catalog)
+        """
+        self._find_cannot_be_null_dexes()
+
+        if named:
+            make_row = namedtuple('CatalogRow', list(self.iter_column_names()), rename=True)._make
+        else:
+            make_row = None
+
+        query_result = self.db_obj.query_columns(colnames=self._active_columns,
+                                                 obs_metadata=self.obs_metadata,
+                                                 constraint=self.constraint,
+                                                 chunk_size=chunk_size)
+
+        for chunk_cols in self._iter_chunk_cols(query_result, n_processes=n_processes):
+            chunk_rows = zip(*[col.tolist() for col in self._remove_null_rows(chunk_cols)])
+            if make_row is not None:
+                chunk_rows = map(make_row, chunk_rows)
+            for row in chunk_rows:
+                yield row
+
     def iter_catalog_chunks(self, chunk_size=None):
-        db_required_columns = self.db_required_columns()
+        self._find_cannot_be_null_dexes()
 
         query_result = self.db_obj.query_columns(colnames=self._active_columns,
                                                  obs_metadata=self.obs_metadata,
                                                  constraint=self.constraint,
                                                  chunk_size=chunk_size)
         for chunk in query_result:
-            self._set_current_chunk(chunk)
-            chunk_cols = [self.transformations[col](self.column_by_name(col))
-                          if col in self.transformations.keys() else
-                          self.column_by_name(col)
-                          for col in self.iter_column_names()]
+            chunk_cols = self._remove_null_rows(self._get_chunk_cols(chunk))
             chunkColMap = dict([(col, i) for i,col in enumerate(self.iter_column_names())])
             yield chunk_cols, chunkColMap
 
+    def iter_catalog_batches(self, chunk_size=None, as_dict=False, n_processes=None):
+        """
+        Iterate over the catalog one chunk at a time, yielding each chunk as a
+        single batch of typed, contiguous numpy data.  The transformations are
+        applied and the rows with null values in the columns listed in
+        cannot_be_null are removed, as in write_catalog.
+
+        @param [in] chunk_size is the number of rows queried from the database
+        at a time (see write_catalog)
+
+        @param [in] as_dict is a boolean.  If False (the default), every batch is
+        a structured numpy array with one field per column; the dtype is fixed
+        by the first chunk and by column_dtypes (as in the binary output formats
+        of write_catalog), so that the batches can be concatenated.  A ValueError
+        is raised if a later chunk has strings which are too long for their field.
+        If True, every batch is an OrderedDict mapping the column names to
+        contiguous numpy arrays, each of the dtype of its own chunk.
+
+        @param [in] n_processes is the number of worker processes used to compute
+        the columns (see write_catalog)
+
+        The fields (or keys) are named after iter_column_names(); a column which
+        is output more than once appears only once in the batches.
+        """
+        self._find_cannot_be_null_dexes()
+
+        # the columns of every batch; a repeated column has the same values
+        # every time it appears, so only its first appearance is kept
+        column_names = []
+        column_dexes = []
+        for i, col in enumerate(self.iter_column_names()):
+            if col not in column_names:
+                column_names.append(col)
+                column_dexes.append(i)
+
+        builder = _RecordBuilder(column_names, column_dtypes=self.column_dtypes)
+
+        query_result = self.db_obj.query_columns(colnames=self._active_columns,
+                                                 obs_metadata=self.obs_metadata,
+                                                 constraint=self.constraint,
+                                                 chunk_size=chunk_size)
+
+        for chunk_cols in self._iter_chunk_cols(query_result, n_processes=n_processes):
+            chunk_cols = self._remove_null_rows(chunk_cols)
+            chunk_cols = [chunk_cols[i] for i in column_dexes]
+            if as_dict:
+                yield OrderedDict((name, numpy.ascontiguousarray(col))
+                                  for name, col in zip(column_names, chunk_cols))
+            else:
+                yield builder._as_records(chunk_cols)
+
     def get_objId(self):
         return self.column_by_name(self.refIdCol)
 
@@ -601,10 +1755,15 @@ class InstanceCatalog(object):
         This method will return the name of the class that first defined the
         input method.
 
-        This is taken verbatim from
+        Getters and defaults are looked up in the column index built by
+        InstanceCatalogMeta.  Other methods are looked up with the recipe from
         http://stackoverflow.com/questions/961048/get-class-that-defined-method
         """
 
+        index = getattr(meth.im_class, '_column_index', None)
+        if index is not None and meth.__name__ in index.defining_classes:
+            return index.defining_classes[meth.__name__]
+
         for cls in inspect.getmro(meth.im_class):
             if meth.__name__ in cls.__dict__:
                 return cls
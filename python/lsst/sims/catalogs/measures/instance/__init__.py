@@ -1,3 +1,4 @@
 from .decorators import *
 from .InstanceCatalog import *
 from .CompoundInstanceCatalog import *
+from .ConnectionPool import *
@@ -1,7 +1,10 @@
+import weakref
+import numpy
 from functools import wraps
 from collections import OrderedDict
 
-__all__ = ["cached", "compound", "register_class", "register_method"]
+__all__ = ["cached", "compound", "register_class", "register_method",
+           "ColumnCache", "chunk_invariant", "metadata_only"]
 
 #---------------------------------------------------------------------- 
 # Define decorators for get_* methods
@@ -10,6 +13,77 @@ __all__ = ["cached", "compound", "register_class", "register_method"]
 # a given database chunk, it is cached in memory and not computed again.
 
 
+def _nbytes(value):
+    """Return the number of bytes held by a cached column (or compound column)"""
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(_nbytes(vv) for vv in value.values())
+    return 0
+
+
+class ColumnCache(object):
+    """
+    The cache in which @cached and @compound store their results.
+
+    It keeps track of the number of bytes it holds.  If max_bytes is not
+    None, the least recently used columns are evicted whenever the cache
+    holds more than max_bytes.  An evicted column is simply recomputed the
+    next time it is asked for.
+
+    Every read of a column counts as a hit; every column stored (i.e.
+    computed because it was not in the cache) counts as a miss.
+    """
+    def __init__(self, max_bytes=None):
+        """
+        @param [in] max_bytes is the maximum number of bytes to keep in the
+        cache (default None, i.e. no limit)
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._sizes = {}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, key):
+        # move the column to the most recently used end
+        value = self._data.pop(key)
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self._remove(key)
+        self._data[key] = value
+        self._sizes[key] = _nbytes(value)
+        self.nbytes += self._sizes[key]
+        self.misses += 1
+
+        if self.max_bytes is not None:
+            while self.nbytes > self.max_bytes and len(self._data) > 0:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def clear(self):
+        """Remove all of the columns (the counters are not reset)"""
+        self._data.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+
 def cached(f):
     """Decorator for specifying that the computed result should be cached"""
     if not f.__name__.startswith('get_'):
@@ -27,6 +101,140 @@ def cached(f):
     new_f._cache_results = True
     return new_f
 
+# The values of @metadata_only columns, keyed by the ObservationMetaData
+# they were computed for (see InstanceCatalog._metadata_key).  Each entry
+# is a tuple (signature, values): the values are only valid for catalogs
+# whose obs_metadata has that signature (see _value_signature).
+_metadata_column_values = weakref.WeakKeyDictionary()
+
+def _value_signature(value, _seen=frozenset()):
+    """
+    Return a hashable signature of the contents of value: two objects have
+    the same signature if they hold the same values.  numpy arrays, dicts,
+    lists and tuples are compared element by element, and other objects
+    by their attributes (so an ObservationMetaData changes its signature
+    whenever one of its setters is used).
+    """
+    if isinstance(value, float):
+        # repr distinguishes all floats (and, unlike ==, matches nan to nan)
+        return ('float', repr(value))
+    if value is None or isinstance(value, (basestring, bool, int, long)):
+        return value
+    if isinstance(value, numpy.ndarray):
+        return ('ndarray', value.dtype.str, value.shape, value.tostring())
+    if isinstance(value, numpy.generic):
+        return _value_signature(value.item())
+
+    if id(value) in _seen:
+        return ('cycle',)
+    _seen = _seen | frozenset([id(value)])
+
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((_value_signature(key), _value_signature(item, _seen))
+                                     for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (value.__class__.__name__, tuple(_value_signature(item, _seen) for item in value))
+
+    attributes = {}
+    if hasattr(value, '__dict__'):
+        attributes.update(vars(value))
+    for klass in type(value).__mro__:
+        for name in getattr(klass, '__slots__', ()):
+            if hasattr(value, name):
+                attributes[name] = getattr(value, name)
+    if len(attributes) > 0 or hasattr(value, '__dict__'):
+        return (value.__class__.__name__, _value_signature(attributes, _seen))
+
+    return (value.__class__.__name__, repr(value))
+
+def _metadata_store(self):
+    """
+    Return the dict in which the @metadata_only columns of the catalog self
+    are stored.  It is shared by the catalogs constructed with the same
+    ObservationMetaData, as long as that ObservationMetaData has not been
+    changed in between; otherwise the stored values are discarded.
+
+    The signature of self.obs_metadata is computed once per chunk and kept
+    in self._metadata_signature (which InstanceCatalog._set_current_chunk
+    resets).
+    """
+    signature = self._metadata_signature
+    if signature is None:
+        signature = _value_signature(self.obs_metadata)
+        self._metadata_signature = signature
+    entry = _metadata_column_values.get(self._metadata_key)
+    if entry is None or entry[0] != signature:
+        entry = (signature, {})
+        _metadata_column_values[self._metadata_key] = entry
+    return entry[1]
+
+def _invariant_value(result):
+    """
+    Return the one-row array from which an invariant column is broadcast,
+    or None if result is empty (e.g. during the introspection of
+    InstanceCatalog.db_required_columns)
+    """
+    result = numpy.asarray(result)
+    if result.ndim == 0:
+        return result.reshape(1)
+    elif len(result) == 0:
+        return None
+    return result[:1].copy()
+
+def _broadcast_invariant(value, nrows):
+    """Return a new array of nrows rows, each equal to the one row of value"""
+    column = numpy.empty((nrows,) + value.shape[1:], dtype=value.dtype)
+    column[:] = value
+    return column
+
+def _invariant_getter(f, get_store):
+    """
+    Wrap the getter f so that its result is computed once, stored in the
+    dict returned by get_store(self), and broadcast to the length of the
+    current chunk thereafter.  While InstanceCatalog.db_required_columns
+    introspects the getters, f is always called (and nothing is stored),
+    so that the columns it asks for are recorded.
+    """
+    if not f.__name__.startswith('get_'):
+        raise ValueError("@chunk_invariant and @metadata_only can only be applied "
+                         "to get_* methods: Method '%s' invalid." % f.__name__)
+    @wraps(f)
+    def new_f(self, *args, **kwargs):
+        if len(args) > 0 or len(kwargs) > 0 or getattr(self, '_column_stack', None):
+            return f(self, *args, **kwargs)
+
+        store = get_store(self)
+        if new_f not in store:
+            result = f(self)
+            value = _invariant_value(result)
+            if value is None:
+                return result
+            store[new_f] = value
+
+        return _broadcast_invariant(store[new_f], len(self._current_chunk))
+    return new_f
+
+def chunk_invariant(f):
+    """
+    Decorator for get_* methods whose result is the same for every row
+    of every chunk (e.g. a column that only depends on obs_metadata).
+    The getter is called once per catalog; it may return either a scalar
+    or a full column, and its first row is broadcast to the length of
+    every chunk.
+    """
+    return _invariant_getter(f, lambda self: self._invariant_columns)
+
+def metadata_only(f):
+    """
+    Decorator for get_* methods whose result only depends on obs_metadata.
+    Like @chunk_invariant, except that the value is computed once per
+    ObservationMetaData and shared by all the catalogs constructed with
+    the same ObservationMetaData instance.  If that ObservationMetaData is
+    modified (e.g. its mjd or bandpassName is set) between catalogs, the
+    value is computed afresh.
+    """
+    return _invariant_getter(f, _metadata_store)
+
 def compound(*colnames):
     """Specifies that a column is a "compound column",
  that is, it returns multiple values.  This is useful in the case of,
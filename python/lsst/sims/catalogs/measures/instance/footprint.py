@@ -0,0 +1,84 @@
+"""Footprints of the fields of view of ObservationMetaData"""
+import numpy
+from lsst.sims.utils import ObservationMetaData, haversine
+
+__all__ = []
+
+
+def _box_lengths(obs_metadata):
+    """Return the half-widths (in degrees) in RA and Dec of a box field of view"""
+    lengths = numpy.atleast_1d(obs_metadata.boundLength)
+    return lengths[0], lengths[-1]
+
+
+def _footprint_mask(obs_metadata, ra, dec):
+    """
+    Return a boolean array that is True for the points (ra, dec) (in degrees)
+    which are inside the field of view of obs_metadata (the 'circle' or 'box'
+    given by its boundType, boundLength, pointingRA and pointingDec).
+    """
+    if obs_metadata.boundType is None or obs_metadata.boundLength is None:
+        return numpy.ones(len(ra), dtype=bool)
+
+    if obs_metadata.boundType == 'circle':
+        separation = haversine(numpy.radians(ra), numpy.radians(dec),
+                               numpy.radians(obs_metadata.pointingRA),
+                               numpy.radians(obs_metadata.pointingDec))
+        return numpy.degrees(separation) <= obs_metadata.boundLength
+
+    if obs_metadata.boundType == 'box':
+        ra_length, dec_length = _box_lengths(obs_metadata)
+        dra = numpy.mod(ra - obs_metadata.pointingRA + 180.0, 360.0) - 180.0
+        return numpy.logical_and(numpy.abs(dra) <= ra_length,
+                                 numpy.abs(dec - obs_metadata.pointingDec) <= dec_length)
+
+    raise ValueError("Unrecognized boundType: %s" % str(obs_metadata.boundType))
+
+
+def _union_footprint(obs_metadata_list):
+    """
+    Return an ObservationMetaData whose circular field of view contains the
+    fields of view of all of the ObservationMetaData in obs_metadata_list,
+    or None if they cover (or may cover) the whole sky.
+    """
+    for obs in obs_metadata_list:
+        if obs.boundType is None or obs.boundLength is None:
+            return None
+        if obs.boundType not in ('circle', 'box'):
+            raise ValueError("Unrecognized boundType: %s" % str(obs.boundType))
+
+    ra = numpy.radians([obs.pointingRA for obs in obs_metadata_list])
+    dec = numpy.radians([obs.pointingDec for obs in obs_metadata_list])
+    center = numpy.array([(numpy.cos(dec)*numpy.cos(ra)).sum(),
+                          (numpy.cos(dec)*numpy.sin(ra)).sum(),
+                          numpy.sin(dec).sum()])
+    norm = numpy.sqrt((center*center).sum())
+    if norm < 1.0e-10:
+        return None
+
+    center_ra = numpy.arctan2(center[1], center[0]) % (2.0*numpy.pi)
+    center_dec = numpy.arcsin(center[2]/norm)
+
+    radius = 0.0
+    for obs in obs_metadata_list:
+        if obs.boundType == 'circle':
+            separation = haversine(center_ra, center_dec, numpy.radians(obs.pointingRA),
+                                   numpy.radians(obs.pointingDec))
+            radius = max(radius, numpy.degrees(separation) + obs.boundLength)
+        else:
+            # the corner of a box is the point farthest from the center
+            ra_length, dec_length = _box_lengths(obs)
+            for ra_sign in (-1.0, 1.0):
+                for dec_sign in (-1.0, 1.0):
+                    corner_dec = numpy.clip(obs.pointingDec + dec_sign*dec_length, -90.0, 90.0)
+                    separation = haversine(center_ra, center_dec,
+                                           numpy.radians(obs.pointingRA + ra_sign*ra_length),
+                                           numpy.radians(corner_dec))
+                    radius = max(radius, numpy.degrees(separation))
+
+    if radius >= 180.0:
+        return None
+
+    return ObservationMetaData(pointingRA=numpy.degrees(center_ra),
+                               pointingDec=numpy.degrees(center_dec),
+                               boundType='circle', boundLength=float(radius))
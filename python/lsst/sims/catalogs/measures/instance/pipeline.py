@@ -0,0 +1,125 @@
+"""Helpers computing and writing the chunks of an InstanceCatalog in parallel"""
+import sys
+import threading
+import Queue
+
+__all__ = []
+
+
+# The catalog used by the worker processes of InstanceCatalog's
+# process pool (see InstanceCatalog._iter_chunk_cols)
+_worker_catalog = None
+
+def _init_chunk_worker(catalog):
+    """
+    Initializer for InstanceCatalog's worker processes.  The catalog is
+    handed over already configured, so the worker does not need to re-run
+    __init__ or _check_requirements.
+    """
+    global _worker_catalog
+    _worker_catalog = catalog
+
+def _compute_chunk_cols(chunk):
+    """Compute the output columns of a chunk in a worker process"""
+    return _worker_catalog._get_chunk_cols(chunk, read_only=True)
+
+
+# markers passed through the queues of _prefetch and _BackgroundWriter
+_END_OF_QUEUE = 'end'
+_ITEM = 'item'
+_ERROR = 'error'
+
+def _prefetch(make_iterator, depth):
+    """
+    Generator yielding the items of the iterator returned by make_iterator().
+
+    make_iterator() is called, and the iterator consumed, by a background
+    thread which stays at most 'depth' items ahead of the caller.  Exceptions
+    raised in the background thread are re-raised by this generator.
+    """
+    items = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(kind, payload):
+        while not stop.is_set():
+            try:
+                items.put((kind, payload), timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in make_iterator():
+                if not put(_ITEM, item):
+                    return
+            put(_END_OF_QUEUE, None)
+        except:
+            put(_ERROR, sys.exc_info())
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            kind, payload = items.get()
+            if kind == _END_OF_QUEUE:
+                break
+            elif kind == _ERROR:
+                raise payload[0], payload[1], payload[2]
+            yield payload
+    finally:
+        stop.set()
+
+
+class _BackgroundWriter(object):
+    """
+    File-like object that passes everything given to write() on to a
+    function called by a background thread.  At most 'depth' items are
+    queued; write() blocks if the background thread falls behind.
+    Exceptions raised in the background thread are re-raised by write()
+    or close().
+    """
+    def __init__(self, write, depth):
+        """
+        @param [in] write is the function that actually writes the data
+
+        @param [in] depth is the maximum number of items waiting to be written
+        """
+        self._write = write
+        self._error = None
+        self._items = Queue.Queue(maxsize=depth)
+        self._thread = threading.Thread(target=self._drain)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self):
+        while True:
+            item = self._items.get()
+            if item is _END_OF_QUEUE:
+                return
+            # after a failure, keep emptying the queue so that write() does not block
+            if self._error is None:
+                try:
+                    self._write(item)
+                except:
+                    self._error = sys.exc_info()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error[0], error[1], error[2]
+
+    def write(self, item):
+        self._raise_error()
+        self._items.put(item)
+
+    def close(self):
+        """Wait for all of the queued items to be written"""
+        if self._thread.is_alive():
+            self._items.put(_END_OF_QUEUE)
+            self._thread.join()
+        self._raise_error()
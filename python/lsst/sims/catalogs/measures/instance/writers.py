@@ -0,0 +1,230 @@
+"""Writers streaming the chunks of an InstanceCatalog into binary files"""
+import os
+import numpy
+
+__all__ = []
+
+
+def _string_length(dtype):
+    """Return the number of characters held by a string dtype"""
+    if dtype.kind == 'U':
+        return dtype.itemsize//4
+    return dtype.itemsize
+
+
+class _RecordBuilder(object):
+    """
+    Converts the chunks of an InstanceCatalog (lists of column arrays) into
+    structured numpy arrays with one field per column.
+
+    The dtype of the records is fixed by the first chunk that is converted,
+    except for the columns whose dtype is given in column_dtypes.  Object
+    columns are converted to strings.  A ValueError is raised if a later
+    chunk has strings which are too long for their field, rather than
+    truncating them.
+    """
+    def __init__(self, column_names, column_dtypes=None):
+        """
+        @param [in] column_names is the list of column names
+        (i.e. list(InstanceCatalog.iter_column_names()))
+
+        @param [in] column_dtypes is an optional dict mapping column names
+        to the dtypes of their fields (see InstanceCatalog.column_dtypes)
+        """
+        self.column_names = column_names
+        self.column_dtypes = column_dtypes if column_dtypes is not None else {}
+        self.dtype = None
+
+    def _as_records(self, chunk_cols):
+        """
+        Convert a list of column arrays into a structured numpy array
+        of self.dtype
+        """
+        chunk_cols = [col.astype(str) if col.dtype.kind == 'O' else col
+                      for col in chunk_cols]
+
+        if self.dtype is None:
+            self.dtype = numpy.dtype([(name, self.column_dtypes.get(name, col.dtype), col.shape[1:])
+                                      for name, col in zip(self.column_names, chunk_cols)])
+
+        records = numpy.empty(len(chunk_cols[0]), dtype=self.dtype)
+        for name, col in zip(self.column_names, chunk_cols):
+            field = self.dtype[name].base
+            if col.dtype.kind in ('S', 'U') and field.kind in ('S', 'U') and \
+               _string_length(col.dtype) > _string_length(field) and len(col) > 0:
+
+                length = numpy.char.str_len(col).max()
+                if length > _string_length(field):
+                    raise ValueError("Strings in column '%s' are %d characters long, but the "
+                                     "column only holds %d characters (the length in the first "
+                                     "chunk of the catalog); declare the dtype of the column "
+                                     "in column_dtypes" % (name, length, _string_length(field)))
+            records[name] = col
+
+        return records
+
+
+class _BinaryCatalogWriter(_RecordBuilder):
+    """
+    Base class for the objects that InstanceCatalog uses to stream its
+    columns into a binary file one chunk at a time.
+
+    The dtype of the output is fixed by the first chunk that is written
+    (see _RecordBuilder).  Object columns are converted to strings.
+    """
+    def __init__(self, filename, column_names, column_dtypes=None):
+        """
+        @param [in] filename is the name of the file to be written
+
+        @param [in] column_names is the list of column names
+        (i.e. list(InstanceCatalog.iter_column_names()))
+
+        @param [in] column_dtypes is an optional dict mapping column names
+        to the dtypes of their fields (see InstanceCatalog.column_dtypes)
+        """
+        super(_BinaryCatalogWriter, self).__init__(column_names, column_dtypes=column_dtypes)
+        self.n_rows = 0
+        self.filename = filename
+        self._file_handle = open(filename, 'wb')
+
+    def write(self, chunk_cols):
+        """
+        Write a chunk of the catalog
+
+        @param [in] chunk_cols is a list of numpy arrays (one per column)
+        """
+        if len(chunk_cols) == 0:
+            return
+
+        records = self._as_records(chunk_cols)
+        self._write_records(records)
+        self.n_rows += len(records)
+
+    def close(self):
+        if self.dtype is None:
+            # nothing was written, so we do not know the column types
+            self.dtype = numpy.dtype([(name, numpy.float64) for name in self.column_names])
+            self._write_records(numpy.empty(0, dtype=self.dtype))
+        self._finalize()
+        self._file_handle.close()
+
+    def abort(self):
+        """Close and delete the file, which was not completely written"""
+        self._file_handle.close()
+        if os.path.exists(self.filename):
+            os.unlink(self.filename)
+
+
+class _NpyCatalogWriter(_BinaryCatalogWriter):
+    """
+    Stream an InstanceCatalog into a numpy .npy file containing a
+    one-dimensional structured array.
+
+    The header is written with room for any number of rows, and is
+    rewritten with the final row count when the file is closed.
+    """
+    _header_length = 0
+
+    def _header(self):
+        header = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" \
+                 % (repr(numpy.lib.format.dtype_to_descr(self.dtype)), self.n_rows)
+
+        if self._header_length == 0:
+            # leave room for 20 digits of rows and make sure the
+            # data starts on a 16 byte boundary
+            length = len(header) + 20 + 1
+            if length + 10 < 65536:
+                self._version = (1, 0)
+                self._preamble = 10
+            else:
+                self._version = (2, 0)
+                self._preamble = 12
+            self._header_length = length + (16 - (self._preamble + length) % 16) % 16
+
+        return header.ljust(self._header_length - 1) + '\n'
+
+    def _write_header(self):
+        header = self._header()
+        self._file_handle.write(numpy.lib.format.magic(*self._version))
+        if self._version == (1, 0):
+            self._file_handle.write(numpy.array(len(header), dtype='<u2').tostring())
+        else:
+            self._file_handle.write(numpy.array(len(header), dtype='<u4').tostring())
+        self._file_handle.write(header)
+
+    def _write_records(self, records):
+        if self._header_length == 0:
+            self._write_header()
+        records.tofile(self._file_handle)
+
+    def _finalize(self):
+        self._file_handle.seek(0)
+        self._write_header()
+
+
+class _FitsCatalogWriter(_BinaryCatalogWriter):
+    """
+    Stream an InstanceCatalog into the first extension of a FITS file
+    as a binary table.
+
+    The table header is built with pyfits; the rows are written directly
+    in FITS (big-endian) byte order and NAXIS2 is updated when the file
+    is closed.
+    """
+    _header_offset = None
+
+    @staticmethod
+    def _fits_type(dtype):
+        """
+        Return the numpy type in which a column of type dtype will be
+        stored in the FITS file
+        """
+        if dtype.kind == 'U':
+            return numpy.dtype((str, dtype.itemsize//4))
+        elif dtype.kind == 'i' and dtype.itemsize == 1:
+            return numpy.dtype(numpy.int16)
+        elif dtype.kind == 'u' and dtype.itemsize == 2:
+            return numpy.dtype(numpy.int32)
+        elif dtype.kind == 'u' and dtype.itemsize > 2:
+            return numpy.dtype(numpy.int64)
+        return dtype
+
+    def _write_header(self):
+        import pyfits
+
+        self._fits_dtype = numpy.dtype([(name, self._fits_type(self.dtype[name].base),
+                                         self.dtype[name].shape)
+                                        for name in self.dtype.names])
+
+        # FITS stores logicals as the characters 'T' and 'F'
+        self._disk_dtype = numpy.dtype([(name, 'S1' if self._fits_dtype[name].base.kind == 'b'
+                                         else self._fits_dtype[name].base.newbyteorder('>'),
+                                         self._fits_dtype[name].shape)
+                                        for name in self._fits_dtype.names])
+
+        table_header = pyfits.BinTableHDU(numpy.zeros(0, dtype=self._fits_dtype)).header.tostring()
+
+        self._file_handle.write(pyfits.PrimaryHDU().header.tostring())
+        self._header_offset = self._file_handle.tell() + table_header.index('NAXIS2  =')
+        self._file_handle.write(table_header)
+
+    def _write_records(self, records):
+        if self._header_offset is None:
+            self._write_header()
+
+        disk_records = numpy.empty(len(records), dtype=self._disk_dtype)
+        for name in records.dtype.names:
+            if records.dtype[name].base.kind == 'b':
+                disk_records[name] = numpy.where(records[name], 'T', 'F')
+            else:
+                disk_records[name] = records[name]
+
+        disk_records.tofile(self._file_handle)
+
+    def _finalize(self):
+        n_bytes = self.n_rows*self._disk_dtype.itemsize
+        if n_bytes % 2880 != 0:
+            self._file_handle.write('\0'*(2880 - n_bytes % 2880))
+
+        self._file_handle.seek(self._header_offset)
+        self._file_handle.write(('%-8s= %20d' % ('NAXIS2', self.n_rows)).ljust(80))
@@ -1,4 +1,9 @@
 import math
+import numpy
+from collections import OrderedDict
+
+### the weights of the bicubic interpolation (Numerical Recipes, bcucof)
+bcuoff_weights = [ 1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0],           [0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0], [-3,0,0,3,0,0,0,0,-2,0,0,-1,0,0,0,0], [2,0,0,-2,0,0,0,0,1,0,0,1,0,0,0,0],  [0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,0],  [0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,0], [0,0,0,0,-3,0,0,3,0,0,0,0,-2,0,0,-1],  [0,0,0,0,2,0,0,-2,0,0,0,0,1,0,0,1],  [-3,3,0,0,-2,-1,0,0,0,0,0,0,0,0,0,0], [0,0,0,0,0,0,0,0,-3,3,0,0,-2,-1,0,0], [9,-9,9,-9,6,3,-3,-6,6,-6,-3,3,4,2,1,2],  [-6,6,-6,6,-4,-2,2,4,-3,3,3,-3,-2,-1,-1,-2],  [2,-2,0,0,1,1,0,0,0,0,0,0,0,0,0,0],  [0,0,0,0,0,0,0,0,2,-2,0,0,1,1,0,0],  [-6,6,-6,6,-3,-3,3,3,-4,4,2,-2,-2,-2,-1,-1],  [4,-4,4,-4,2,2,-2,-2,2,-2,-2,2,1,1,1,1]
 
 def bcuint(y, y1, y2, y12, x1l, x1u, x2l, x2u, x1, x2):
     d1 = x1u-x1l
@@ -18,7 +23,7 @@ def bcuint(y, y1, y2, y12, x1l, x1u, x2l, x2u, x1, x2):
 def bcuoff(y, y1, y2, y12, d1, d2):
     
     
-    wt =  [ 1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0],           [0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0], [-3,0,0,3,0,0,0,0,-2,0,0,-1,0,0,0,0], [2,0,0,-2,0,0,0,0,1,0,0,1,0,0,0,0],  [0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,0],  [0,0,0,0,0,0,0,0,0,0,0,0,1,0,0,0], [0,0,0,0,-3,0,0,3,0,0,0,0,-2,0,0,-1],  [0,0,0,0,2,0,0,-2,0,0,0,0,1,0,0,1],  [-3,3,0,0,-2,-1,0,0,0,0,0,0,0,0,0,0], [0,0,0,0,0,0,0,0,-3,3,0,0,-2,-1,0,0], [9,-9,9,-9,6,3,-3,-6,6,-6,-3,3,4,2,1,2],  [-6,6,-6,6,-4,-2,2,4,-3,3,3,-3,-2,-1,-1,-2],  [2,-2,0,0,1,1,0,0,0,0,0,0,0,0,0,0],  [0,0,0,0,0,0,0,0,2,-2,0,0,1,1,0,0],  [-6,6,-6,6,-3,-3,3,3,-4,4,2,-2,-2,-2,-1,-1],  [4,-4,4,-4,2,2,-2,-2,2,-2,-2,2,1,1,1,1] 
+    wt = bcuoff_weights
     d1d2 = d1*d2
     x=[]
     for i in range(0,16):
@@ -52,6 +57,10 @@ def bcuoff(y, y1, y2, y12, d1, d2):
 
 
 def get_interpolated_value(imagearray, nx, ny, x1, x2):
+    ## a numpy map can be given unflattened, e.g. WL.maps[i, k]
+    if isinstance(imagearray, numpy.ndarray):
+        imagearray = imagearray.reshape(-1)
+
     ansy = 0.0
     ansy1 = 0.0
     ansy2 = 0.0
@@ -93,6 +102,216 @@ def get_interpolated_value(imagearray, nx, ny, x1, x2):
     return ansy
 
 
+def bicubic_coefficients(imagearray, nx, a):
+    """ Vectorized version of the derivatives in get_interpolated_value and
+    of bcuoff: returns the array of the 16 coefficients c[i][j] (flattened
+    as l = 4*i+j on the first axis) for the cells whose lower left pixel
+    has the flat index a in imagearray.
+
+    imagearray is a numpy array whose last axis is the flattened map
+    (any leading axes, e.g. several maps, are carried along) and a is an
+    array of flat indices. The result has the shape
+    (16,) + imagearray.shape[:-1] + a.shape
+    """
+    def pixels(b):
+        return numpy.asarray(numpy.take(imagearray, b, axis=-1), dtype=float)
+
+    ## the corners of the cells, in the order used by get_interpolated_value
+    corners = [a, a+1, a+1+nx, a+nx]
+
+    y = [pixels(b) for b in corners]
+    y2 = [(pixels(b+nx) - pixels(b-nx)) /2.0 for b in corners]
+    y12 = [(pixels(b+1+nx) - pixels(b+1-nx) - pixels(b-1+nx) + pixels(b-1-nx)) /4.0
+           for b in corners]
+
+    ## the cells are always one pixel wide, so d1 = d2 = 1.
+    ## bcuoff fills its vector x in overlapping steps; these are the
+    ## values that x is left with (and y1 is never used).
+    zero = numpy.zeros(y[0].shape)
+    x = [y[0], y[1], y[2], y[3], y[2], y[3], y2[1], y2[2], y2[3], zero,
+         y12[0], y12[1], y12[2], y12[3], zero, zero]
+
+    return numpy.tensordot(numpy.array(bcuoff_weights, dtype=float),
+                           numpy.array(x, dtype=float), axes=1)
+
+
+def evaluate_bicubic(c, t, u):
+    """ Vectorized version of the polynomial evaluation in bcuint.
+    c is the array of coefficients returned by bicubic_coefficients and t, u
+    are the positions of the points within their cells (between 0 and 1)
+    """
+    ansy = numpy.zeros(c.shape[1:])
+    for i in range(3, -1,-1):
+        ansy = t*ansy +((c[4*i+3]*u + c[4*i+2])*u + c[4*i+1])*u + c[4*i]
+    return ansy
+
+
+def get_interpolated_values(imagearray, nx, ny, x1, x2, offset=0):
+    """ Vectorized version of get_interpolated_value: interpolate the map(s)
+    in imagearray at the arrays of positions x1, x2.
+
+    imagearray is a numpy array whose last axis is the flattened map
+    (index = x2*nx + x1). All of the maps along the leading axes are
+    interpolated at once, so that the result has the shape
+    imagearray.shape[:-1] + x1.shape (broadcast with offset)
+
+    offset is an optional (array of) index offsets added to the flat index of
+    every point; it can be used to stack several maps along the last axis
+    and choose, point by point, which of them is read (see WL.calc).
+    """
+    x1 = numpy.asarray(x1, dtype=float)
+    x2 = numpy.asarray(x2, dtype=float)
+
+    ## x1u = x1l+1 and x2u = x2l+1 always, as in get_interpolated_value
+    x1l = numpy.floor(x1)
+    x2l = numpy.floor(x2)
+
+    a = (x2l*nx + x1l).astype(int) + offset
+    c = bicubic_coefficients(imagearray, nx, a)
+
+    return evaluate_bicubic(c, x1-x1l, x2-x2l)
+
+
+class BicubicCoefficients(object):
+    """ The bicubic coefficients (see bicubic_coefficients) of the cells
+    of one flattened map, so that interpolating the map reduces to
+    gathering the coefficients of the cells and evaluating the polynomials
+    (see get_coefficient_interpolated_values).
+
+    The coefficients are computed tile_size x tile_size cells at a time,
+    when a point first falls in a tile (or all at once if precompute is
+    True), and kept in one pool of tiles. Once more than max_tiles tiles
+    are kept (None means no limit), the least recently used ones are
+    dropped and their room in the pool is reused. A tile takes
+    tile_size*tile_size*16*8 bytes; the pool holds at most max_tiles
+    tiles, or as many as a single call to coefficients needs if that
+    is more. The pool doubles in size whenever it is full, so that
+    filling it copies every tile a bounded number of times on average.
+    """
+
+    def __init__(self, imagearray, nx, ny, tile_size=64, max_tiles=None, precompute=False):
+        if precompute and max_tiles is not None:
+            raise ValueError("Cannot precompute the coefficients of all of the tiles "
+                             "if max_tiles is set")
+        self.imagearray = imagearray
+        self.nx = int(nx)
+        self.ny = int(ny)
+        self.tile_size = int(tile_size)
+        self.max_tiles = max_tiles
+        self.tiles_x = (self.nx + self.tile_size - 1)//self.tile_size
+        self.tiles_y = (self.ny + self.tile_size - 1)//self.tile_size
+        self.n_computed = 0 ## the number of tiles computed so far
+
+        self._cells = self.tile_size*self.tile_size
+        ## the coefficients of the tiles: slot s holds the coefficients
+        ## of its cells in rows s*_cells to (s+1)*_cells (the 16
+        ## coefficients of a cell are contiguous, for faster gathering)
+        self._pool = numpy.empty((0, 16))
+        self._free = []
+        ## the slot of every tile (-1 if it is not in the pool)
+        self._slots = -numpy.ones(self.tiles_x*self.tiles_y, dtype=int)
+        ## the tiles in the pool, least recently used first
+        self._used = OrderedDict()
+
+        if precompute:
+            self._load(numpy.arange(self.tiles_x*self.tiles_y))
+
+    def __len__(self):
+        return len(self._used)
+
+    def _compute_tile(self, tile):
+        """ Return the coefficients of the cells of a tile, as an array of
+        shape (16, tile_size*tile_size)
+        """
+        ty, tx = divmod(tile, self.tiles_x)
+        cell_y = numpy.arange(ty*self.tile_size, (ty+1)*self.tile_size)
+        cell_x = numpy.arange(tx*self.tile_size, (tx+1)*self.tile_size)
+        a = (cell_y[:, numpy.newaxis]*self.nx + cell_x[numpy.newaxis, :]).ravel()
+
+        ## the cells whose stencil is not in the map are never asked for
+        ## (see coefficients); give them the coefficients of a cell that is
+        a = numpy.clip(a, self.nx+1, self.nx*self.ny-3-2*self.nx)
+
+        self.n_computed += 1
+        return bicubic_coefficients(self.imagearray, self.nx, a)
+
+    def _load(self, tiles):
+        """ Put the tiles in the pool (if they are not there yet) and mark
+        them as the most recently used ones
+        """
+        missing = [tile for tile in tiles if self._slots[tile] < 0]
+
+        n_new = len(missing) - len(self._free)
+        if n_new > 0:
+            self._grow(len(self._pool)//self._cells + n_new)
+
+        for tile in tiles:
+            if tile in self._used:
+                self._used[tile] = self._used.pop(tile)
+
+        for tile in missing:
+            slot = self._free.pop()
+            self._pool[slot*self._cells:(slot+1)*self._cells] = self._compute_tile(tile).T
+            self._slots[tile] = slot
+            self._used[tile] = slot
+
+    def _grow(self, n_slots):
+        """ Make room for at least n_slots tiles in the pool, by doubling
+        its size (but never beyond the number of tiles of the map or
+        max_tiles, unless n_slots is more)
+        """
+        old_slots = len(self._pool)//self._cells
+        limit = self.tiles_x*self.tiles_y
+        if self.max_tiles is not None:
+            limit = min(limit, self.max_tiles)
+        new_slots = max(n_slots, min(2*old_slots, limit))
+
+        pool = numpy.empty((new_slots*self._cells, 16))
+        pool[:len(self._pool)] = self._pool
+        self._pool = pool
+        self._free.extend(range(old_slots, new_slots))
+
+    def coefficients(self, a):
+        """ Return the coefficients of the cells whose lower left pixel has
+        the flat index a (an array), as bicubic_coefficients would, i.e.
+        as an array of shape (16,) + a.shape
+        """
+        a = numpy.asarray(a, dtype=int)
+        if a.size > 0 and (a.min()-1-self.nx < 0 or a.max()+2+2*self.nx >= self.nx*self.ny):
+            raise IndexError("bicubic stencil reaches beyond the map")
+
+        cell_y, cell_x = divmod(a, self.nx)
+        tile = (cell_y//self.tile_size)*self.tiles_x + cell_x//self.tile_size
+        local = (cell_y % self.tile_size)*self.tile_size + cell_x % self.tile_size
+
+        touched = numpy.zeros(len(self._slots), dtype=bool)
+        touched[tile] = True
+        self._load(numpy.nonzero(touched)[0])
+
+        coefficients = numpy.take(self._pool, self._slots[tile]*self._cells + local, axis=0)
+
+        while self.max_tiles is not None and len(self._used) > self.max_tiles:
+            tile, slot = self._used.popitem(last=False)
+            self._slots[tile] = -1
+            self._free.append(slot)
+
+        ## move the coefficient axis first
+        return numpy.rollaxis(coefficients, -1)
+
+
+def get_coefficient_interpolated_values(coefficients, x1, x2):
+    """ Same as get_interpolated_values for one map, but from the
+    coefficients of its cells (a BicubicCoefficients) """
+    x1 = numpy.asarray(x1, dtype=float)
+    x2 = numpy.asarray(x2, dtype=float)
+
+    x1l = numpy.floor(x1)
+    x2l = numpy.floor(x2)
+
+    a = (x2l*coefficients.nx + x1l).astype(int)
+    return evaluate_bicubic(coefficients.coefficients(a), x1-x1l, x2-x2l)
+
+
 def get_linear_interpolated_value(x, x1, y1, x2, y2):
     """ If the redshift of the object is less than 1.0 or greater than 2.0,
     then there will be an extrapolation based on the redshift planes we actually do have.
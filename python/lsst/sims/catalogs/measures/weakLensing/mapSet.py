@@ -0,0 +1,122 @@
+import os, math
+
+class WLMapSet(object):
+    """ Describes a set of WL maps: for every redshift plane, one FITS
+    file for each of the shear1, shear2 and conv maps. The files of a
+    plane are found either from a filename pattern or from a manifest
+    (see from_manifest). The size of the maps, the survey angle and the
+    cosmology are read from the FITS header of the first map of the set
+    (see WL.initialize).
+    """
+
+    ### the maps of the original WL catalogs, mirrored on the lsst1 disk
+    default_directory = "/astro/net/lsst1/shared/djbard/mirrored"
+    default_pattern = "WL-{map_type}_m-512b240_Om0.260_Ol0.740_w-1.000_ns0.960_si0.798_4096xy_0001r_00{last_plane}p_0{redshift_tag}z_og.gre_X4_smaller.fit"
+
+    def __init__(self, directory, source_redshift, filename_pattern=None, filenames=None,
+                 last_plane=None, comoving_distance=None):
+        """
+        @param [in] directory is the directory containing the maps
+
+        @param [in] source_redshift is the list of the redshifts of the planes,
+        in increasing order (there must be at least two planes)
+
+        @param [in] filename_pattern is a format string giving the name of the
+        file of a map from the fields map_type ('shear1', 'shear2' or 'conv'),
+        plane (the index of the plane), redshift, redshift_tag
+        (int(floor(100*redshift))) and last_plane (see below)
+
+        @param [in] filenames is an alternative to filename_pattern: a list with,
+        for every plane, a dict mapping the map types to file names
+
+        @param [in] last_plane is an optional list with, for every plane, the index
+        of the last lens plane of the ray tracing (used by the default pattern)
+
+        @param [in] comoving_distance is an optional list of the comoving distances
+        of the planes
+        """
+        if (filename_pattern is None) == (filenames is None):
+            raise ValueError("Specify exactly one of filename_pattern and filenames")
+
+        self.directory = directory
+        self.source_redshift = [float(z) for z in source_redshift]
+        self.filename_pattern = filename_pattern
+        self.filenames = filenames
+        self.last_plane = last_plane
+        self.comoving_distance = comoving_distance
+
+        if len(self.source_redshift) < 2:
+            raise ValueError("A WL map set needs at least two redshift planes; you gave %d"
+                             % len(self.source_redshift))
+        for i in range(1, len(self.source_redshift)):
+            if self.source_redshift[i] <= self.source_redshift[i-1]:
+                raise ValueError("The redshifts of the WL map planes must be increasing: %s"
+                                 % str(self.source_redshift))
+        for name, values in (('filenames', filenames), ('last_plane', last_plane),
+                             ('comoving_distance', comoving_distance)):
+            if values is not None and len(values) != len(self.source_redshift):
+                raise ValueError("%s has %d entries for %d planes"
+                                 % (name, len(values), len(self.source_redshift)))
+
+    def __len__(self):
+        return len(self.source_redshift)
+
+    @classmethod
+    def default(cls):
+        """ The map set that WL has always used: three planes, at redshifts
+        1.0, 1.5 and 2.0, in default_directory
+        """
+        return cls(cls.default_directory, [1.0, 1.5, 2.0], filename_pattern=cls.default_pattern,
+                   last_plane=[29, 38, 46], comoving_distance=[2370.3, 3152.481, 3759.214])
+
+    @classmethod
+    def from_manifest(cls, manifest):
+        """ Read a map set from a manifest: a text file with one line per
+        redshift plane, giving
+
+            redshift shear1_file shear2_file conv_file [comoving_distance]
+
+        Lines starting with '#' are ignored. The files are relative to the
+        directory of the manifest (unless they are absolute paths). The planes
+        can be listed in any order.
+        """
+        planes = []
+        with open(manifest, 'r') as input_file:
+            for line in input_file:
+                words = line.split()
+                if len(words) == 0 or words[0].startswith('#'):
+                    continue
+                if len(words) not in (4, 5):
+                    raise ValueError("Cannot read the line '%s' of the WL map manifest %s"
+                                     % (line.strip(), manifest))
+                planes.append(words)
+
+        planes.sort(key=lambda words: float(words[0]))
+        if any(len(words) == 5 for words in planes) and any(len(words) == 4 for words in planes):
+            raise ValueError("The WL map manifest %s gives the comoving distance "
+                             "of some planes only" % manifest)
+
+        if len(planes) > 0 and len(planes[0]) == 5:
+            comoving_distance = [float(words[4]) for words in planes]
+        else:
+            comoving_distance = None
+
+        return cls(os.path.dirname(os.path.abspath(manifest)),
+                   [words[0] for words in planes],
+                   filenames=[dict(zip(('shear1', 'shear2', 'conv'), words[1:4])) for words in planes],
+                   comoving_distance=comoving_distance)
+
+    def get_filename(self, map_type, plane):
+        """ Return the path of the map of type map_type ('shear1', 'shear2'
+        or 'conv') of redshift plane number plane
+        """
+        if self.filenames is not None:
+            filename = self.filenames[plane][map_type]
+        else:
+            redshift = self.source_redshift[plane]
+            filename = self.filename_pattern.format(map_type=map_type, plane=plane, redshift=redshift,
+                                                    redshift_tag=int(math.floor(100*redshift)),
+                                                    last_plane=self.last_plane[plane]
+                                                    if self.last_plane is not None else None)
+
+        return os.path.join(self.directory, filename)
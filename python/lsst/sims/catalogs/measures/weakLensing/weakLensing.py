@@ -2,6 +2,7 @@ import pyfits ,math, numpy
 from darkenergy import *
 from interpolation import *
 from comoving_distance import *
+from mapSet import *
 
 class WL:
     """ Class for obtaining the shear parameters for a galaxy. 
@@ -18,20 +19,49 @@ class WL:
     NbinsX, NbinsY =0, 0
     w0, wa, Omega_m, Omega_Lambda, h = 0, 0, 0, 0, 0
     survey_angle = 0
-    number_of_maps = 3 ## number of redshift bins. 
+    number_of_maps = 3 ## number of redshift bins (set from map_set by initialize)
     source_redshift, last_plane, comoving_distance = [], [], []
+    map_types = ('shear1', 'shear2', 'conv')
+    ## the maps, as an array of shape (number_of_maps, len(map_types), NbinsY, NbinsX)
+    ## (or as nested lists of memory-mapped arrays; see initialize)
+    maps = None
+    ## the BicubicCoefficients of the maps (coefficients[i][k] for map type k of plane i),
+    ## if the coefficients are cached (see cache_coefficients)
+    coefficients = None
+    ## views of maps: e.g. shear1map[i] is the flattened shear1 map of redshift plane i
     shear1map, shear2map, convmap= [], [], []
+    calc_block_size = 100000 ## number of galaxies interpolated at a time by calc
 
-    def __init__(self):
-        data = None
+    def __init__(self, map_set=None):
+        """ map_set is the WLMapSet describing the maps to use
+        (by default, WLMapSet.default())
+        """
+        if map_set is None:
+            map_set = WLMapSet.default()
+        self.map_set = map_set
+        ## the memory-mapped FITS files of this instance (see initialize)
+        self._map_files = []
 
 
-    def initialize(self):
+    def initialize(self, memmap=False):
         """ To start with, we should get some of the info required
         from the WL maps, set up some variables and initialize this and that. 
+
+        If memmap is True, the maps are not read in: the FITS files are
+        memory-mapped and calc only reads the pixels around the galaxies
+        (the bicubic stencil of the cells they fall in). The pages that are
+        read stay in the page cache of the operating system, where they are
+        shared by all of the processes that use the same maps. The files stay
+        open until close() is called.
         """
 
-        hdulist = pyfits.open("/astro/net/lsst1/shared/djbard/mirrored/WL-shear1_m-512b240_Om0.260_Ol0.740_w-1.000_ns0.960_si0.798_4096xy_0001r_0029p_0100z_og.gre_X4_smaller.fit")
+        ### the redshift planes are those of the map set
+        self.number_of_maps = len(self.map_set)
+        self.source_redshift = list(self.map_set.source_redshift)
+        self.last_plane = self.map_set.last_plane
+        self.comoving_distance = self.map_set.comoving_distance
+
+        hdulist = pyfits.open(self.get_filename(self.map_types[0], 0))
         
         
         hdr = hdulist[0].header
@@ -46,54 +76,35 @@ class WL:
         self.survey_angle = hdr['ANGLE']
         hdulist.close()
 
-        ### there are only three redshift planes - hardcode them.
-        ## Can also access them from the WL map header files.
-        self.source_redshift = [1.0, 1.5, 2.0] 
-        self.last_plane = [29, 38, 46]
-        self.comoving_distance = [2370.3, 3152.481, 3759.214] 
-
-        ### load in the WL maps! this takes some time. 
-
-        ### can I avoid initializing? 
-        self.shear1map=[]
-        self.shear2map = []
-        self.convmap = []
-        
-        for i in range(0, self.number_of_maps):
-            self.shear1map.append([])
-            self.shear2map.append([])
-            self.convmap.append([])    
-            for j in range(0, int(self.NbinsX*self.NbinsY)):
-                self.shear1map[i].append(0)
-                self.shear2map[i].append(0)
-                self.convmap[i].append(0)
-        
-        for i in range(0, self.number_of_maps):
-
-            shear1name = self.get_filename("shear1", i)
-            shear2name = self.get_filename("shear2",i)
-            convname = self.get_filename("conv",i)
-            shear1hdu = pyfits.open(shear1name)
-            temp_shear1map = shear1hdu[0].data
-            shear1hdu.close()
-            shear2hdu = pyfits.open(shear2name)
-            temp_shear2map = shear2hdu[0].data
-            shear2hdu.close()
-            convhdu = pyfits.open(convname)
-            temp_convmap = convhdu[0].data
-            convhdu.close()
-    ### now, the maps have to be in a 1D array! not 2D matrix. bummer. 
-            
-            for xx in range(0, int(self.NbinsX)):
-                for yy in range(0, int(self.NbinsY)):
-                    idx = int(self.NbinsY*xx + yy)
-                    
-                    self.shear1map[i][idx] = temp_shear1map[xx][yy]
-                    self.shear2map[i][idx] = temp_shear2map[xx][yy]
-                    self.convmap[i][idx] = temp_convmap[xx][yy]
-            del(temp_shear1map)
-            del(temp_shear2map)
-            del(temp_convmap)
+        self.close()
+
+        ### load in the WL maps! 
+        if memmap:
+            maps = []
+            for i in range(0, self.number_of_maps):
+                maps.append([])
+                for basename in self.map_types:
+                    hdu = pyfits.open(self.get_filename(basename, i), memmap=True)
+                    self._map_files.append(hdu)
+                    maps[i].append(hdu[0].data)
+
+            self.set_maps(maps, stack=False)
+
+        else:
+            maps = None
+            for i in range(0, self.number_of_maps):
+                for k, basename in enumerate(self.map_types):
+                    hdu = pyfits.open(self.get_filename(basename, i))
+                    data = hdu[0].data
+                    if maps is None:
+                        ## FITS data are big-endian; keep the maps in native byte order
+                        maps = numpy.empty((self.number_of_maps, len(self.map_types)) + data.shape,
+                                           dtype=data.dtype.newbyteorder('='))
+                    maps[i, k] = data
+                    hdu.close()
+                    del(data)
+
+            self.set_maps(maps)
                         
         ### initialize dark energy. 
         initialize_darkenergy(self.w0, self.wa)
@@ -103,75 +114,168 @@ class WL:
         """ This is where we do all the calculating. 
         I have the ra/dec/z as input, in the form of numpy arrays. 
         I return arrays for shear1, shear2 and conv. 
+
+        The galaxies are processed calc_block_size at a time; for each block,
+        all of the galaxies, both redshift planes around each galaxy and all
+        three maps are interpolated at once.
         """
 
+        ra = numpy.asarray(ra, dtype=float)
+        dec = numpy.asarray(dec, dtype=float)
+        z = numpy.asarray(z, dtype=float)
+
         shear1 = numpy.empty(len(ra))
         shear2 = numpy.empty(len(ra))
         conv = numpy.empty(len(ra))
 
-        ## I'm gonna have to loop through these arrays, irritatingly. 
-        for g in range(0, len(ra)):
-            gal_x, gal_y = self.get_pixel_coordinates(ra[g], dec[g])
+        source_redshift = numpy.asarray(self.source_redshift, dtype=float)
 
-            i = 0
-            while self.source_redshift[i+1] < z[g] and i<self.number_of_maps-2:
-                i+=1
-        
+        for start in range(0, len(ra), self.calc_block_size):
+            block = slice(start, start+self.calc_block_size)
+            shear1[block], shear2[block], conv[block] = \
+                self._calc_block(source_redshift, ra[block], dec[block], z[block])
 
-            shear1map_close = self.shear1map[i]
-            shear2map_close = self.shear2map[i]
-            convmap_close = self.convmap[i]
-            shear1map_far = self.shear1map[i+1]
-            shear2map_far = self.shear2map[i+1]
-            convmap_far = self.convmap[i+1]
-            gal_z_close = self.source_redshift[i]
-            gal_z_far = self.source_redshift[i+1]
-            comoving_distance_close = self.comoving_distance[i]
-            comoving_distance_far = self.comoving_distance[i+1]
-            
-    # interpolate shear from close and far shear maps
-    
-            shear1_close = get_interpolated_value(shear1map_close, self.NbinsX, self.NbinsY, gal_x, gal_y)
-            shear2_close = get_interpolated_value(shear2map_close, self.NbinsX, self.NbinsY, gal_x, gal_y)
-            conv_close = get_interpolated_value(convmap_close, self.NbinsX, self.NbinsY, gal_x, gal_y)
-            shear1_far = get_interpolated_value(shear1map_far, self.NbinsX, self.NbinsY, gal_x, gal_y)
-            shear2_far = get_interpolated_value(shear2map_far, self.NbinsX, self.NbinsY, gal_x, gal_y)
-            conv_far = get_interpolated_value(convmap_far, self.NbinsX, self.NbinsY, gal_x, gal_y)
-        
+        return shear1, shear2, conv
+
+    def _calc_block(self, source_redshift, ra, dec, z):
+        """ Do the calculation of calc for one block of galaxies.
+        """
+        gal_x, gal_y = self.get_pixel_coordinates(ra, dec)
+
+        ## the redshift planes close to and far from the galaxy: the
+        ## first plane i such that source_redshift[i+1] >= z, with
+        ## the last pair of planes used for all of the higher redshifts
+        i = numpy.searchsorted(source_redshift[1:], z, side='left')
+        i = numpy.minimum(i, len(source_redshift)-2)
+
+        npix = int(self.NbinsX*self.NbinsY)
+        if len(ra) > 0:
+            ## the bicubic stencil reaches two rows and two columns beyond
+            ## the lower left pixel of the cell
+            last_pixel = (numpy.floor(gal_y)*self.NbinsX + numpy.floor(gal_x)).max() + 2 + 2*self.NbinsX
+            if last_pixel >= npix:
+                raise IndexError("galaxy position excedes range of WL maps")
+
+        ## interpolate shear from close and far shear maps, in one go
+        values = self._interpolate_maps(numpy.concatenate([i, i+1]),
+                                        numpy.concatenate([gal_x, gal_x]),
+                                        numpy.concatenate([gal_y, gal_y]))
+        close = values[:, :len(ra)]
+        far = values[:, len(ra):]
+
+        ## this is not used for anything. So leave it out for now. 
+        ##gal_comoving_distance = calculate_comoving_distance( 1.0/(1.0+z[g]), self.Omega_m, self.Omega_Lambda, self.w0, self.wa)
+
+        gal_z_close = source_redshift[i]
+        gal_z_far = source_redshift[i+1]
+        shear1, shear2, conv = weight_shear_2(z, gal_z_close, gal_z_far, close, far)
 
-            ## this is not used for anything. So leave it out for now. 
-            ##gal_comoving_distance = calculate_comoving_distance( 1.0/(1.0+z[g]), self.Omega_m, self.Omega_Lambda, self.w0, self.wa)
-            
-            shear1[g] = weight_shear_2(z[g], gal_z_close, gal_z_far, shear1_close, shear1_far)
-            shear2[g] = weight_shear_2(z[g], gal_z_close, gal_z_far, shear2_close, shear2_far)
-            conv[g] = weight_shear_2(z[g], gal_z_close, gal_z_far, conv_close, conv_far)
-
-            del(shear1map_close)
-            del(shear2map_close)
-            del(convmap_close)
-            del(shear1map_far)
-            del(shear2map_far)
-            del(convmap_far)
-
-        #self.shear1map = []
-        #self.shear2map = []
-        #self.convmap = []
         return shear1, shear2, conv
 
+    def _interpolate_maps(self, plane, x, y):
+        """ Interpolate all of the map types at the pixel coordinates x, y,
+        each point in the redshift plane given by the array plane.
+        Returns an array of shape (len(map_types), len(x)).
+        """
+        n_types = len(self.map_types)
+        npix = int(self.NbinsX*self.NbinsY)
+
+        if isinstance(self.maps, numpy.ndarray) and self.coefficients is None:
+            ## one gather from the flattened array of all of the maps,
+            ## in which the offset of map type k of plane i is (i*n_types + k)*npix
+            offset = (plane[numpy.newaxis, :]*n_types + numpy.arange(n_types)[:, numpy.newaxis])*npix
+            return get_interpolated_values(self.maps.reshape(-1), self.NbinsX, self.NbinsY,
+                                           x, y, offset=offset)
+
+        ## interpolate map by map: either from the cached coefficients or,
+        ## if the maps are separate (memory-mapped) arrays, from the pixels
+        ## of every map around the points that need it
+        values = numpy.empty((n_types, len(x)))
+        for i in numpy.unique(plane):
+            in_plane = numpy.where(plane == i)[0]
+            for k in range(n_types):
+                if self.coefficients is not None:
+                    values[k, in_plane] = get_coefficient_interpolated_values(self.coefficients[i][k],
+                                                                              x[in_plane], y[in_plane])
+                else:
+                    values[k, in_plane] = get_interpolated_values(self.maps[i][k].reshape(-1),
+                                                                  self.NbinsX, self.NbinsY,
+                                                                  x[in_plane], y[in_plane])
+        return values
+
+    def cache_coefficients(self, tile_size=64, max_tiles=None, precompute=False):
+        """ Keep the bicubic coefficients of the cells of the maps (see
+        interpolation.BicubicCoefficients), so that calc only has to gather
+        them instead of computing them from the pixels around every galaxy.
+
+        If precompute is True, the coefficients of all of the cells are
+        computed now (this takes 16 times the memory of float64 maps).
+        Otherwise they are computed tile_size x tile_size cells at a time,
+        when a galaxy first falls in a tile, and at most max_tiles tiles
+        (None means no limit) are kept for each map.
+
+        The cache is dropped by set_maps (and initialize); setting
+        coefficients to None drops it too.
+        """
+        self.coefficients = [[BicubicCoefficients(self.maps[i][k].reshape(-1), self.NbinsX, self.NbinsY,
+                                                  tile_size=tile_size, max_tiles=max_tiles,
+                                                  precompute=precompute)
+                              for k in range(len(self.map_types))]
+                             for i in range(len(self.maps))]
+
+    def set_maps(self, maps, stack=True):
+        """ Set the WL maps. maps is an array (or nested sequence) of shape
+        (number_of_maps, len(map_types), NbinsY, NbinsX); it is used as it
+        is if it is a contiguous float32 or float64 numpy array.
+        shear1map, shear2map and convmap are set to views of maps in which
+        the map of every redshift plane is flattened.
+
+        If stack is False, maps must be nested lists (maps[i][k] is the map
+        of type k of plane i) of contiguous 2D arrays, e.g. memory-mapped FITS
+        data; they are used as they are, without being read in and stacked.
+        """
+        self.coefficients = None
+
+        if not stack:
+            self.maps = maps
+            self.shear1map, self.shear2map, self.convmap = \
+                [[maps[i][k].reshape(-1) for i in range(len(maps))] for k in range(len(self.map_types))]
+            return
+
+        maps = numpy.asarray(maps)
+        if maps.dtype not in (numpy.float32, numpy.float64):
+            maps = maps.astype(numpy.float64)
+        self.maps = numpy.ascontiguousarray(maps)
+
+        planes = self.maps.reshape(self.maps.shape[0], self.maps.shape[1], -1)
+        self.shear1map = planes[:, 0]
+        self.shear2map = planes[:, 1]
+        self.convmap = planes[:, 2]
+
+    def close(self):
+        """ Close the memory-mapped map files (see initialize), if any,
+        and forget the maps that were read from them.
+        """
+        if len(self._map_files) == 0:
+            return
+
+        self.maps = None
+        self.coefficients = None
+        self.shear1map, self.shear2map, self.convmap = [], [], []
+        for hdu in self._map_files:
+            hdu.close()
+        self._map_files = []
+
 
 
     
 
 
     def get_filename(self, basename, z):
-        """ This is unlikely to be used as originally intended, 
-        as we won't be reading in more than one set of WL maps yet. 
+        """ Returns the path of the map basename ('shear1', 'shear2' or
+        'conv') of redshift plane number z (see WLMapSet.get_filename)
         """
-
-        redshift_tag = int(math.floor(100*self.source_redshift[z]))
-        filename = "/astro/net/lsst1/shared/djbard/mirrored/WL-"+basename+"_m-512b240_Om0.260_Ol0.740_w-1.000_ns0.960_si0.798_4096xy_0001r_00"+str(self.last_plane[z])+"p_0"+str(redshift_tag)+"z_og.gre_X4_smaller.fit"
-
-        return filename
+        return self.map_set.get_filename(basename, z)
 
 
 
@@ -179,17 +283,19 @@ class WL:
     def get_pixel_coordinates(self, ra, dec):
         """ Returns pixel coord for WL maps. Note that we repeat the 
         same WL map periodically across the sky - not ideal! 
+        ra (in hours) and dec can be numbers or numpy arrays; for
+        numbers, x and y are returned as floats.
         """
         MINSIZE = 1.0e-8
-        if ra>=12:
-            ra-= 24.0
+        is_scalar = numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0
+        ra = numpy.where(ra>=12, ra-24.0, ra)
         xx = ra* (360.0/24.0) * (self.NbinsX/self.survey_angle) + (self.NbinsX/2.0)
         yy = dec * (self.NbinsY/self.survey_angle) + (self.NbinsX/2.0)
 
  ### make it periodic....
-        multiple = math.floor(xx/self.NbinsX)
+        multiple = numpy.floor(xx/self.NbinsX)
         x = xx - multiple*self.NbinsX 
-        multiple = math.floor(yy/self.NbinsX)
+        multiple = numpy.floor(yy/self.NbinsX)
         y = yy - multiple*self.NbinsX
 
 
@@ -203,16 +309,9 @@ class WL:
         #    print "galaxy dec position excedes range of WL maps", dec, yy, y
        
         
-        if x<1.0:
-            x = 1.0
-        if x>= self.NbinsX-2.0+MINSIZE:
-            x = self.NbinsX-2.0+MINSIZE
-        if y<1.0:
-            y = 1.0
-        if y>= self.NbinsY-2.0+MINSIZE:
-            y = self.NbinsY-2.0+MINSIZE
-    
-        return x,y
-
-
+        x = numpy.clip(x, 1.0, self.NbinsX-2.0+MINSIZE)
+        y = numpy.clip(y, 1.0, self.NbinsY-2.0+MINSIZE)
 
+        if is_scalar:
+            return float(x), float(y)
+        return x,y
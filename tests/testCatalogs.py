@@ -32,6 +32,29 @@ class TransformationCatalog(InstanceCatalog):
     transformations = {'raJ2000':twice_fn}
 
 
+class SharedColumnCatalog(InstanceCatalog):
+    catalog_type = 'shared_column_catalog'
+    refIdCol = 'id'
+    column_outputs = ['id', 'raJ2000', 'decJ2000', 'doubleRa', 'raOffset']
+    default_formats = {'f':'%.12f'}
+    shared_columns = ['doubleRa']
+
+    def _pointing_ra(self):
+        # reads the pointing without going through the obs_metadata property
+        return self._obs_metadata.pointingRA
+
+    def get_doubleRa(self):
+        return 2.0*self.column_by_name('raJ2000')
+
+    def get_raOffset(self):
+        return self.column_by_name('raJ2000') - self._pointing_ra()
+
+
+class MisdeclaredSharedColumnCatalog(SharedColumnCatalog):
+    catalog_type = 'misdeclared_shared_column_catalog'
+    shared_columns = ['doubleRa', 'raOffset']
+
+
 class BasicCatalog(InstanceCatalog):
     catalog_type = 'basic_catalog'
     refIdCol = 'id'
@@ -435,6 +458,45 @@ class boundingBoxTest(unittest.TestCase):
         if os.path.exists(catName):
             os.unlink(catName)
 
+    def testSharedQuery(self):
+        """
+        Test that write_pointing_catalogs writes the same catalogs whether or
+        not the pointings share a single query
+        """
+        baseName = os.path.join(getPackageDir('sims_catalogs_measures'), 'tests',
+                                'scratchSpace', 'shared_query_test_%d_%s.txt')
+
+        obsList = [self.obsMdCirc, self.obsMdBox,
+                   ObservationMetaData(boundType='circle', pointingRA=self.RAcenter+5.0,
+                                       pointingDec=self.DECcenter-3.0, boundLength=self.radius,
+                                       mjd=52000., bandpassName='r')]
+
+        sharedNames = [baseName % (ix, 'shared') for ix in range(len(obsList))]
+        controlNames = [baseName % (ix, 'control') for ix in range(len(obsList))]
+
+        for catClass in (TransformationCatalog, SharedColumnCatalog):
+            catClass.write_pointing_catalogs(self.starDB, obsList, sharedNames,
+                                             chunk_size=20, shared_query=True)
+            catClass.write_pointing_catalogs(self.starDB, obsList, controlNames,
+                                             chunk_size=20)
+
+            for sharedName, controlName in zip(sharedNames, controlNames):
+                with open(sharedName, 'r') as input_file:
+                    sharedLines = input_file.readlines()
+                with open(controlName, 'r') as input_file:
+                    controlLines = input_file.readlines()
+
+                self.assertGreater(len(controlLines), 1)
+                self.assertEqual(sharedLines[0], controlLines[0])
+                self.assertEqual(sorted(sharedLines[1:]), sorted(controlLines[1:]))
+
+        # a column which reads the pointing cannot be computed once for all of them
+        self.assertRaises(AttributeError, MisdeclaredSharedColumnCatalog.write_pointing_catalogs,
+                          self.starDB, obsList, sharedNames, chunk_size=20, shared_query=True)
+
+        for name in sharedNames + controlNames:
+            if os.path.exists(name):
+                os.unlink(name)
 
 
 def suite():
@@ -224,6 +224,83 @@ class testColumnOrigins(unittest.TestCase):
         self.assertEqual(str(myCatalog._column_origins['cc']),self.mixin3Name)
         self.assertEqual(str(myCatalog._column_origins['dd']),self.mixin1Name)
 
+    def testColumnDispatch(self):
+        """
+        Test that the precomputed column dispatch agrees with the column origins
+        and gives the same columns as the introspection path of column_by_name
+        """
+        catalogClasses = [testCatalogDefaults, testCatalogMixin1, testCatalogMixin2,
+                          testCatalogMixin3, testCatalogMixin3Mixin1, testCatalogAunspecified]
+
+        for catClass in catalogClasses:
+            myCatalog = catClass(self.myDBobject)
+            for column in myCatalog.iter_column_names():
+                source = myCatalog._column_dispatch[column][0]
+                origin = myCatalog._column_origins[column]
+                if origin == 'the database':
+                    self.assertEqual(source, 'database')
+                elif origin == 'default column':
+                    self.assertEqual(source, 'default')
+                else:
+                    self.assertTrue(source in ('getter', 'compound'))
+
+            for chunk in self.myDBobject.query_columns(colnames=myCatalog._active_columns):
+                myCatalog._set_current_chunk(chunk)
+                dispatched = [myCatalog.column_by_name(col) for col in myCatalog.iter_column_names()]
+
+                dispatch = myCatalog._column_dispatch
+                myCatalog._column_dispatch = {}
+                myCatalog._set_current_chunk(chunk)
+                introspected = [myCatalog.column_by_name(col) for col in myCatalog.iter_column_names()]
+                myCatalog._column_dispatch = dispatch
+
+                for dispatchedCol, introspectedCol in zip(dispatched, introspected):
+                    numpy.testing.assert_array_equal(dispatchedCol, introspectedCol)
+
+    def testColumnIndex(self):
+        """
+        Test that the column index built by the metaclass agrees with the
+        attributes of the catalog classes and is rebuilt when a getter is added
+        """
+        index = testCatalogMixin3Mixin1._column_index
+        self.assertEqual(index.defining_classes['get_cc'], mixin3)
+        self.assertEqual(index.defining_classes['get_dd'], mixin1)
+        self.assertFalse('default_aa' in index.defining_classes)
+        self.assertTrue('cc' in index.getters)
+        self.assertTrue('dd' in index.defaults)
+        for name in dir(testCatalogMixin3Mixin1):
+            if name.startswith('get_'):
+                self.assertTrue(name[4:] in index.column_names)
+            elif name.startswith('default_'):
+                self.assertTrue(name[8:] in index.column_names)
+
+        index = testCatalogMixin2._column_index
+        self.assertEqual(index.compound_columns, {'both': ('cc', 'dd')})
+        self.assertEqual(index.compound_members, {'cc': 'get_both', 'dd': 'get_both'})
+        self.assertTrue(testCatalogMixin2.is_compound_column('both'))
+        self.assertFalse(testCatalogMixin2.is_compound_column('cc'))
+        self.assertFalse(testCatalogMixin1.is_compound_column('both'))
+
+        class reindexedCatalog(testCatalogMixin1):
+            pass
+
+        class reindexedChildCatalog(reindexedCatalog):
+            pass
+
+        def get_ee(self):
+            return self.column_by_name('aa')
+
+        self.assertFalse('ee' in reindexedChildCatalog._column_index.getters)
+        reindexedCatalog.get_ee = get_ee
+        self.assertTrue('ee' in reindexedCatalog._column_index.getters)
+        self.assertEqual(reindexedChildCatalog._column_index.defining_classes['get_ee'],
+                         reindexedCatalog)
+        myCatalog = reindexedChildCatalog(self.myDBobject, column_outputs=['ee'])
+        self.assertEqual(myCatalog._column_origins['ee'], reindexedCatalog)
+
+        del reindexedCatalog.get_ee
+        self.assertFalse('ee' in reindexedChildCatalog._column_index.getters)
+
 
 class myDummyCatalogClass(InstanceCatalog):
 
@@ -2,12 +2,14 @@ from __future__ import with_statement
 import os
 import numpy
 import unittest
+from collections import OrderedDict
 import lsst.utils.tests as utilsTests
 from lsst.utils import getPackageDir
 from lsst.sims.utils import ObservationMetaData
 from lsst.sims.catalogs.generation.db import fileDBObject, CatalogDBObject, CompoundCatalogDBObject
 from lsst.sims.catalogs.measures.instance import InstanceCatalog, \
                                                  CompoundInstanceCatalog
+from lsst.sims.catalogs.measures.instance.CompoundInstanceCatalog import _ChunkColumnView
 
 class negativeRaCompound(CompoundCatalogDBObject):
 
@@ -137,6 +139,26 @@ class Cat4(Cat3):
         return self.column_by_name('id')+4000
 
 
+class chunkAccessCat(Cat1):
+    """
+    Reads self._current_chunk directly (by attribute, size, shape and by
+    row) rather than through column_by_name
+    """
+
+    def get_testId(self):
+        chunk = self._current_chunk
+        return chunk.id[:chunk.size] + numpy.zeros(chunk.shape, dtype=int) + 5000
+
+    def get_raObs(self):
+        chunk = self._current_chunk
+        raObs = numpy.zeros(len(chunk))
+        even = chunk['id'] % 2 == 0
+        raObs[even] = chunk[even].raJ2000
+        for ix in numpy.nonzero(numpy.logical_not(even))[0]:
+            raObs[ix] = chunk[ix]['raJ2000']
+        return raObs
+
+
 class CompoundCatalogTest(unittest.TestCase):
 
     @classmethod
@@ -298,6 +320,132 @@ class CompoundCatalogTest(unittest.TestCase):
 
 
 
+    def testChunkedCompoundCatalog(self):
+        """
+        Test that, when written in chunks, a CompoundInstanceCatalog writes
+        each chunk of each of its InstanceCatalogs in turn, exactly as the
+        InstanceCatalogs would have written them
+        """
+        fileName = os.path.join(self.baseDir, 'chunked_compound_catalog.txt')
+        controlName = os.path.join(self.baseDir, 'chunked_compound_control.txt')
+        chunk_size = 30
+
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2], [table1DB1, table1DB2])
+        compoundCat.write_catalog(fileName, chunk_size=chunk_size)
+
+        with open(fileName, 'r') as input_file:
+            lines = input_file.readlines()
+
+        controlChunks = []
+        for catClass, dbClass in zip([Cat1, Cat2], [table1DB1, table1DB2]):
+            cat = catClass(dbClass())
+            cat.write_catalog(controlName, chunk_size=chunk_size, write_header=False)
+            with open(controlName, 'r') as input_file:
+                controlLines = input_file.readlines()
+            controlChunks.append([controlLines[ix:ix+chunk_size]
+                                  for ix in range(0, len(controlLines), chunk_size)])
+
+        expectedLines = []
+        for chunk1, chunk2 in zip(*controlChunks):
+            expectedLines += chunk1 + chunk2
+
+        self.assertEqual(len(lines), 2*len(self.table1Control)+1)
+        self.assertEqual(lines[1:], expectedLines)
+
+        for name in (fileName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testConcurrentCompoundCatalog(self):
+        """
+        Test that writing the groups of a CompoundInstanceCatalog concurrently
+        produces the same output as writing them one after the other
+        """
+        fileName = os.path.join(self.baseDir, 'concurrent_compound_catalog.txt')
+        controlName = os.path.join(self.baseDir, 'concurrent_compound_control.txt')
+
+        compoundCat = CompoundInstanceCatalog([Cat1, Cat2, Cat3, Cat4],
+                                              [table1DB1, table1DB2, table2DB1, table2DB2])
+        compoundCat.write_catalog(controlName, chunk_size=30)
+        with open(controlName, 'r') as input_file:
+            controlLines = input_file.readlines()
+
+        for concurrency in ('threads', 'processes'):
+            compoundCat.write_catalog(fileName, chunk_size=30, concurrency=concurrency)
+            with open(fileName, 'r') as input_file:
+                lines = input_file.readlines()
+            self.assertEqual(lines, controlLines)
+            self.assertEqual(len([line for line in lines if line.startswith('#')]), 1)
+
+        # the temporary segment files are gone
+        self.assertEqual([name for name in os.listdir(self.baseDir) if name.endswith('.segment')], [])
+
+        self.assertRaises(ValueError, compoundCat.write_catalog, fileName, concurrency='fibers')
+
+        for name in (fileName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testChunkColumnView(self):
+        """
+        Test that the view of a compound chunk given to each InstanceCatalog
+        renames the columns without copying them
+        """
+        chunk = numpy.rec.fromrecords([(1, 2.0, 3.0), (4, 5.0, 6.0)],
+                                      names=['id', 'db1_ra', 'db2_ra'])
+        view = _ChunkColumnView(chunk, OrderedDict([('id', 'id'), ('ra', 'db2_ra')]))
+
+        self.assertEqual(len(view), 2)
+        self.assertEqual(view.dtype.names, ('id', 'ra'))
+        numpy.testing.assert_array_equal(view['ra'], chunk['db2_ra'])
+        self.assertTrue(numpy.may_share_memory(view['ra'], chunk))
+        self.assertFalse(view['ra'].flags['WRITEABLE'])
+
+        # the columns can also be read as attributes
+        numpy.testing.assert_array_equal(view.ra, chunk['db2_ra'])
+        numpy.testing.assert_array_equal(view.field('id'), chunk['id'])
+        self.assertRaises(AttributeError, getattr, view, 'db1_ra')
+        self.assertEqual(view.size, 2)
+        self.assertEqual(view.shape, (2,))
+
+        # rows are selected as record arrays with the renamed columns
+        rows = view[numpy.array([False, True])]
+        self.assertEqual(rows.dtype.names, ('id', 'ra'))
+        numpy.testing.assert_array_equal(rows.ra, [6.0])
+        self.assertEqual(view[0]['ra'], 3.0)
+        self.assertEqual([row['id'] for row in view], [1, 4])
+
+        # the dtype can be shared between the views of successive chunks
+        other = _ChunkColumnView(chunk[1:], OrderedDict([('id', 'id'), ('ra', 'db2_ra')]), view.dtype)
+        self.assertTrue(other.dtype is view.dtype)
+
+    def testChunkAccess(self):
+        """
+        Test that a member catalog whose getters read self._current_chunk
+        directly writes the same rows as it does on its own
+        """
+        fileName = os.path.join(self.baseDir, 'compound_chunk_access_cat.txt')
+        controlName = os.path.join(self.baseDir, 'compound_chunk_access_control.txt')
+
+        compoundCat = CompoundInstanceCatalog([chunkAccessCat, Cat1], [table1DB1, table1DB2])
+        compoundCat.write_catalog(fileName, chunk_size=17)
+
+        controlLines = []
+        for catClass, dbClass in ((chunkAccessCat, table1DB1), (Cat1, table1DB2)):
+            catClass(dbClass()).write_catalog(controlName)
+            with open(controlName, 'r') as input_file:
+                controlLines.extend(line for line in input_file if not line.startswith('#'))
+
+        with open(fileName, 'r') as input_file:
+            lines = [line for line in input_file if not line.startswith('#')]
+
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(sorted(lines), sorted(controlLines))
+
+        for name in (fileName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
     def testObservationMetaData(self):
         """
         Test that CompoundInstanceCatalog handles ObservationMetaData
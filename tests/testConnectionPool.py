@@ -0,0 +1,137 @@
+from __future__ import with_statement
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.sims.catalogs.measures.instance import ConnectionPool
+
+
+class cartoonEngine(object):
+
+    def __init__(self):
+        self.disposed = False
+
+    def dispose(self):
+        self.disposed = True
+
+
+class cartoonConnection(object):
+    """
+    Mimics the connection of a CatalogDBObject
+    """
+
+    def __init__(self, database, driver, host, port, verbose):
+        self.database = database
+        self.driver = driver
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.engine = cartoonEngine()
+
+
+def makeDBObjectClass(database, driver='sqlite', host=None, port=None):
+    """
+    Return a class which mimics a CatalogDBObject class connecting
+    to the specified database
+    """
+
+    class cartoonDBObject(object):
+        verbose = False
+
+        def __init__(self, connection=None):
+            if connection is None:
+                connection = cartoonConnection(self.database, self.driver,
+                                               self.host, self.port, self.verbose)
+                cartoonDBObject.opened += 1
+            self.connection = connection
+
+    cartoonDBObject.database = database
+    cartoonDBObject.driver = driver
+    cartoonDBObject.host = host
+    cartoonDBObject.port = port
+    cartoonDBObject.opened = 0
+    return cartoonDBObject
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    def testConnectionKey(self):
+        """
+        Test that equivalent connection parameters give the same key
+        """
+        key1 = ConnectionPool.connection_key(database='db', driver='MSSQL+pymssql ',
+                                             host='LocalHost', port='1433')
+        key2 = ConnectionPool.connection_key(database=''.join(['d', 'b']), driver='mssql+pymssql',
+                                             host='localhost', port=1433)
+        self.assertEqual(key1, key2)
+
+        key3 = ConnectionPool.connection_key(database='db', driver='mssql+pymssql',
+                                             host='localhost', port=1434)
+        self.assertNotEqual(key1, key3)
+
+    def testSharedConnection(self):
+        """
+        Test that CatalogDBObjects with equal connection parameters share
+        one connection
+        """
+        dbClass1 = makeDBObjectClass('test.db')
+        dbClass2 = makeDBObjectClass(''.join(['test', '.db']))
+        dbClass3 = makeDBObjectClass('other.db')
+
+        with ConnectionPool() as pool:
+            dbo1 = pool.get_db_object(dbClass1)
+            dbo2 = pool.get_db_object(dbClass2)
+            dbo3 = pool.get_db_object(dbClass3)
+            self.assertTrue(dbo1.connection is dbo2.connection)
+            self.assertFalse(dbo1.connection is dbo3.connection)
+            self.assertEqual(dbClass1.opened, 1)
+            self.assertEqual(dbClass2.opened, 0)
+            self.assertEqual(len(pool), 2)
+            self.assertTrue(pool.get_connection(dbClass3) is dbo3.connection)
+
+        # leaving the with block closes all of the connections
+        self.assertEqual(len(pool), 0)
+        self.assertTrue(dbo1.connection.engine.disposed)
+        self.assertTrue(dbo3.connection.engine.disposed)
+
+    def testMaxConnections(self):
+        """
+        Test that the least recently used connection is closed when the
+        pool is full
+        """
+        dbClassList = [makeDBObjectClass('test%d.db' % ix) for ix in range(3)]
+
+        pool = ConnectionPool(max_connections=2)
+        dbo0 = pool.get_db_object(dbClassList[0])
+        dbo1 = pool.get_db_object(dbClassList[1])
+        pool.get_db_object(dbClassList[0])
+        dbo2 = pool.get_db_object(dbClassList[2])
+
+        self.assertEqual(len(pool), 2)
+        self.assertTrue(dbo1.connection.engine.disposed)
+        self.assertFalse(dbo0.connection.engine.disposed)
+        self.assertTrue(pool.get_connection(dbClassList[1]) is None)
+        self.assertTrue(pool.get_connection(dbClassList[2]) is dbo2.connection)
+        pool.close()
+
+        self.assertRaises(ValueError, ConnectionPool, max_connections=0)
+
+    def testDefaultPool(self):
+        """
+        Test that there is one default pool per process
+        """
+        self.assertTrue(ConnectionPool.default() is ConnectionPool.default())
+
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+    suites = []
+    suites += unittest.makeSuite(ConnectionPoolTestCase)
+
+    return unittest.TestSuite(suites)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)
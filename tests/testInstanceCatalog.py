@@ -1,13 +1,16 @@
 import os
 import numpy
 import sqlite3
+import threading
 import unittest
+import pyfits
 import lsst.utils.tests as utilsTests
 from collections import OrderedDict
 from lsst.sims.utils import ObservationMetaData
 from lsst.sims.catalogs.generation.db import CatalogDBObject
 from lsst.sims.catalogs.generation.utils import myTestStars, makeStarTestDB
-from lsst.sims.catalogs.measures.instance import InstanceCatalog, is_null
+from lsst.sims.catalogs.measures.instance import InstanceCatalog, is_null, compound, \
+                                                 chunk_invariant, metadata_only
 from lsst.sims.utils import Site
 
 def createCannotBeNullTestDB(filename=None, add_nans=True):
@@ -137,6 +140,114 @@ class cartoonValueCatalog(InstanceCatalog):
         y = self.column_by_name('n3')
         return x-y
 
+class intermediateColumnCatalog(InstanceCatalog):
+    """
+    This catalog counts how many times its (uncached) intermediate
+    column 'total' is computed
+    """
+    column_outputs = ['id', 'doubleTotal', 'totalPlusN1']
+    default_formats = {'f': '%le'}
+    total_calls = 0
+
+    def get_total(self):
+        intermediateColumnCatalog.total_calls += 1
+        return self.column_by_name('n1') + self.column_by_name('n2')
+
+    def get_doubleTotal(self):
+        return 2.0*self.column_by_name('total')
+
+    def get_totalPlusN1(self):
+        return self.column_by_name('total') + self.column_by_name('n1')
+
+class mutatingColumnCatalog(intermediateColumnCatalog):
+    """
+    This catalog has getters which modify the columns they ask for in place
+    """
+    column_outputs = ['id', 'n1', 'doubleTotal', 'totalPlusOne', 'n1Squared']
+
+    def get_totalPlusOne(self):
+        total = self.column_by_name('total')
+        total += 1.0
+        return total
+
+    def get_n1Squared(self):
+        n1 = self.column_by_name('n1')
+        n1 *= n1
+        return n1
+
+class cachedColumnCatalog(InstanceCatalog):
+    """
+    This catalog reads its compound columns from the column cache twice per chunk
+    """
+    column_outputs = ['id', 'sumN', 'diffN', 'sumSquared']
+    default_formats = {'f': '%le'}
+    memoize_columns = False
+
+    @compound('sumN', 'diffN')
+    def get_sumAndDiff(self):
+        n1 = self.column_by_name('n1')
+        n2 = self.column_by_name('n2')
+        return numpy.array([n1+n2, n1-n2])
+
+    def get_sumSquared(self):
+        return self.column_by_name('sumN')**2
+
+class invariantColumnCatalog(InstanceCatalog):
+    """
+    This catalog counts how many times its invariant columns are computed
+    """
+    column_outputs = ['id', 'pointingRA', 'bandpass', 'shiftedN1']
+    calls = {'pointingRA': 0, 'bandpass': 0}
+
+    @metadata_only
+    def get_pointingRA(self):
+        invariantColumnCatalog.calls['pointingRA'] += 1
+        return self.obs_metadata.pointingRA
+
+    @chunk_invariant
+    def get_bandpass(self):
+        invariantColumnCatalog.calls['bandpass'] += 1
+        return numpy.array([self.obs_metadata.bandpass]*len(self._current_chunk))
+
+    def get_shiftedN1(self):
+        return self.column_by_name('n1') + self.column_by_name('pointingRA')
+
+class metadataDependencyCatalog(InstanceCatalog):
+    """
+    This catalog has a @metadata_only column which asks for a database column
+    """
+    column_outputs = ['id', 'n1Kind']
+
+    @metadata_only
+    def get_n1Kind(self):
+        return '%s_%s' % (self.obs_metadata.bandpass, self.column_by_name('n1').dtype.kind)
+
+class defaultColumnCatalog(InstanceCatalog):
+    """
+    This catalog writes columns which are filled from default_columns
+    """
+    column_outputs = ['id', 'dflt', 'n1', 'label', 'zero', 'source']
+    default_columns = [('dflt', 2.5, float), ('label', 'star', (str, 4)), ('source', 'CCM', str)]
+
+    def get_zero(self):
+        return numpy.zeros(len(self.column_by_name('id')))
+
+class growingStringCatalog(InstanceCatalog):
+    """
+    This catalog has a string column whose strings are longer in the
+    later rows of the database than in the first ones
+    """
+    column_outputs = ['id', 'label']
+
+    def get_label(self):
+        return numpy.array(['x'*(1+ix//50) for ix in self.column_by_name('id')])
+
+class declaredStringCatalog(growingStringCatalog):
+    """
+    This catalog declares the width of its growing string column
+    """
+    column_dtypes = {'label': (str, 2)}
+
 class InstanceCatalogMetaDataTest(unittest.TestCase):
     """
     This class will test how Instance catalog handles the metadata
@@ -299,6 +410,446 @@ class InstanceCatalogMetaDataTest(unittest.TestCase):
         if os.path.exists('valueTestDB.db'):
             os.unlink('valueTestDB.db')
 
+    def testColumnAnalysisCache(self):
+        """
+        Test that catalogs of the same class, on the same database and with
+        the same columns reuse the analysis of the columns done by the first
+        """
+        class analysisCacheCatalog(InstanceCatalog):
+            column_outputs = ['n1', 'n2', 'difference']
+            def get_difference(self):
+                n1 = self.column_by_name('n1')
+                n3 = self.column_by_name('n3')
+                return n1-n3
+
+        dbName = 'analysisTestDB.db'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        cat1 = analysisCacheCatalog(db)
+
+        calls = []
+        original = analysisCacheCatalog.db_required_columns
+        def counted(self):
+            calls.append(1)
+            return original(self)
+        analysisCacheCatalog.db_required_columns = counted
+
+        cat2 = analysisCacheCatalog(db)
+        self.assertEqual(len(calls), 0)
+        self.assertEqual(cat2._column_origins, cat1._column_origins)
+        self.assertEqual(cat2._actually_calculated_columns, cat1._actually_calculated_columns)
+        self.assertFalse(cat2._actually_calculated_columns is cat1._actually_calculated_columns)
+
+        # a different set of columns is analyzed afresh
+        cat3 = analysisCacheCatalog(db, column_outputs=['n3'])
+        self.assertEqual(len(calls), 1)
+        self.assertTrue('n3' in cat3.iter_column_names())
+
+        # only the most recently used analyses are kept
+        analysisCacheCatalog.column_analysis_cache_size = 2
+        analysisCacheCatalog(db, column_outputs=['n4'])
+        self.assertEqual(len(calls), 2)
+        analysisCacheCatalog(db, column_outputs=['n3'])
+        self.assertEqual(len(calls), 2)
+        analysisCacheCatalog(db)
+        self.assertEqual(len(calls), 3)
+
+        # the analyses can be forgotten
+        analysisCacheCatalog(db)
+        self.assertEqual(len(calls), 3)
+        InstanceCatalog.clear_column_analysis_cache()
+        analysisCacheCatalog(db)
+        self.assertEqual(len(calls), 4)
+
+        # a catalog of a class which turns the cache off is always analyzed afresh
+        analysisCacheCatalog.cache_column_analysis = False
+        analysisCacheCatalog(db)
+        self.assertEqual(len(calls), 5)
+
+        if os.path.exists(dbName):
+            os.unlink(dbName)
+
+    def testColumnAnalysisCacheThreads(self):
+        """
+        Test that catalogs of the same class can be created by several threads
+        at once while they share (and evict from) the column analysis cache
+        """
+        class threadedAnalysisCatalog(InstanceCatalog):
+            column_outputs = ['n1', 'n2', 'difference']
+            column_analysis_cache_size = 2
+            def get_difference(self):
+                return self.column_by_name('n1')-self.column_by_name('n3')
+
+        dbName = 'threadedAnalysisTestDB.db'
+        createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        column_outputs = [None, ['n1', 'difference'], ['n3'], ['n4', 'n2']]
+        controls = []
+        for outputs in column_outputs:
+            cat = threadedAnalysisCatalog(db, column_outputs=outputs)
+            controls.append((list(cat.iter_column_names()), cat._actually_calculated_columns))
+
+        start = threading.Event()
+        errors = []
+        def build(i_thread):
+            start.wait()
+            try:
+                for i_cat in range(100):
+                    i_outputs = (i_thread+i_cat) % len(column_outputs)
+                    cat = threadedAnalysisCatalog(db, column_outputs=column_outputs[i_outputs])
+                    self.assertEqual((list(cat.iter_column_names()), cat._actually_calculated_columns),
+                                     controls[i_outputs])
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=build, args=(i_thread,)) for i_thread in range(8)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(threadedAnalysisCatalog._column_analysis_cache) <= 2)
+
+        if os.path.exists(dbName):
+            os.unlink(dbName)
+
+    def testColumnarFormatting(self):
+        """
+        Test that the columnar writer produces exactly the lines that
+        applying the row template to each row would produce
+        """
+        dbName = 'formatTestDB.db'
+        catName = 'formatTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=True)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        for chunk_size in (None, 7):
+            cat = CanBeNullCatalog(db)
+            cat.write_catalog(catName, chunk_size=chunk_size)
+            with open(catName, 'r') as input_file:
+                lines = input_file.readlines()
+
+            controlLines = [cat._template % line for line in cat.iter_catalog()]
+            self.assertEqual(len(lines), len(baselineData)+1)
+            self.assertEqual(lines[1:], controlLines)
+
+        if os.path.exists(dbName):
+            os.unlink(dbName)
+        if os.path.exists(catName):
+            os.unlink(catName)
+
+    def testDefaultColumns(self):
+        """
+        Test that default columns and other constant columns are written
+        correctly, and that default columns are only returned as read-only
+        views to the catalog writer
+        """
+        dbName = 'defaultTestDB.db'
+        catName = 'defaultTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        for chunk_size in (None, 7):
+            cat = defaultColumnCatalog(db)
+            cat.write_catalog(catName, chunk_size=chunk_size)
+            with open(catName, 'r') as input_file:
+                lines = input_file.readlines()
+
+            controlLines = [cat._template % line for line in cat.iter_catalog()]
+            self.assertEqual(len(lines), len(baselineData)+1)
+            self.assertEqual(lines[1:], controlLines)
+            for line in lines[1:]:
+                self.assertEqual(line.split(', ')[1], '2.5000')
+                self.assertEqual(line.split(', ')[3], 'star')
+                self.assertEqual(line.split(', ')[5], 'CCM\n')
+
+            for chunk_cols, colMap in cat.iter_catalog_chunks(chunk_size=chunk_size):
+                self.assertTrue(chunk_cols[colMap['dflt']].flags['WRITEABLE'])
+                numpy.testing.assert_array_equal(chunk_cols[colMap['dflt']],
+                                                 2.5*numpy.ones(len(chunk_cols[0])))
+                # an unsized string dtype takes the length of the default value
+                numpy.testing.assert_array_equal(chunk_cols[colMap['source']],
+                                                 numpy.array(['CCM']*len(chunk_cols[0])))
+
+        chunk = db.query_columns(colnames=cat._active_columns).next()
+        chunk_cols = cat._get_chunk_cols(chunk, read_only=True)
+        self.assertFalse(chunk_cols[1].flags['WRITEABLE'])
+        self.assertEqual(chunk_cols[3].dtype, numpy.dtype((str, 4)))
+        numpy.testing.assert_array_equal(chunk_cols[3], numpy.array(['star']*len(chunk)))
+
+        if os.path.exists(dbName):
+            os.unlink(dbName)
+        if os.path.exists(catName):
+            os.unlink(catName)
+
+    def testMemoizedColumns(self):
+        """
+        Test that an intermediate column needed by two getters is only
+        computed once per chunk, and that the catalog does not change
+        """
+        dbName = 'memoTestDB.db'
+        catName = 'memoTestCat.txt'
+        controlName = 'memoControlCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        cat = intermediateColumnCatalog(db)
+        self.assertEqual(cat._column_dependencies['doubleTotal'], ['total'])
+        self.assertEqual(cat._column_dependencies['totalPlusN1'], ['total', 'n1'])
+
+        intermediateColumnCatalog.total_calls = 0
+        cat.write_catalog(catName, chunk_size=10)
+        self.assertEqual(intermediateColumnCatalog.total_calls, 10+2) # 2 for db_required_columns
+
+        class unmemoizedCatalog(intermediateColumnCatalog):
+            memoize_columns = False
+
+        controlCat = unmemoizedCatalog(db)
+        intermediateColumnCatalog.total_calls = 0
+        controlCat.write_catalog(controlName, chunk_size=10)
+        self.assertEqual(intermediateColumnCatalog.total_calls, 20+2)
+
+        with open(catName, 'r') as input_file:
+            lines = input_file.readlines()
+        with open(controlName, 'r') as input_file:
+            controlLines = input_file.readlines()
+        self.assertEqual(lines, controlLines)
+
+        for name in (dbName, catName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testMutatingGetter(self):
+        """
+        Test that getters which modify the (memoized) columns they ask for
+        in place do not change the other columns
+        """
+        dbName = 'mutatingTestDB.db'
+        catName = 'mutatingTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        cat = mutatingColumnCatalog(db)
+        cat.write_catalog(catName, chunk_size=10)
+        rows = 0
+        for chunk_cols, colMap in cat.iter_catalog_chunks(chunk_size=10):
+            ids = chunk_cols[colMap['id']]
+            total = baselineData['n1'][ids] + baselineData['n2'][ids]
+            numpy.testing.assert_allclose(chunk_cols[colMap['n1']], baselineData['n1'][ids],
+                                          rtol=1.0e-10)
+            numpy.testing.assert_allclose(chunk_cols[colMap['doubleTotal']], 2.0*total, rtol=1.0e-10)
+            numpy.testing.assert_allclose(chunk_cols[colMap['totalPlusOne']], total+1.0, rtol=1.0e-10)
+            numpy.testing.assert_allclose(chunk_cols[colMap['n1Squared']],
+                                          baselineData['n1'][ids]**2, rtol=1.0e-10)
+            rows += len(ids)
+        self.assertEqual(rows, len(baselineData))
+
+        # the columns returned by iter_catalog_chunks are writeable
+        cat = intermediateColumnCatalog(db)
+        for chunk_cols, colMap in cat.iter_catalog_chunks(chunk_size=10):
+            for col in chunk_cols:
+                self.assertTrue(col.flags['WRITEABLE'])
+
+        for name in (dbName, catName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testColumnCache(self):
+        """
+        Test the bookkeeping of the column cache, and that limiting its
+        size does not change the catalog
+        """
+        dbName = 'cacheTestDB.db'
+        catName = 'cacheTestCat.txt'
+        controlName = 'cacheControlCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+
+        controlCat = cachedColumnCatalog(db)
+        controlCat.write_catalog(controlName, chunk_size=10)
+        info = controlCat.column_cache_info()
+        self.assertEqual(info['misses'], 10)
+        self.assertEqual(info['hits'], 20)
+        self.assertEqual(info['evictions'], 0)
+        self.assertEqual(info['nbytes'], 2*10*8)
+        self.assertEqual(info['max_bytes'], None)
+
+        class smallCacheCatalog(cachedColumnCatalog):
+            column_cache_max_bytes = 100
+
+        cat = smallCacheCatalog(db)
+        cat.write_catalog(catName, chunk_size=10)
+        info = cat.column_cache_info()
+        self.assertEqual(info['misses'], 30)
+        self.assertEqual(info['hits'], 0)
+        self.assertEqual(info['evictions'], 30)
+        self.assertEqual(info['nbytes'], 0)
+        self.assertEqual(info['max_bytes'], 100)
+
+        with open(catName, 'r') as input_file:
+            lines = input_file.readlines()
+        with open(controlName, 'r') as input_file:
+            controlLines = input_file.readlines()
+        self.assertEqual(lines, controlLines)
+
+        for name in (dbName, catName, controlName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testInvariantColumns(self):
+        """
+        Test that @chunk_invariant columns are computed once per catalog,
+        that @metadata_only columns are computed once per ObservationMetaData,
+        and that both are broadcast to every row
+        """
+        dbName = 'invariantTestDB.db'
+        catName = 'invariantTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+        obs = ObservationMetaData(pointingRA=25.0, pointingDec=-5.0, bandpassName='g')
+
+        dtype = numpy.dtype([('id', int), ('pointingRA', float), ('bandpass', (str, 1)),
+                             ('shiftedN1', float)])
+
+        # start from a fresh analysis of the columns
+        InstanceCatalog.clear_column_analysis_cache()
+
+        for ix in range(2):
+            invariantColumnCatalog.calls['pointingRA'] = 0
+            invariantColumnCatalog.calls['bandpass'] = 0
+
+            cat = invariantColumnCatalog(db, obs_metadata=obs)
+            cat.write_catalog(catName, chunk_size=10)
+
+            # twice for the introspection pass (as an output and for
+            # shiftedN1) and once for the first chunk; the second catalog
+            # reuses the analysis and the ObservationMetaData of the first
+            self.assertEqual(invariantColumnCatalog.calls['pointingRA'], 3 if ix==0 else 0)
+
+            # once for the introspection pass (which does not store the empty
+            # column; the second catalog reuses the analysis of the first)
+            # and once for the first chunk
+            self.assertEqual(invariantColumnCatalog.calls['bandpass'], 2 if ix==0 else 1)
+
+            testData = numpy.genfromtxt(catName, dtype=dtype, delimiter=', ')
+            self.assertEqual(len(testData), len(baselineData))
+            for testLine, controlLine in zip(testData, baselineData):
+                self.assertAlmostEqual(testLine['pointingRA'], 25.0, 4)
+                self.assertEqual(testLine['bandpass'], 'g')
+                self.assertAlmostEqual(testLine['shiftedN1'], controlLine['n1']+25.0, 4)
+
+        for name in (dbName, catName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testChangedMetaData(self):
+        """
+        Test that @metadata_only columns are computed afresh when the
+        ObservationMetaData they were computed for is modified
+        """
+        dbName = 'changedMetaDataTestDB.db'
+        catName = 'changedMetaDataTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+        obs = ObservationMetaData(pointingRA=25.0, pointingDec=-5.0, bandpassName='g')
+
+        dtype = numpy.dtype([('id', int), ('pointingRA', float), ('bandpass', (str, 1)),
+                             ('shiftedN1', float)])
+
+        # start from a fresh analysis of the columns (which calls
+        # get_pointingRA twice, see testInvariantColumns)
+        InstanceCatalog.clear_column_analysis_cache()
+
+        # the value is only shared with the previous catalog if the
+        # ObservationMetaData did not change in between
+        for pointingRA, calls in ((25.0, 3), (35.0, 1), (35.0, 0)):
+            invariantColumnCatalog.calls['pointingRA'] = 0
+            obs.pointingRA = pointingRA
+            cat = invariantColumnCatalog(db, obs_metadata=obs)
+            cat.write_catalog(catName, chunk_size=10)
+            self.assertEqual(invariantColumnCatalog.calls['pointingRA'], calls)
+
+            testData = numpy.genfromtxt(catName, dtype=dtype, delimiter=', ')
+            self.assertEqual(len(testData), len(baselineData))
+            for testLine, controlLine in zip(testData, baselineData):
+                self.assertAlmostEqual(testLine['pointingRA'], pointingRA, 4)
+                self.assertAlmostEqual(testLine['shiftedN1'], controlLine['n1']+pointingRA, 4)
+
+        for name in (dbName, catName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testMetaDataDependencies(self):
+        """
+        Test that the columns asked for by a @metadata_only column are queried
+        even if its value was already computed for the ObservationMetaData
+        """
+        dbName = 'metaDataDependencyTestDB.db'
+        catName = 'metaDataDependencyTestCat.txt'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+        obs = ObservationMetaData(pointingRA=25.0, pointingDec=-5.0, bandpassName='g')
+
+        cat = metadataDependencyCatalog(db, obs_metadata=obs)
+        cat.write_catalog(catName, chunk_size=10)
+
+        # another analysis of the columns, with the value already stored
+        InstanceCatalog.clear_column_analysis_cache()
+        cat = metadataDependencyCatalog(db, obs_metadata=obs)
+        self.assertTrue('n1' in cat._active_columns)
+
+        # the value is computed afresh, which needs n1
+        cat.obs_metadata.pointingRA = 35.0
+        cat.write_catalog(catName, chunk_size=10)
+        with open(catName, 'r') as input_file:
+            lines = [line for line in input_file if not line.startswith('#')]
+        self.assertEqual(len(lines), len(baselineData))
+        self.assertTrue(all(line.strip().endswith('g_f') for line in lines))
+
+        for name in (dbName, catName):
+            if os.path.exists(name):
+                os.unlink(name)
+
+    def testPointingCatalogs(self):
+        """
+        Test that write_pointing_catalogs writes, for each pointing, the
+        catalog that write_catalog would have written
+        """
+        dbName = 'pointingTestDB.db'
+        baselineData = createCannotBeNullTestDB(filename=dbName, add_nans=False)
+        db = myCannotBeNullDBObject(driver='sqlite', database=dbName)
+        obsList = [ObservationMetaData(pointingRA=ra, pointingDec=-5.0, bandpassName=band)
+                   for ra, band in zip((10.0, 20.0, 30.0), ('u', 'g', 'r'))]
+        catNames = ['pointingTestCat_%d.txt' % ix for ix in range(len(obsList))]
+
+        for n_workers in (None, 2):
+            invariantColumnCatalog.write_pointing_catalogs(db, obsList, 'pointingTestCat_%d.txt',
+                                                           chunk_size=10, n_workers=n_workers)
+
+            for obs, catName in zip(obsList, catNames):
+                with open(catName, 'r') as input_file:
+                    lines = input_file.readlines()
+
+                cat = invariantColumnCatalog(db, obs_metadata=obs)
+                cat.write_catalog(catName, chunk_size=10)
+                with open(catName, 'r') as input_file:
+                    controlLines = input_file.readlines()
+
+                self.assertEqual(len(lines), len(baselineData)+1)
+                self.assertEqual(lines, controlLines)
+                self.assertEqual(lines[1].split(', ')[2], obs.bandpass)
+
+        self.assertRaises(ValueError, invariantColumnCatalog.write_pointing_catalogs,
+                          db, obsList, catNames[:1])
+
+        for name in [dbName] + catNames:
+            if os.path.exists(name):
+                os.unlink(name)
+
 class InstanceCatalogCannotBeNullTest(unittest.TestCase):
 
         def setUp(self):
@@ -368,6 +919,251 @@ class InstanceCatalogCannotBeNullTest(unittest.TestCase):
             if os.path.exists(fileName):
                 os.unlink(fileName)
 
+        def testIterCatalogCannotBeNull(self):
+            """
+            Test that iter_catalog and iter_catalog_chunks drop the same rows
+            that write_catalog does
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog, unicodeCannotBeNullCatalog]
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            fileName = 'cannotBeNullIterTestFile.txt'
+
+            for catClass in availableCatalogs:
+                cat = catClass(dbobj)
+                cat.write_catalog(fileName)
+                with open(fileName, 'r') as input_file:
+                    lines = input_file.readlines()
+
+                rows = list(cat.iter_catalog(chunk_size=9))
+                self.assertEqual(len(rows), len(lines)-1)
+                self.assertTrue(len(rows) < len(self.baselineOutput))
+
+                nullDex = list(cat.iter_column_names()).index(cat.cannot_be_null[0])
+                for row in rows:
+                    self.assertFalse(is_null(row[nullDex]))
+
+                nChunkRows = 0
+                for chunk_cols, colMap in cat.iter_catalog_chunks(chunk_size=9):
+                    nChunkRows += len(chunk_cols[0])
+                    for value in chunk_cols[colMap[cat.cannot_be_null[0]]]:
+                        self.assertFalse(is_null(value))
+                self.assertEqual(nChunkRows, len(rows))
+
+            if os.path.exists(fileName):
+                os.unlink(fileName)
+
+        def testCatalogRows(self):
+            """
+            Test that iter_catalog_rows yields the rows of iter_catalog as
+            tuples (or namedtuples) of native Python values
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog,
+                                 unicodeCannotBeNullCatalog, CanBeNullCatalog]
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+
+            for catClass in availableCatalogs:
+                cat = catClass(dbobj)
+                controlRows = list(cat.iter_catalog(chunk_size=9))
+                rows = list(cat.iter_catalog_rows(chunk_size=9))
+                namedRows = list(cat.iter_catalog_rows(chunk_size=9, named=True))
+                self.assertEqual(len(rows), len(controlRows))
+                self.assertEqual(len(namedRows), len(controlRows))
+
+                for controlRow, row, namedRow in zip(controlRows, rows, namedRows):
+                    self.assertTrue(isinstance(row, tuple))
+                    self.assertEqual(namedRow._fields, tuple(cat.iter_column_names()))
+                    for k, value in enumerate(row):
+                        self.assertFalse(isinstance(value, numpy.generic))
+                        if k>0 and k<4 and numpy.isnan(controlRow[k]):
+                            self.assertTrue(numpy.isnan(value))
+                            self.assertTrue(numpy.isnan(namedRow[k]))
+                        else:
+                            self.assertEqual(value, controlRow[k])
+                            self.assertEqual(namedRow[k], controlRow[k])
+
+                    self.assertEqual(namedRow.id, row[0])
+
+        def testBinaryOutput(self):
+            """
+            Test that the npy and fits output formats contain the same rows
+            as iter_catalog
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog,
+                                 unicodeCannotBeNullCatalog, CanBeNullCatalog]
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            npyName = 'cannotBeNullBinaryTestFile.npy'
+            fitsName = 'cannotBeNullBinaryTestFile.fits'
+
+            for catClass in availableCatalogs:
+                cat = catClass(dbobj)
+                controlRows = list(cat.iter_catalog())
+                columnNames = list(cat.iter_column_names())
+
+                cat.write_catalog(npyName, chunk_size=11, output_format='npy')
+                npyData = numpy.load(npyName)
+
+                cat.write_catalog(fitsName, chunk_size=11, output_format='fits')
+                fitsFile = pyfits.open(fitsName)
+                fitsData = fitsFile[1].data
+
+                self.assertEqual(list(npyData.dtype.names), columnNames)
+                self.assertEqual(len(npyData), len(controlRows))
+                self.assertEqual(len(fitsData), len(controlRows))
+
+                for controlRow, npyRow, fitsRow in zip(controlRows, npyData, fitsData):
+                    for k, name in enumerate(columnNames):
+                        if k>0 and k<4:
+                            if numpy.isnan(controlRow[k]):
+                                self.assertTrue(numpy.isnan(npyRow[name]))
+                                self.assertTrue(numpy.isnan(fitsRow[name]))
+                            else:
+                                self.assertEqual(controlRow[k], npyRow[name])
+                                self.assertEqual(controlRow[k], fitsRow[name])
+                        else:
+                            self.assertEqual(controlRow[k], npyRow[name])
+                            self.assertEqual(controlRow[k], fitsRow[name])
+
+                fitsFile.close()
+
+            if os.path.exists(npyName):
+                os.unlink(npyName)
+            if os.path.exists(fitsName):
+                os.unlink(fitsName)
+
+        def testBinaryStringLength(self):
+            """
+            Test that the binary output formats do not truncate strings which
+            are longer than in the first chunk, and that the width of a string
+            column can be declared in column_dtypes
+            """
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            controlLabels = ['x'*(1+ix//50) for ix in range(len(self.baselineOutput))]
+
+            for outputFormat in ('npy', 'fits'):
+                fileName = 'cannotBeNullStringTestFile.%s' % outputFormat
+                cat = growingStringCatalog(dbobj)
+                self.assertRaises(ValueError, cat.write_catalog, fileName, chunk_size=11,
+                                  output_format=outputFormat)
+                self.assertFalse(os.path.exists(fileName))
+
+                cat = declaredStringCatalog(dbobj)
+                cat.write_catalog(fileName, chunk_size=11, output_format=outputFormat)
+                if outputFormat == 'npy':
+                    labels = numpy.load(fileName)['label']
+                else:
+                    fitsFile = pyfits.open(fileName)
+                    labels = fitsFile[1].data['label']
+                    fitsFile.close()
+                self.assertEqual(list(labels), controlLabels)
+
+                if os.path.exists(fileName):
+                    os.unlink(fileName)
+
+        def testCatalogBatches(self):
+            """
+            Test that iter_catalog_batches yields the rows of iter_catalog
+            as structured arrays (or dicts of arrays)
+            """
+            availableCatalogs = [floatCannotBeNullCatalog, strCannotBeNullCatalog,
+                                 unicodeCannotBeNullCatalog, CanBeNullCatalog]
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+
+            for catClass in availableCatalogs:
+                cat = catClass(dbobj)
+                controlRows = list(cat.iter_catalog())
+                columnNames = list(cat.iter_column_names())
+
+                batches = list(cat.iter_catalog_batches(chunk_size=11))
+                for batch in batches:
+                    self.assertEqual(list(batch.dtype.names), columnNames)
+                    self.assertEqual(batch.dtype, batches[0].dtype)
+                    self.assertTrue(batch.flags['C_CONTIGUOUS'])
+
+                dictBatches = list(cat.iter_catalog_batches(chunk_size=11, as_dict=True))
+                self.assertEqual(len(dictBatches), len(batches))
+                for batch, dictBatch in zip(batches, dictBatches):
+                    self.assertEqual(list(dictBatch.keys()), columnNames)
+                    for name in columnNames:
+                        self.assertEqual(len(dictBatch[name]), len(batch))
+                        self.assertTrue(dictBatch[name].flags['C_CONTIGUOUS'])
+
+                records = numpy.concatenate(batches)
+                self.assertEqual(len(records), len(controlRows))
+                for controlRow, record in zip(controlRows, records):
+                    for k, name in enumerate(columnNames):
+                        if k>0 and k<4 and numpy.isnan(controlRow[k]):
+                            self.assertTrue(numpy.isnan(record[name]))
+                        else:
+                            self.assertEqual(controlRow[k], record[name])
+
+            # strings longer than in the first batch are not truncated
+            controlLabels = ['x'*(1+ix//50) for ix in range(len(self.baselineOutput))]
+            cat = growingStringCatalog(dbobj)
+            self.assertRaises(ValueError, list, cat.iter_catalog_batches(chunk_size=11))
+            labels = []
+            for batch in cat.iter_catalog_batches(chunk_size=11, as_dict=True):
+                labels += list(batch['label'])
+            self.assertEqual(labels, controlLabels)
+
+            cat = declaredStringCatalog(dbobj)
+            records = numpy.concatenate(list(cat.iter_catalog_batches(chunk_size=11)))
+            self.assertEqual(list(records['label']), controlLabels)
+
+        def testParallelWrite(self):
+            """
+            Test that computing chunks in a pool of processes produces
+            the same catalog as computing them serially
+            """
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            serialName = 'cannotBeNullSerialTestFile.txt'
+            parallelName = 'cannotBeNullParallelTestFile.txt'
+
+            for catClass in [floatCannotBeNullCatalog, CanBeNullCatalog]:
+                cat = catClass(dbobj)
+                cat.write_catalog(serialName, chunk_size=7)
+                cat.write_catalog(parallelName, chunk_size=7, n_processes=3)
+
+                with open(serialName, 'r') as input_file:
+                    serialLines = input_file.readlines()
+                with open(parallelName, 'r') as input_file:
+                    parallelLines = input_file.readlines()
+
+                self.assertTrue(len(serialLines) > 1)
+                self.assertEqual(serialLines, parallelLines)
+
+            if os.path.exists(serialName):
+                os.unlink(serialName)
+            if os.path.exists(parallelName):
+                os.unlink(parallelName)
+
+        def testPipelinedWrite(self):
+            """
+            Test that prefetching chunks and writing them from background
+            threads produces the same catalog as the serial writer
+            """
+            dbobj = CatalogDBObject.from_objid('cannotBeNull')
+            serialName = 'cannotBeNullSerialTestFile.txt'
+            pipelinedName = 'cannotBeNullPipelinedTestFile.txt'
+
+            for depths in [(1, None), (None, 1), (3, 2)]:
+                cat = floatCannotBeNullCatalog(dbobj)
+                cat.write_catalog(serialName, chunk_size=7)
+                cat.write_catalog(pipelinedName, chunk_size=7,
+                                  prefetch_depth=depths[0], write_depth=depths[1])
+
+                with open(serialName, 'r') as input_file:
+                    serialLines = input_file.readlines()
+                with open(pipelinedName, 'r') as input_file:
+                    pipelinedLines = input_file.readlines()
+
+                self.assertTrue(len(serialLines) > 1)
+                self.assertEqual(serialLines, pipelinedLines)
+
+            if os.path.exists(serialName):
+                os.unlink(serialName)
+            if os.path.exists(pipelinedName):
+                os.unlink(pipelinedName)
+
         def testCanBeNull(self):
             """
             Test to make sure that we can still write all rows to catalogs,
@@ -0,0 +1,327 @@
+import os
+import shutil
+import numpy
+import pyfits
+import unittest
+import lsst.utils.tests as utilsTests
+from lsst.utils import getPackageDir
+from lsst.sims.catalogs.measures.weakLensing import WL, WLMapSet, get_interpolated_value, weight_shear_2
+from lsst.sims.catalogs.measures.weakLensing.interpolation import BicubicCoefficients, bicubic_coefficients
+
+
+def makeCartoonWL(nbins=64, seed=42, dtype=numpy.float64):
+    """
+    Return a WL whose maps are filled with random numbers (rather than
+    read from the WL map files)
+    """
+    rng = numpy.random.RandomState(seed)
+    wl = WL()
+    wl.NbinsX = nbins
+    wl.NbinsY = nbins
+    wl.survey_angle = 3.5
+    wl.source_redshift = [1.0, 1.5, 2.0]
+    wl.comoving_distance = [2370.3, 3152.481, 3759.214]
+    wl.set_maps(rng.normal(size=(wl.number_of_maps, 3, nbins, nbins)).astype(dtype))
+    return wl
+
+
+def writeCartoonMapSet(directory, redshifts, nbins=64, seed=99):
+    """
+    Write a map set with random maps at the given redshifts (in decreasing
+    order) in directory; the maps of plane i are named WL-<map type>_<i>.fit.
+    Return the array of the maps, in increasing order of redshift.
+    """
+    rng = numpy.random.RandomState(seed)
+    maps = rng.normal(size=(len(redshifts), 3, nbins, nbins)).astype(numpy.float32)
+
+    for i in range(len(redshifts)):
+        for k, mapType in enumerate(('shear1', 'shear2', 'conv')):
+            hdu = pyfits.PrimaryHDU(maps[len(redshifts)-1-i, k])
+            for key, value in (('MAP', nbins), ('H_0', 70.0), ('OMEGA_M', 0.26), ('OMEGA_L', 0.74),
+                               ('W_0', -1.0), ('W_A', 0.0), ('ANGLE', 3.5)):
+                hdu.header[key] = value
+            hdu.writeto(os.path.join(directory, 'WL-%s_%d.fit' % (mapType, i)))
+
+    return maps
+
+
+def scalarCalc(wl, ra, dec, z):
+    """
+    Calculate shear1, shear2 and conv one galaxy at a time
+    """
+    shear1 = numpy.empty(len(ra))
+    shear2 = numpy.empty(len(ra))
+    conv = numpy.empty(len(ra))
+
+    for g in range(len(ra)):
+        gal_x, gal_y = wl.get_pixel_coordinates(ra[g], dec[g])
+
+        i = 0
+        while wl.source_redshift[i+1] < z[g] and i<wl.number_of_maps-2:
+            i+=1
+
+        for output, maps in zip((shear1, shear2, conv), (wl.shear1map, wl.shear2map, wl.convmap)):
+            close = get_interpolated_value(maps[i], wl.NbinsX, wl.NbinsY, gal_x, gal_y)
+            far = get_interpolated_value(maps[i+1], wl.NbinsX, wl.NbinsY, gal_x, gal_y)
+            output[g] = weight_shear_2(z[g], wl.source_redshift[i], wl.source_redshift[i+1],
+                                       close, far)
+
+    return shear1, shear2, conv
+
+
+class WeakLensingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(17)
+        nGalaxies = 500
+        self.ra = rng.uniform(0.0, 24.0, nGalaxies)
+        self.dec = rng.uniform(-1.5, 1.5, nGalaxies)
+        self.z = rng.uniform(0.5, 2.5, nGalaxies)
+
+        # galaxies on the edges of the redshift planes and of the right ascension range
+        self.ra[:4] = [0.0, 12.0, 23.94, 11.99]
+        self.z[:5] = [1.0, 1.5, 2.0, 0.2, 3.0]
+
+    def testCalc(self):
+        """
+        Test that the vectorized calc agrees with the galaxy-by-galaxy calculation
+        """
+        wl = makeCartoonWL()
+        controlValues = scalarCalc(wl, self.ra, self.dec, self.z)
+
+        for blockSize in (len(self.ra), 37):
+            wl.calc_block_size = blockSize
+            testValues = wl.calc(self.ra, self.dec, self.z)
+            for test, control in zip(testValues, controlValues):
+                self.assertEqual(len(test), len(control))
+                numpy.testing.assert_allclose(test, control, rtol=1.0e-10, atol=1.0e-12)
+
+    def testMaps(self):
+        """
+        Test that the maps are stored as one array and that shear1map,
+        shear2map and convmap are flattened views of it
+        """
+        for dtype in (numpy.float32, numpy.float64):
+            wl = makeCartoonWL(dtype=dtype)
+            self.assertEqual(wl.maps.shape, (wl.number_of_maps, 3, wl.NbinsY, wl.NbinsX))
+            self.assertEqual(wl.maps.dtype, dtype)
+            self.assertTrue(wl.maps.flags['C_CONTIGUOUS'])
+            for k, maps in enumerate((wl.shear1map, wl.shear2map, wl.convmap)):
+                for i in range(wl.number_of_maps):
+                    self.assertTrue(numpy.may_share_memory(maps[i], wl.maps))
+                    numpy.testing.assert_array_equal(maps[i], wl.maps[i, k].ravel())
+
+            # the maps can be interpolated directly
+            x, y = 10.3, 20.7
+            self.assertEqual(get_interpolated_value(wl.maps[1, 2], wl.NbinsX, wl.NbinsY, x, y),
+                             get_interpolated_value(wl.convmap[1], wl.NbinsX, wl.NbinsY, x, y))
+
+            # float32 maps are interpolated in double precision
+            controlValues = scalarCalc(wl, self.ra, self.dec, self.z)
+            testValues = wl.calc(self.ra, self.dec, self.z)
+            for test, control in zip(testValues, controlValues):
+                numpy.testing.assert_allclose(test, control, rtol=1.0e-5, atol=1.0e-6)
+
+    def testUnstackedMaps(self):
+        """
+        Test that calc gives the same answers when the maps are separate
+        memory-mapped arrays (as with initialize(memmap=True)) as when they
+        are stacked in one array
+        """
+        wl = makeCartoonWL(dtype=numpy.float32)
+        controlValues = wl.calc(self.ra, self.dec, self.z)
+
+        fileName = os.path.join(getPackageDir('sims_catalogs_measures'), 'tests',
+                                'scratchSpace', 'wlMapsTest.dat')
+        mapFile = numpy.memmap(fileName, dtype='>f4', mode='w+', shape=wl.maps.shape)
+        mapFile[:] = wl.maps
+        mapFile.flush()
+        del mapFile
+
+        mapFile = numpy.memmap(fileName, dtype='>f4', mode='r', shape=wl.maps.shape)
+        wl.set_maps([[mapFile[i, k] for k in range(3)] for i in range(wl.number_of_maps)],
+                    stack=False)
+        self.assertFalse(isinstance(wl.maps, numpy.ndarray))
+        self.assertTrue(numpy.may_share_memory(wl.convmap[1], mapFile))
+
+        testValues = wl.calc(self.ra, self.dec, self.z)
+        for test, control in zip(testValues, controlValues):
+            numpy.testing.assert_array_equal(test, control)
+
+        del wl, mapFile
+        if os.path.exists(fileName):
+            os.unlink(fileName)
+
+    def testCachedCoefficients(self):
+        """
+        Test that calc gives the same answers from cached bicubic coefficients
+        and that the number of cached tiles is bounded
+        """
+        wl = makeCartoonWL()
+        controlValues = wl.calc(self.ra, self.dec, self.z)
+
+        for precompute, maxTiles in ((True, None), (False, None), (False, 3)):
+            wl.cache_coefficients(tile_size=16, max_tiles=maxTiles, precompute=precompute)
+            for ix in range(2):
+                testValues = wl.calc(self.ra, self.dec, self.z)
+                for test, control in zip(testValues, controlValues):
+                    numpy.testing.assert_allclose(test, control, rtol=1.0e-12, atol=1.0e-14)
+
+            for coefficients in wl.coefficients[0]:
+                if maxTiles is None:
+                    # the 64x64 map is cut into 4x4 tiles
+                    self.assertEqual(len(coefficients), 16 if precompute else coefficients.n_computed)
+                else:
+                    self.assertTrue(len(coefficients) <= maxTiles)
+                    self.assertTrue(coefficients.n_computed > 16)
+
+        self.assertRaises(ValueError, wl.cache_coefficients, max_tiles=3, precompute=True)
+
+        wl.set_maps(wl.maps)
+        self.assertTrue(wl.coefficients is None)
+
+    def testCoefficientPool(self):
+        """
+        Test that the pool of cached bicubic coefficients grows geometrically
+        when the tiles are loaded one at a time, and no further than max_tiles
+        """
+        nbins = 128
+        image = numpy.random.RandomState(7).normal(size=nbins*nbins)
+        # one cell in each of the 16x16 tiles (of 8x8 cells) of the map
+        cells = [(8*ty+3)*nbins + 8*tx+3 for ty in range(16) for tx in range(16)]
+
+        for maxTiles in (None, 5):
+            coefficients = BicubicCoefficients(image, nbins, nbins, tile_size=8, max_tiles=maxTiles)
+            pools = []
+            for cell in cells:
+                numpy.testing.assert_allclose(coefficients.coefficients(numpy.array([cell])),
+                                              bicubic_coefficients(image, nbins, numpy.array([cell])),
+                                              rtol=1.0e-12, atol=1.0e-14)
+                if len(pools) == 0 or coefficients._pool is not pools[-1]:
+                    pools.append(coefficients._pool)
+
+            if maxTiles is None:
+                # 1, 2, 4, ..., 256 tiles
+                self.assertEqual(len(pools), 9)
+                self.assertEqual(len(coefficients._pool), 256*64)
+            else:
+                # a call loads its tile before the least recently used one is dropped
+                self.assertEqual(len(coefficients._pool), 6*64)
+                self.assertEqual(len(coefficients), 5)
+
+    def testMapSet(self):
+        """
+        Test that WL reads the maps of a map set described by a manifest
+        or by a filename pattern, with any number of redshift planes
+        """
+        directory = os.path.join(getPackageDir('sims_catalogs_measures'), 'tests',
+                                 'scratchSpace', 'wlMapSetTest')
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+
+        redshifts = [2.5, 1.7, 1.2, 0.8]
+        maps = writeCartoonMapSet(directory, redshifts)
+
+        manifestName = os.path.join(directory, 'manifest.txt')
+        with open(manifestName, 'w') as output:
+            output.write('# redshift shear1 shear2 conv\n')
+            for i, z in enumerate(redshifts):
+                output.write('%f WL-shear1_%d.fit WL-shear2_%d.fit WL-conv_%d.fit\n' % (z, i, i, i))
+
+        patternSet = WLMapSet(directory, redshifts[::-1],
+                              filename_pattern='WL-{map_type}_{last_plane}.fit',
+                              last_plane=range(len(redshifts)-1, -1, -1))
+        manifestSet = WLMapSet.from_manifest(manifestName)
+        self.assertEqual(manifestSet.source_redshift, sorted(redshifts))
+
+        control = makeCartoonWL()
+        control.number_of_maps = len(redshifts)
+        control.source_redshift = sorted(redshifts)
+        control.set_maps(maps)
+        controlValues = scalarCalc(control, self.ra, self.dec, self.z)
+
+        for mapSet in (patternSet, manifestSet):
+            for memmap in (False, True):
+                wl = WL(map_set=mapSet)
+                wl.initialize(memmap=memmap)
+                self.assertEqual(wl.number_of_maps, len(redshifts))
+                self.assertEqual(wl.NbinsX, 64)
+                self.assertEqual(wl.survey_angle, 3.5)
+                testValues = wl.calc(self.ra, self.dec, self.z)
+                # the scalar calculation of the float32 maps is done in single precision
+                for test, controlValue in zip(testValues, controlValues):
+                    numpy.testing.assert_allclose(test, controlValue, rtol=1.0e-5, atol=1.0e-6)
+                wl.close()
+
+        self.assertRaises(ValueError, WLMapSet, directory, [1.0, 0.5], filename_pattern='x')
+        self.assertRaises(ValueError, WLMapSet, directory, [1.0], filename_pattern='x')
+
+        shutil.rmtree(directory)
+
+    def testMemmapInstances(self):
+        """
+        Test that closing one memory-mapped WL does not close the maps
+        of another one
+        """
+        directory = os.path.join(getPackageDir('sims_catalogs_measures'), 'tests',
+                                 'scratchSpace', 'wlMemmapTest')
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.mkdir(directory)
+
+        redshifts = [2.0, 1.5, 1.0]
+        writeCartoonMapSet(directory, redshifts)
+        mapSet = WLMapSet(directory, redshifts[::-1], filename_pattern='WL-{map_type}_{last_plane}.fit',
+                          last_plane=range(len(redshifts)-1, -1, -1))
+
+        first = WL(map_set=mapSet)
+        first.initialize(memmap=True)
+        controlValues = first.calc(self.ra, self.dec, self.z)
+
+        second = WL(map_set=mapSet)
+        second.initialize(memmap=True)
+        self.assertEqual(len(first._map_files), 3*len(redshifts))
+        self.assertEqual(len(second._map_files), 3*len(redshifts))
+        second.close()
+        self.assertTrue(second.maps is None)
+        for hdu in first._map_files:
+            self.assertFalse(hdu.fileinfo(0)['file'].closed)
+
+        testValues = first.calc(self.ra, self.dec, self.z)
+        for test, control in zip(testValues, controlValues):
+            numpy.testing.assert_array_equal(test, control)
+
+        first.close()
+        shutil.rmtree(directory)
+
+    def testPixelCoordinates(self):
+        """
+        Test that get_pixel_coordinates gives the same answers for arrays
+        and for single galaxies
+        """
+        wl = makeCartoonWL()
+        xArray, yArray = wl.get_pixel_coordinates(self.ra, self.dec)
+        for ra, dec, xTest, yTest in zip(self.ra, self.dec, xArray, yArray):
+            x, y = wl.get_pixel_coordinates(float(ra), float(dec))
+            self.assertIsInstance(x, float)
+            self.assertIsInstance(y, float)
+            self.assertEqual(x, xTest)
+            self.assertEqual(y, yTest)
+            self.assertTrue(x >= 1.0 and x < wl.NbinsX-2.0+1.0e-7)
+
+
+def suite():
+    """Returns a suite containing all the test cases in this module."""
+    utilsTests.init()
+    suites = []
+    suites += unittest.makeSuite(WeakLensingTest)
+
+    return unittest.TestSuite(suites)
+
+def run(shouldExit=False):
+    """Run the tests"""
+    utilsTests.run(suite(), shouldExit)
+
+if __name__ == "__main__":
+    run(True)